@@ -9,19 +9,37 @@ from __future__ import annotations
 import io
 import os
 import re
+import sys
 import json
+import hashlib
+import secrets
 import time
 import shutil
+import zipfile
 import xml.etree.ElementTree as ET
 import unicodedata
+from array import array
+import threading
+from concurrent.futures import Executor, ThreadPoolExecutor, Future
 from pathlib import Path
-from typing import List, Dict, Optional, Union, IO, Tuple
+from typing import List, Dict, Optional, Union, IO, Tuple, Iterator, Callable, NamedTuple
 from decimal import Decimal
-from datetime import datetime
+from datetime import datetime, date
+from itertools import zip_longest
 
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
 import streamlit as st
+import xlsxwriter
+from openpyxl import load_workbook
+from pandas.io.parsers import TextParser
+
+try:  # leitor de .xlsx em Rust (opcional): bem mais rápido que o openpyxl em planilhas grandes
+    from python_calamine import CalamineWorkbook
+except ImportError:
+    CalamineWorkbook = None
 
 # =========================================================
 # Configuração da página (UI)
@@ -42,28 +60,129 @@ def dec(txt: Optional[str]) -> Decimal:
     s = str(txt).strip().replace(',', '.')
     return Decimal(s) if s else DEC_ZERO
 
+# Modo inteiro: valores em centavos (int64) e quantidades escaladas por QTD_ESCALA
+QTD_CASAS = 4
+QTD_ESCALA = 10 ** QTD_CASAS
+# valor unitário com uma casa a mais (milésimos de real): preços abaixo de 1 centavo (ex.: 0.004 por
+# unidade de material) não podem virar 0 e cair no fallback "sem valor unitário" (= valor total)
+VUNI_CASAS = 3
+VUNI_ESCALA = 10 ** VUNI_CASAS
+_NUM_RE = re.compile(r'^([+-]?)(\d*)(?:\.(\d*))?$')
+
+def escalado(txt: Optional[str], casas: int = 2) -> int:
+    """Texto decimal TISS -> inteiro com `casas` decimais (arredonda meio para cima), sem passar por Decimal/float."""
+    if txt is None:
+        return 0
+    s = str(txt).strip().replace(',', '.')
+    if not s:
+        return 0
+    m = _NUM_RE.match(s)
+    if m is None or not (m.group(2) or m.group(3)):
+        raise ValueError(f"Valor numérico inválido: {txt!r}")
+    sinal, inteiro, frac = m.group(1), m.group(2) or '0', (m.group(3) or '').ljust(casas + 1, '0')
+    v = int(inteiro) * 10 ** casas + int(frac[:casas] or '0') + (frac[casas] >= '5')
+    return -v if sinal == '-' else v
+
 def tx(el: Optional[ET.Element]) -> str:
     return (el.text or '').strip() if (el is not None and el.text) else ''
 
+# Tabelas para montar a moeda por indexação (sem formatar célula a célula em Python)
+_BRL_GRUPO = np.array([f"{i:03d}" for i in range(1000)])
+_BRL_GRUPO_PONTO = np.array([f".{i:03d}" for i in range(1000)])
+_BRL_CENTAVOS = np.array([f",{i:02d}" for i in range(100)])
+_BRL_SINAL = np.array(["R$ ", "-R$ "])
+
+def formatar_brl(valores) -> pd.Series:
+    """
+    Moeda BRL vetorizada ('R$ 1.234,56', negativos com '-' na frente). Texto não numérico e None
+    viram R$ 0,00 (como no antigo float(v) com fallback); NaN/inf e pd.NA ficam em branco.
+    Centavos arredondados com vai-um (1,995 → R$ 2,00).
+    """
+    s = valores if isinstance(valores, pd.Series) else pd.Series(valores, dtype=object)
+    num = pd.to_numeric(s, errors="coerce").astype("float64")
+    zero = num.isna() & s.notna()
+    if s.dtype == object:
+        zero |= np.equal(s.to_numpy(), None)
+    v = num.where(~zero, 0.0).to_numpy()
+    ok = np.isfinite(v)
+    if not ok.any():
+        return pd.Series("", index=s.index, dtype=object)
+    a = np.abs(np.where(ok, v, 0.0))
+    inteiro = np.floor(a)
+    cent = np.rint((a - inteiro) * 100)
+    vai = cent >= 100
+    inteiro = inteiro.astype(np.int64) + vai
+    cent = np.where(vai, 0, cent).astype(np.int64)
+    # milhar: todos os grupos de 3 dígitos com zeros, depois tira os zeros/pontos à esquerda
+    n_grupos = max(1, -(-len(str(int(inteiro.max()))) // 3))
+    txt = _BRL_GRUPO[(inteiro // 1000 ** (n_grupos - 1)) % 1000]
+    for k in range(n_grupos - 2, -1, -1):
+        txt = np.strings.add(txt, _BRL_GRUPO_PONTO[(inteiro // 1000 ** k) % 1000])
+    txt = np.strings.lstrip(txt, "0.")
+    txt[inteiro == 0] = "0"
+    out = np.strings.add(np.strings.add(_BRL_SINAL[(v < 0).astype(np.intp)], txt), _BRL_CENTAVOS[cent])
+    out[~ok] = ""
+    return pd.Series(out.tolist(), index=s.index, dtype=object)
+
 def f_currency(v: Union[int, float, Decimal, str]) -> str:
-    try:
-        v = float(v)
-    except Exception:
-        v = 0.0
-    neg = v < 0
-    v = abs(v)
-    inteiro = int(v)
-    cent = int(round((v - inteiro) * 100))
-    s = f"R$ {inteiro:,}".replace(",", ".") + f",{cent:02d}"
-    return f"-{s}" if neg else s
+    return formatar_brl([v]).iat[0]
 
 def apply_currency(df: pd.DataFrame, cols: List[str]) -> pd.DataFrame:
     d = df.copy()
     for c in cols:
         if c in d.columns:
-            d[c] = d[c].apply(f_currency)
+            d[c] = formatar_brl(d[c])
+    return d
+
+def pagina_df(df: pd.DataFrame, key: str, tamanho: int = 1_000) -> pd.DataFrame:
+    """Só a página visível de tabelas grandes (formatar/exibir o resto a cada rerun é desperdício)."""
+    if df is None or len(df) <= tamanho:
+        return df
+    n_paginas = -(-len(df) // tamanho)
+    pagina = st.number_input(f"Página (de {n_paginas}; {tamanho} linhas por página, {len(df)} no total)",
+                             min_value=1, max_value=n_paginas, value=1, step=1, key=key)
+    return df.iloc[(pagina - 1) * tamanho: pagina * tamanho]
+
+# Colunas monetárias que ficam em centavos (int64) no modo inteiro
+_COLS_CENTAVOS = [
+    'valor_total', 'valor_apresentado', 'valor_glosa', 'valor_pago',
+    'apresentado_diff', 'valor_glosa_sim', 'valor_pago_sim', 'p50', 'q1', 'q3', 'iqr',
+]
+
+def em_reais(df: pd.DataFrame, centavos: bool) -> pd.DataFrame:
+    """
+    No modo inteiro, converte centavos -> reais, valor unitário em milésimos -> reais e
+    quantidade escalada -> unidades (só para exibição/exportação).
+    """
+    if not centavos or df is None or df.empty:
+        return df
+    d = df.copy()
+    for c in _COLS_CENTAVOS:
+        if c in d.columns:
+            d[c] = d[c] / 100
+    if 'valor_unitario' in d.columns:
+        d['valor_unitario'] = d['valor_unitario'] / VUNI_ESCALA
+    if 'quantidade' in d.columns:
+        d['quantidade'] = d['quantidade'] / QTD_ESCALA
     return d
 
+def demo_em_centavos(df_demo: pd.DataFrame) -> pd.DataFrame:
+    """Valores do demonstrativo (reais, float) -> centavos int64, para conciliar no modo inteiro."""
+    d = df_demo.copy()
+    for c in ['valor_apresentado', 'valor_pago', 'valor_glosa']:
+        if c in d.columns:
+            v = pd.to_numeric(d[c], errors='coerce').fillna(0).to_numpy(dtype=np.float64)
+            d[c] = np.rint(v * 100).astype(np.int64)
+    return d
+
+def _safe_div(num, den) -> np.ndarray:
+    """num/den elemento a elemento; 0.0 onde den <= 0 ou NaN (mesma regra dos antigos apply por linha)."""
+    n = pd.to_numeric(pd.Series(num), errors='coerce').to_numpy(dtype=np.float64, na_value=np.nan)
+    d = pd.to_numeric(pd.Series(den), errors='coerce').to_numpy(dtype=np.float64, na_value=np.nan)
+    out = np.zeros(len(n), dtype=np.float64)
+    np.divide(n, d, out=out, where=d > 0)
+    return out
+
 def parse_date_flex(s: str) -> Optional[datetime]:
     if s is None or not isinstance(s, str):
         return None
@@ -119,14 +238,75 @@ if "demo_mappings" not in st.session_state:
     st.session_state["demo_mappings"] = load_demo_mappings()
 
 # Cache
-@st.cache_data(show_spinner=False)
-def _cached_read_excel(file, sheet_name=0) -> pd.DataFrame:
-    return pd.read_excel(file, sheet_name=sheet_name, engine="openpyxl")
+def _bytes_arquivo(arquivo) -> bytes:
+    if isinstance(arquivo, (str, Path)):
+        return Path(arquivo).read_bytes()
+    return arquivo.getvalue() if hasattr(arquivo, "getvalue") else arquivo.read()
+
+@st.cache_resource(show_spinner=False, max_entries=32)
+def _planilha_cache(chave: str, engine: str, _dados: bytes) -> "_PlanilhaDemo":
+    return _PlanilhaDemo(_dados, engine)
+
+def _planilha_demo(arquivo, engine: str = "auto") -> "_PlanilhaDemo":
+    """Workbook do demonstrativo aberto uma vez por conteúdo (reaproveitado entre reruns e estratégias)."""
+    dados = _bytes_arquivo(arquivo)
+    return _planilha_cache(hashlib.sha1(dados).hexdigest(), engine, dados)
+
+# Cache persistente do parse de XML: um Parquet por (conteúdo, versão do parser, modo numérico).
+# Sobrevive a restart/redeploy; LRU por mtime limitado a TISS_CACHE_MAX_MB.
+XML_PARSER_VERSION = "2"
+XML_CACHE_DIR = Path(os.environ.get("TISS_CACHE_DIR", ".cache_tiss"))
+XML_CACHE_MAX_BYTES = int(float(os.environ.get("TISS_CACHE_MAX_MB", "512")) * 1024 * 1024)
+
+def _chave_cache_xml(b: bytes, centavos: bool = False) -> str:
+    h = hashlib.sha256(f"tiss-xml:{XML_PARSER_VERSION}:{'centavos' if centavos else 'float'}:".encode())
+    h.update(b)
+    return h.hexdigest()
+
+def _cache_xml_get(chave: str) -> Optional[Dict[str, Union[list, np.ndarray]]]:
+    p = XML_CACHE_DIR / f"{chave}.parquet"
+    if not p.exists():
+        return None
+    try:
+        tab = pq.read_table(p)
+        os.utime(p)  # LRU: mtime = último acesso
+    except Exception:
+        return None
+    return {
+        c: (col.to_numpy() if c in _ITEM_NUM_COLS else col.to_pylist())
+        for c, col in zip(tab.column_names, tab.columns)
+    }
 
-@st.cache_data(show_spinner=False)
-def _cached_xml_bytes(b: bytes) -> List[Dict]:
-    from io import BytesIO
-    return parse_itens_tiss_xml(BytesIO(b))
+def _cache_xml_put(chave: str, colunas: Dict[str, Union[list, np.ndarray]]):
+    # best-effort: falha de disco não pode derrubar a leitura
+    try:
+        XML_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        tmp = XML_CACHE_DIR / f".{chave}.{os.getpid()}.tmp"
+        pq.write_table(pa.table(colunas), tmp)
+        os.replace(tmp, XML_CACHE_DIR / f"{chave}.parquet")
+        _cache_xml_evict()
+    except Exception:
+        pass
+
+def _cache_xml_evict(limite: int = None):
+    limite = XML_CACHE_MAX_BYTES if limite is None else limite
+    arqs = []
+    for e in os.scandir(XML_CACHE_DIR):
+        if e.name.endswith(".parquet"):
+            try:
+                info = e.stat()
+                arqs.append((info.st_mtime, info.st_size, e.path))
+            except OSError:
+                continue
+    total = sum(a[1] for a in arqs)
+    for _, tam, path in sorted(arqs):
+        if total <= limite:
+            break
+        try:
+            os.remove(path)
+            total -= tam
+        except OSError:
+            pass
 
 # =========================================================
 # PARTE 2 — XML TISS → Itens por guia
@@ -140,138 +320,289 @@ def _get_numero_lote(root: ET.Element) -> str:
         return tx(el)
     return ""
 
-def _itens_consulta(guia: ET.Element) -> List[Dict]:
+# Colunas de item (ordem das tuplas geradas por _itens_*) e colunas de guia
+_ITEM_COLS = [
+    'tipo_item', 'identificadorDespesa', 'codigo_tabela', 'codigo_procedimento',
+    'descricao_procedimento', 'quantidade', 'valor_unitario', 'valor_total',
+]
+_GUIA_COLS = [
+    'arquivo', 'numero_lote', 'tipo_guia',
+    'numeroGuiaPrestador', 'numeroGuiaOperadora', 'paciente', 'medico', 'data_atendimento',
+]
+_ITEM_NUM_COLS = ('quantidade', 'valor_unitario', 'valor_total')
+
+class _Numerico(NamedTuple):
+    qtd: Callable[[str], object]
+    valor: Callable[[str], object]
+    vuni: Callable[[str], object]          # valor unitário (no modo inteiro, em VUNI_CASAS casas)
+    zero: object
+    um: object
+    total: Callable[[str, str], object]    # valor_unitario × quantidade, a partir dos textos
+
+def _total_centavos(vuni_txt: str, qtd_txt: str) -> int:
+    # produto em 4+4 casas e arredondado uma única vez para centavos
+    p = escalado(vuni_txt, QTD_CASAS) * escalado(qtd_txt, QTD_CASAS)
+    return (p + 5 * 10 ** (2 * QTD_CASAS - 3)) // 10 ** (2 * QTD_CASAS - 2)
+
+_NUM_DECIMAL = _Numerico(dec, dec, dec, DEC_ZERO, Decimal('1'), lambda vuni, qtd: dec(vuni) * dec(qtd))
+_NUM_CENTAVOS = _Numerico(lambda t: escalado(t, QTD_CASAS), escalado, lambda t: escalado(t, VUNI_CASAS),
+                          0, QTD_ESCALA, _total_centavos)
+
+def _itens_consulta(guia: ET.Element, num: _Numerico = _NUM_DECIMAL) -> List[Tuple]:
     proc = guia.find('.//ans:procedimento', ANS_NS)
     codigo_tabela = tx(proc.find('ans:codigoTabela', ANS_NS)) if proc is not None else ''
     codigo_proc   = tx(proc.find('ans:codigoProcedimento', ANS_NS)) if proc is not None else ''
     descricao     = tx(proc.find('ans:descricaoProcedimento', ANS_NS)) if proc is not None else ''
-    valor         = dec(tx(proc.find('ans:valorProcedimento', ANS_NS))) if proc is not None else DEC_ZERO
-    return [{
-        'tipo_item': 'procedimento',
-        'identificadorDespesa': '',
-        'codigo_tabela': codigo_tabela,
-        'codigo_procedimento': codigo_proc,
-        'descricao_procedimento': descricao,
-        'quantidade': Decimal('1'),
-        'valor_unitario': valor,
-        'valor_total': valor
-    }]
-
-def _itens_sadt(guia: ET.Element) -> List[Dict]:
+    valor_txt     = tx(proc.find('ans:valorProcedimento', ANS_NS)) if proc is not None else ''
+    return [('procedimento', '', codigo_tabela, codigo_proc, descricao, num.um, num.vuni(valor_txt), num.valor(valor_txt))]
+
+def _itens_sadt(guia: ET.Element, num: _Numerico = _NUM_DECIMAL) -> List[Tuple]:
+    zero = num.zero
     out = []
     for it in guia.findall('.//ans:procedimentosExecutados/ans:procedimentoExecutado', ANS_NS):
         proc = it.find('ans:procedimento', ANS_NS)
         codigo_tabela = tx(proc.find('ans:codigoTabela', ANS_NS)) if proc is not None else ''
         codigo_proc   = tx(proc.find('ans:codigoProcedimento', ANS_NS)) if proc is not None else ''
         descricao     = tx(proc.find('ans:descricaoProcedimento', ANS_NS)) if proc is not None else ''
-        qtd  = dec(tx(it.find('ans:quantidadeExecutada', ANS_NS)))
-        vuni = dec(tx(it.find('ans:valorUnitario', ANS_NS)))
-        vtot = dec(tx(it.find('ans:valorTotal', ANS_NS)))
-        if vtot == DEC_ZERO and (vuni > DEC_ZERO and qtd > DEC_ZERO):
-            vtot = vuni * qtd
-        out.append({
-            'tipo_item': 'procedimento',
-            'identificadorDespesa': '',
-            'codigo_tabela': codigo_tabela,
-            'codigo_procedimento': codigo_proc,
-            'descricao_procedimento': descricao,
-            'quantidade': qtd if qtd > DEC_ZERO else Decimal('1'),
-            'valor_unitario': vuni if vuni > DEC_ZERO else vtot,
-            'valor_total': vtot,
-        })
+        qtd_txt  = tx(it.find('ans:quantidadeExecutada', ANS_NS))
+        vuni_txt = tx(it.find('ans:valorUnitario', ANS_NS))
+        vtot_txt = tx(it.find('ans:valorTotal', ANS_NS))
+        qtd  = num.qtd(qtd_txt)
+        vuni = num.vuni(vuni_txt)
+        vtot = num.valor(vtot_txt)
+        if vtot == zero and (vuni > zero and qtd > zero):
+            vtot = num.total(vuni_txt, qtd_txt)
+        out.append((
+            'procedimento', '', codigo_tabela, codigo_proc, descricao,
+            qtd if qtd > zero else num.um,
+            vuni if vuni > zero else num.vuni(vtot_txt),  # sem valor unitário: o total informado
+            vtot,
+        ))
     for desp in guia.findall('.//ans:outrasDespesas/ans:despesa', ANS_NS):
         ident = tx(desp.find('ans:identificadorDespesa', ANS_NS))
         sv = desp.find('ans:servicosExecutados', ANS_NS)
         codigo_tabela = tx(sv.find('ans:codigoTabela', ANS_NS)) if sv is not None else ''
         codigo_proc   = tx(sv.find('ans:codigoProcedimento', ANS_NS)) if sv is not None else ''
         descricao     = tx(sv.find('ans:descricaoProcedimento', ANS_NS)) if sv is not None else ''
-        qtd  = dec(tx(sv.find('ans:quantidadeExecutada', ANS_NS))) if sv is not None else DEC_ZERO
-        vuni = dec(tx(sv.find('ans:valorUnitario', ANS_NS)))      if sv is not None else DEC_ZERO
-        vtot = dec(tx(sv.find('ans:valorTotal', ANS_NS)))         if sv is not None else DEC_ZERO
-        if vtot == DEC_ZERO and (vuni > DEC_ZERO and qtd > DEC_ZERO):
-            vtot = vuni * qtd
-        out.append({
-            'tipo_item': 'outra_despesa',
-            'identificadorDespesa': ident,
-            'codigo_tabela': codigo_tabela,
-            'codigo_procedimento': codigo_proc,
-            'descricao_procedimento': descricao,
-            'quantidade': qtd if qtd > DEC_ZERO else Decimal('1'),
-            'valor_unitario': vuni if vuni > DEC_ZERO else vtot,
-            'valor_total': vtot,
-        })
+        qtd_txt  = tx(sv.find('ans:quantidadeExecutada', ANS_NS)) if sv is not None else ''
+        vuni_txt = tx(sv.find('ans:valorUnitario', ANS_NS))       if sv is not None else ''
+        vtot_txt = tx(sv.find('ans:valorTotal', ANS_NS))         if sv is not None else ''
+        qtd  = num.qtd(qtd_txt)
+        vuni = num.vuni(vuni_txt)
+        vtot = num.valor(vtot_txt)
+        if vtot == zero and (vuni > zero and qtd > zero):
+            vtot = num.total(vuni_txt, qtd_txt)
+        out.append((
+            'outra_despesa', ident, codigo_tabela, codigo_proc, descricao,
+            qtd if qtd > zero else num.um,
+            vuni if vuni > zero else num.vuni(vtot_txt),
+            vtot,
+        ))
     return out
 
-def parse_itens_tiss_xml(source: Union[str, Path, IO[bytes]]) -> List[Dict]:
+def _cabecalho_consulta(guia: ET.Element) -> Tuple[str, ...]:
+    numero_guia_prest = tx(guia.find('ans:numeroGuiaPrestador', ANS_NS))
+    numero_guia_oper  = tx(guia.find('ans:numeroGuiaOperadora', ANS_NS)) or numero_guia_prest
+    paciente = tx(guia.find('.//ans:dadosBeneficiario/ans:nomeBeneficiario', ANS_NS))
+    medico   = tx(guia.find('.//ans:dadosProfissionaisResponsaveis/ans:nomeProfissional', ANS_NS))
+    data_atd = tx(guia.find('.//ans:dataAtendimento', ANS_NS))
+    return numero_guia_prest, numero_guia_oper, paciente, medico, data_atd
+
+def _cabecalho_sadt(guia: ET.Element) -> Tuple[str, ...]:
+    cab = guia.find('ans:cabecalhoGuia', ANS_NS)
+    aut = guia.find('ans:dadosAutorizacao', ANS_NS)
+
+    numero_guia_prest = tx(guia.find('ans:numeroGuiaPrestador', ANS_NS))
+    if not numero_guia_prest and cab is not None:
+        numero_guia_prest = tx(cab.find('ans:numeroGuiaPrestador', ANS_NS))
+
+    numero_guia_oper = ""
+    if aut is not None:
+        numero_guia_oper = tx(aut.find('ans:numeroGuiaOperadora', ANS_NS))
+    if not numero_guia_oper and cab is not None:
+        numero_guia_oper = tx(cab.find('ans:numeroGuiaOperadora', ANS_NS))
+    if not numero_guia_oper:
+        numero_guia_oper = numero_guia_prest
+
+    paciente = tx(guia.find('.//ans:dadosBeneficiario/ans:nomeBeneficiario', ANS_NS))
+    medico   = tx(guia.find('.//ans:dadosProfissionaisResponsaveis/ans:nomeProfissional', ANS_NS))
+    data_atd = tx(guia.find('.//ans:dataAtendimento', ANS_NS))
+    return numero_guia_prest, numero_guia_oper, paciente, medico, data_atd
+
+# tipo_guia -> (tag local, cabeçalho, itens)
+_GUIAS_TISS = {
+    'CONSULTA': ('guiaConsulta', _cabecalho_consulta, _itens_consulta),
+    'SADT': ('guiaSP-SADT', _cabecalho_sadt, _itens_sadt),
+}
+
+def _abrir_fonte_xml(source: Union[str, Path, IO[bytes]]) -> Tuple[Union[str, IO[bytes]], str]:
     if hasattr(source, 'read'):
         if hasattr(source, 'seek'):
             source.seek(0)
-        root = ET.parse(source).getroot()
-        nome = getattr(source, "name", "upload.xml")
-    else:
-        p = Path(source)
-        root = ET.parse(p).getroot()
-        nome = p.name
-
+        return source, getattr(source, "name", "upload.xml")
+    p = Path(source)
+    return str(p), p.name
+
+# Motor streaming: tags qualificadas usadas no iterparse
+_ANS_TAG = '{%s}' % ANS_NS['ans']
+_TAGS_GUIA = {_ANS_TAG + tag: tipo for tipo, (tag, _, _) in _GUIAS_TISS.items()}
+_LOTE_GUIAS  = (_ANS_TAG + 'prestadorParaOperadora', _ANS_TAG + 'loteGuias')
+_LOTE_RECURSO = (_ANS_TAG + 'prestadorParaOperadora', _ANS_TAG + 'recursoGlosa', _ANS_TAG + 'guiaRecursoGlosa')
+
+def _guias_stream(src: Union[str, IO[bytes]]) -> Iterator[Tuple[str, ET.Element, str]]:
+    # numeroLote vem antes das guias no schema TISS (loteGuias / guiaRecursoGlosa)
+    lote_guias: Optional[str] = None
+    lote_recurso: Optional[str] = None
+    pilha: List[ET.Element] = []
+    for evento, el in ET.iterparse(src, events=("start", "end")):
+        if evento == "start":
+            pilha.append(el)
+            continue
+        pilha.pop()
+        tipo_guia = _TAGS_GUIA.get(el.tag)
+        if tipo_guia is not None:
+            yield tipo_guia, el, (lote_guias or lote_recurso or "")
+            # guia já consumida: solta da árvore para liberar memória
+            if pilha:
+                pilha[-1].remove(el)
+            else:
+                el.clear()
+        elif el.tag == _ANS_TAG + 'numeroLote':
+            caminho = tuple(e.tag for e in pilha)
+            if lote_guias is None and caminho[-2:] == _LOTE_GUIAS:
+                lote_guias = tx(el)
+            elif lote_recurso is None and caminho[-3:] == _LOTE_RECURSO:
+                lote_recurso = tx(el)
+
+def _guias_tree(src: Union[str, IO[bytes]]) -> Iterator[Tuple[str, ET.Element, str]]:
+    root = ET.parse(src).getroot()
     numero_lote = _get_numero_lote(root)
-    out: List[Dict] = []
+    for tipo_guia, (tag, _, _) in _GUIAS_TISS.items():
+        for guia in root.findall(f'.//ans:{tag}', ANS_NS):
+            yield tipo_guia, guia, numero_lote
+
+_MOTORES_XML = {'tree': _guias_tree, 'stream': _guias_stream}
 
-    # CONSULTA
-    for guia in root.findall('.//ans:guiaConsulta', ANS_NS):
-        numero_guia_prest = tx(guia.find('ans:numeroGuiaPrestador', ANS_NS))
-        numero_guia_oper  = tx(guia.find('ans:numeroGuiaOperadora', ANS_NS)) or numero_guia_prest
-        paciente = tx(guia.find('.//ans:dadosBeneficiario/ans:nomeBeneficiario', ANS_NS))
-        medico   = tx(guia.find('.//ans:dadosProfissionaisResponsaveis/ans:nomeProfissional', ANS_NS))
-        data_atd = tx(guia.find('.//ans:dataAtendimento', ANS_NS))
-        for it in _itens_consulta(guia):
-            it.update({
-                'arquivo': nome,
-                'numero_lote': numero_lote,
-                'tipo_guia': 'CONSULTA',
-                'numeroGuiaPrestador': numero_guia_prest,
-                'numeroGuiaOperadora': numero_guia_oper,
-                'paciente': paciente,
-                'medico': medico,
-                'data_atendimento': data_atd,
-            })
-            out.append(it)
-
-    # SADT
-    for guia in root.findall('.//ans:guiaSP-SADT', ANS_NS):
-        cab = guia.find('ans:cabecalhoGuia', ANS_NS)
-        aut = guia.find('ans:dadosAutorizacao', ANS_NS)
-
-        numero_guia_prest = tx(guia.find('ans:numeroGuiaPrestador', ANS_NS))
-        if not numero_guia_prest and cab is not None:
-            numero_guia_prest = tx(cab.find('ans:numeroGuiaPrestador', ANS_NS))
-
-        numero_guia_oper = ""
-        if aut is not None:
-            numero_guia_oper = tx(aut.find('ans:numeroGuiaOperadora', ANS_NS))
-        if not numero_guia_oper and cab is not None:
-            numero_guia_oper = tx(cab.find('ans:numeroGuiaOperadora', ANS_NS))
-        if not numero_guia_oper:
-            numero_guia_oper = numero_guia_prest
-
-        paciente = tx(guia.find('.//ans:dadosBeneficiario/ans:nomeBeneficiario', ANS_NS))
-        medico   = tx(guia.find('.//ans:dadosProfissionaisResponsaveis/ans:nomeProfissional', ANS_NS))
-        data_atd = tx(guia.find('.//ans:dataAtendimento', ANS_NS))
-
-        for it in _itens_sadt(guia):
-            it.update({
-                'arquivo': nome,
-                'numero_lote': numero_lote,
-                'tipo_guia': 'SADT',
-                'numeroGuiaPrestador': numero_guia_prest,
-                'numeroGuiaOperadora': numero_guia_oper,
-                'paciente': paciente,
-                'medico': medico,
-                'data_atendimento': data_atd,
-            })
-            out.append(it)
+def _motor_xml(engine: str):
+    try:
+        return _MOTORES_XML[engine]
+    except KeyError:
+        raise ValueError(f"Motor de XML desconhecido: {engine!r} (use 'tree' ou 'stream').") from None
 
+def _linhas_guia(guia: ET.Element, tipo_guia: str, nome: str, numero_lote: str) -> List[Dict]:
+    _, cabecalho, itens = _GUIAS_TISS[tipo_guia]
+    base = dict(zip(_GUIA_COLS, (nome, numero_lote, tipo_guia) + cabecalho(guia)))
+    out = []
+    for it in itens(guia):
+        d = dict(zip(_ITEM_COLS, it))
+        d.update(base)
+        out.append(d)
     return out
 
+def iter_itens_tiss_xml(source: Union[str, Path, IO[bytes]]) -> Iterator[Dict]:
+    """
+    Motor streaming (iterparse): gera um dict por procedimentoExecutado/despesa
+    e descarta cada guia assim que ela é processada — a memória fica limitada
+    a uma guia por vez, independente do tamanho do lote.
+    As guias saem na ordem do documento (o motor 'tree' lista CONSULTA antes de SADT).
+    """
+    src, nome = _abrir_fonte_xml(source)
+    for tipo_guia, guia, numero_lote in _guias_stream(src):
+        yield from _linhas_guia(guia, tipo_guia, nome, numero_lote)
+
+def parse_itens_tiss_xml(source: Union[str, Path, IO[bytes]], engine: str = "tree") -> List[Dict]:
+    src, nome = _abrir_fonte_xml(source)
+    out: List[Dict] = []
+    for tipo_guia, guia, numero_lote in _motor_xml(engine)(src):
+        out.extend(_linhas_guia(guia, tipo_guia, nome, numero_lote))
+    if engine == "stream":
+        # mesma ordem do motor 'tree': todas as CONSULTA, depois as SADT
+        out.sort(key=lambda r: r['tipo_guia'] != 'CONSULTA')
+    return out
+
+class ColetorItens:
+    """
+    Acumula itens em buffers por coluna (struct-of-arrays) em vez de um dict por item.
+    Valores numéricos vão para array('d') — ou array('q') no modo centavos, já como
+    inteiros exatos; textos de guia são internados, então as repetições por item
+    compartilham o mesmo objeto. `colunas()` entrega o dict-de-colunas pronto para o pandas.
+    """
+    def __init__(self, centavos: bool = False):
+        self.centavos = centavos
+        self._tipo, self._dtype, self._conv = ('q', np.int64, int) if centavos else ('d', np.float64, float)
+        self._cols: Dict[str, Union[list, array]] = {
+            c: (array(self._tipo) if c in _ITEM_NUM_COLS else []) for c in _ITEM_COLS + _GUIA_COLS
+        }
+        self._erros: List[Tuple[int, str]] = []
+        self.n_linhas = 0
+
+    @property
+    def n_itens(self) -> int:
+        return self.n_linhas - len(self._erros)
+
+    def add_guia(self, guia_vals: Tuple[str, ...], itens: List[Tuple]):
+        k = len(itens)
+        if not k:
+            return
+        for c, vals in zip(_ITEM_COLS, zip(*itens)):
+            if c in _ITEM_NUM_COLS:
+                self._cols[c].extend(map(self._conv, vals))
+            else:
+                self._cols[c].extend(map(sys.intern, vals))
+        for c, v in zip(_GUIA_COLS, guia_vals):
+            self._cols[c].extend([sys.intern(v)] * k)
+        self.n_linhas += k
+
+    def add_erro(self, arquivo: str, erro: str):
+        for c, buf in self._cols.items():
+            if c in _ITEM_NUM_COLS:
+                buf.append(0 if self.centavos else float('nan'))
+            else:
+                buf.append(arquivo if c == 'arquivo' else None)
+        self._erros.append((self.n_linhas, erro))
+        self.n_linhas += 1
+
+    def extend(self, colunas: Dict[str, Union[list, np.ndarray]]):
+        """Anexa o dict-de-colunas de outro coletor (ex.: vindo do cache ou de uma thread do pool)."""
+        n = len(colunas['arquivo'])
+        erros = colunas.get('erro')
+        for c, buf in self._cols.items():
+            if isinstance(buf, array):
+                buf.frombytes(np.asarray(colunas[c], dtype=self._dtype).tobytes())
+            else:
+                buf.extend(colunas[c])
+        if erros is not None:
+            self._erros.extend((self.n_linhas + i, e) for i, e in enumerate(erros) if e is not None)
+        self.n_linhas += n
+
+    def colunas(self) -> Dict[str, Union[list, np.ndarray]]:
+        out = {c: (np.frombuffer(buf, dtype=self._dtype) if isinstance(buf, array) else buf)
+               for c, buf in self._cols.items()}
+        if self._erros:
+            erro = [None] * self.n_linhas
+            for i, e in self._erros:
+                erro[i] = e
+            out['erro'] = erro
+        return out
+
+def coletar_itens_tiss_xml(source: Union[str, Path, IO[bytes]], engine: str = "tree",
+                           centavos: bool = False) -> ColetorItens:
+    """
+    Versão colunar de parse_itens_tiss_xml (mesmas linhas, mesma ordem).
+    Com centavos=True os valores saem em centavos int64, o valor unitário em milésimos (VUNI_ESCALA)
+    e a quantidade escalada por QTD_ESCALA.
+    """
+    src, nome = _abrir_fonte_xml(source)
+    num = _NUM_CENTAVOS if centavos else _NUM_DECIMAL
+    por_tipo = {t: ColetorItens(centavos) for t in _GUIAS_TISS}
+    for tipo_guia, guia, numero_lote in _motor_xml(engine)(src):
+        _, cabecalho, itens = _GUIAS_TISS[tipo_guia]
+        por_tipo[tipo_guia].add_guia((nome, numero_lote, tipo_guia) + cabecalho(guia), itens(guia, num))
+    coletor = ColetorItens(centavos)
+    for c in por_tipo.values():
+        coletor.extend(c.colunas())
+    return coletor
+
 # =========================================================
 # PARTE 3 — Demonstrativo (.xlsx)
 # =========================================================
@@ -285,24 +616,215 @@ def tratar_codigo_glosa(df: pd.DataFrame) -> pd.DataFrame:
     df["motivo_glosa_descricao"] = df["motivo_glosa_descricao"].fillna("").str.strip()
     return df
 
-def ler_demo_amhp_fixado(path, strip_zeros_codes: bool = False) -> pd.DataFrame:
+# ---------------------------------------------------------
+# Leitura de planilhas .xlsx: motores plugáveis
+# ---------------------------------------------------------
+# Cada motor abre o workbook a partir dos bytes e entrega as linhas de uma aba como
+# listas de valores Python; o resto (cabeçalho, tipos, DataFrame) é comum.
+class _LivroCalamine:
+    def __init__(self, dados: bytes):
+        self._wb = CalamineWorkbook.from_filelike(io.BytesIO(dados))
+        self.abas: List[str] = list(self._wb.sheet_names)
+
+    def linhas(self, aba: str) -> Iterator[list]:
+        return iter(self._wb.get_sheet_by_name(aba).to_python(skip_empty_area=False))
+
+class _LivroOpenpyxl:
+    def __init__(self, dados: bytes):
+        self._wb = load_workbook(io.BytesIO(dados), read_only=True, data_only=True)
+        self.abas: List[str] = list(self._wb.sheetnames)
+
+    def linhas(self, aba: str) -> Iterator[list]:
+        ws = self._wb[aba]
+        ws.reset_dimensions()
+        return (list(r) for r in ws.iter_rows(values_only=True))
+
+_LEITORES_XLSX = {"calamine": _LivroCalamine, "openpyxl": _LivroOpenpyxl}
+
+def motores_xlsx() -> List[str]:
+    """Motores disponíveis neste ambiente ('pandas' = read_excel + conversão depois, só para comparação)."""
+    return ["auto"] + (["calamine"] if CalamineWorkbook is not None else []) + ["openpyxl", "pandas"]
+
+def _abrir_xlsx(dados: bytes, engine: str = "auto"):
+    if engine in ("auto", "pandas"):
+        engine = "calamine" if CalamineWorkbook is not None else "openpyxl"
+    if engine == "calamine" and CalamineWorkbook is None:
+        raise ValueError("Motor 'calamine' indisponível: instale python-calamine.")
     try:
-        df_raw = pd.read_excel(path, header=None, engine="openpyxl")
-    except:
-        df_raw = pd.read_csv(path, header=None)
-
-    header_row = None
-    for i in range(min(20, len(df_raw))):
-        row_values = df_raw.iloc[i].astype(str).tolist()
-        if any("CPF/CNPJ" in str(val).upper() for val in row_values):
-            header_row = i
-            break
+        return _LEITORES_XLSX[engine](dados)
+    except KeyError:
+        raise ValueError(f"Motor de planilha desconhecido: {engine!r}") from None
+
+def _nomes_colunas(cab: list, largura: int) -> List[str]:
+    """Nomes como o read_excel gera (Unnamed: i, duplicadas com .1, .2 ...), já sem espaços nas bordas."""
+    nomes, vistos = [], {}
+    for j in range(largura):
+        v = cab[j] if j < len(cab) else None
+        if v is None or v == "":
+            nome = f"Unnamed: {j}"
+        elif isinstance(v, float) and v.is_integer():
+            nome = str(int(v))
+        else:
+            nome = str(v).strip()
+        if nome in vistos:
+            vistos[nome] += 1
+            nome = f"{nome}.{vistos[nome]}"
+        else:
+            vistos[nome] = 0
+        nomes.append(nome)
+    return nomes
+
+def _coluna_tipada(vals: tuple, tipo: Optional[str]) -> pd.Series:
+    s = pd.Series(vals, dtype=object)
+    if tipo == "num":
+        return pd.to_numeric(s.replace("", None), errors="coerce")
+    if tipo == "data":
+        return pd.to_datetime(s.replace("", None), errors="coerce")
+    s = pd.Series([None if v == "" else v for v in vals])
+    if s.dtype == object or pd.api.types.is_string_dtype(s):
+        nn = s.dropna()
+        if len(nn) and s.dtype == object and all(isinstance(v, (datetime, date)) for v in nn):
+            return pd.to_datetime(s)
+        # como o read_excel: coluna inteira com texto numérico vira número
+        try:
+            return _inteiro_se_exato(pd.to_numeric(s))
+        except (ValueError, TypeError):
+            pass
+        if s.dtype == object:
+            return s.map(lambda v: int(v) if isinstance(v, float) and v.is_integer() else v)
+        return s
+    return _inteiro_se_exato(s)
+
+def _inteiro_se_exato(s: pd.Series) -> pd.Series:
+    # como o read_excel: números inteiros guardados como float viram int
+    if s.dtype == np.float64 and len(s) and s.notna().all() and np.all(np.mod(s.to_numpy(), 1) == 0):
+        return s.astype(np.int64)
+    return s
+
+def _quadro_xlsx(linhas: Iterator[list], tipar: Optional[Callable[[List[str]], Dict[str, str]]] = None) -> pd.DataFrame:
+    """
+    Primeira linha = cabeçalho. As colunas saem direto das linhas (transposição em C) e já
+    com o tipo pedido por tipar(nomes) -> {coluna: 'num' | 'data'}; as demais são inferidas.
+    """
+    cab = next(linhas, None)
+    if cab is None:
+        return pd.DataFrame()
+    corpo = list(linhas)
+    while corpo and all(v is None or v == "" for v in corpo[-1]):
+        corpo.pop()
+    largura = max([len(cab)] + [len(r) for r in corpo])
+    while largura and (largura > len(cab) or cab[largura - 1] in (None, "")) \
+            and all(len(r) < largura or r[largura - 1] in (None, "") for r in corpo):
+        largura -= 1
+    nomes = _nomes_colunas(cab, largura)
+    tipos = tipar(nomes) if tipar else {}
+    colunas = list(zip_longest(*corpo, fillvalue=None))[:largura] if corpo else [()] * largura
+    df = pd.DataFrame({j: _coluna_tipada(colunas[j], tipos.get(nomes[j])) for j in range(largura)})
+    df.columns = nomes
+    return df
+
+def ler_planilha_xlsx(arquivo, aba: Optional[str] = None, engine: str = "auto",
+                      tipar: Optional[Callable[[List[str]], Dict[str, str]]] = None) -> pd.DataFrame:
+    """
+    Lê uma aba (.xlsx) com cabeçalho na 1ª linha. engine: 'auto' (calamine se instalado),
+    'calamine', 'openpyxl' (read-only, streaming) ou 'pandas' (read_excel; tipos aplicados depois).
+    """
+    dados = _bytes_arquivo(arquivo)
+    if engine == "pandas":
+        df = pd.read_excel(io.BytesIO(dados), sheet_name=aba or 0, engine="openpyxl")
+        df.columns = [str(c).strip() for c in df.columns]
+        for c, tipo in (tipar(list(df.columns)) if tipar else {}).items():
+            df[c] = pd.to_numeric(df[c], errors="coerce") if tipo == "num" else pd.to_datetime(df[c], errors="coerce")
+        return df
+    livro = _abrir_xlsx(dados, engine)
+    return _quadro_xlsx(livro.linhas(aba or livro.abas[0]), tipar)
+
+# Células que o read_excel do pandas trataria como ausentes
+_NA_CELULA = frozenset({"", "#N/A", "N/A", "NA", "NULL", "NaN", "nan", "null", "n/a", "<NA>", "None"})
+
+class _PlanilhaDemo:
+    """
+    Workbook .xlsx lido uma única vez (calamine ou openpyxl read-only, ver _abrir_xlsx). As linhas
+    de cada aba são convertidas como o leitor openpyxl do pandas faz e guardadas; o leitor AMHP fixo,
+    o mapeamento persistido, a auto-detecção e o wizard trabalham todos sobre elas.
+    A instância fica em st.cache_resource (compartilhada entre sessões): o preenchimento preguiçoso
+    passa por um lock, já que o workbook read-only não pode ser iterado por duas threads ao mesmo tempo.
+    """
+    def __init__(self, dados: bytes, engine: str = "auto"):
+        self._livro = _abrir_xlsx(dados, engine)
+        self.abas: List[str] = self._livro.abas
+        self._linhas: Dict[str, List[list]] = {}
+        self._tabelas: Dict[str, pd.DataFrame] = {}
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def _celula(v):
+        if v is None:
+            return ""
+        if isinstance(v, float) and v.is_integer():
+            return int(v)
+        if type(v) is date:  # calamine devolve date puro em células só com data
+            return datetime(v.year, v.month, v.day)
+        return v
+
+    def linhas(self, aba: Optional[str] = None) -> List[list]:
+        aba = aba or self.abas[0]
+        with self._lock:
+            if aba not in self._linhas:
+                linhas, ultima = [], -1
+                for i, row in enumerate(self._livro.linhas(aba)):
+                    conv = [self._celula(v) for v in row]
+                    while conv and conv[-1] == "":
+                        conv.pop()
+                    if conv:
+                        ultima = i
+                    linhas.append(conv)
+                self._linhas[aba] = linhas[:ultima + 1]
+            return self._linhas[aba]
+
+    def tabela(self, aba: Optional[str] = None) -> pd.DataFrame:
+        """Equivalente a pd.read_excel(arquivo, sheet_name=aba), sem reabrir o arquivo."""
+        aba = aba or self.abas[0]
+        with self._lock:
+            if aba not in self._tabelas:
+                linhas = self.linhas(aba)
+                if not linhas:
+                    self._tabelas[aba] = pd.DataFrame()
+                else:
+                    larg = max(len(r) for r in linhas)
+                    dados = [r + [""] * (larg - len(r)) for r in linhas]
+                    self._tabelas[aba] = TextParser(dados, header=0, skip_blank_lines=False).read()
+            return self._tabelas[aba]
+
+def _coluna_demo(valores: list) -> pd.Series:
+    vals = [np.nan if isinstance(v, str) and v in _NA_CELULA else v for v in valores]
+    so_texto = all(isinstance(v, str) for v in vals if not (isinstance(v, float) and np.isnan(v)))
+    return pd.Series(vals) if so_texto else pd.Series(vals, dtype=object)
+
+def ler_demo_amhp_fixado(path, strip_zeros_codes: bool = False) -> pd.DataFrame:
+    # o script é reexecutado a cada rerun (classe redefinida), então nada de isinstance aqui
+    if hasattr(path, "linhas"):
+        linhas = path.linhas()
+    else:
+        try:
+            linhas = _planilha_demo(path).linhas()
+        except Exception:
+            if hasattr(path, "seek"):
+                path.seek(0)
+            df_csv = pd.read_csv(path, header=None, dtype=object, keep_default_na=False)
+            linhas = df_csv.values.tolist()
+
+    # cabeçalho nas 20 primeiras linhas; o corpo vira colunas direto das linhas já lidas
+    header_row = next((i for i, row in enumerate(linhas[:20])
+                       if any("CPF/CNPJ" in str(val).upper() for val in row)), None)
     if header_row is None:
         raise ValueError("Não foi possível localizar a linha de cabeçalho 'CPF/CNPJ' no demonstrativo.")
 
-    df = df_raw.iloc[header_row + 1:].copy()
-    df.columns = df_raw.iloc[header_row]
-    df = df.loc[:, df.columns.notna()]
+    cab = linhas[header_row]
+    corpo = linhas[header_row + 1:]
+    usar = [j for j, nome in enumerate(cab) if not (isinstance(nome, str) and nome in _NA_CELULA)]
+    df = pd.DataFrame({j: _coluna_demo([row[j] if j < len(row) else "" for row in corpo]) for j in usar})
+    df.columns = [cab[j] for j in usar]
 
     ren = {
         "Guia": "numeroGuiaPrestador",
@@ -394,19 +916,19 @@ def _apply_manual_map(df: pd.DataFrame, mapping: dict) -> pd.DataFrame:
     out["chave_oper"]  = out["numeroGuiaOperadora"] + "__" + out["codigo_procedimento_norm"]
     return out
 
-def _mapping_wizard_for_demo(uploaded_file):
+def _mapping_wizard_for_demo(uploaded_file, planilha: Optional[_PlanilhaDemo] = None):
     st.warning(f"Mapeamento manual pode ser necessário para: **{uploaded_file.name}**")
     try:
-        xls = pd.ExcelFile(uploaded_file, engine="openpyxl")
+        planilha = planilha or _planilha_demo(uploaded_file)
     except Exception as e:
         st.error(f"Erro abrindo arquivo: {e}")
         return None
     sheet = st.selectbox(
         f"Aba (sheet) do demonstrativo {uploaded_file.name}",
-        xls.sheet_names,
+        planilha.abas,
         key=f"map_sheet_{uploaded_file.name}"
     )
-    df_raw = _cached_read_excel(uploaded_file, sheet)
+    df_raw = planilha.tabela(sheet)
     st.dataframe(df_raw.head(15), use_container_width=True)
     cols = [str(c) for c in df_raw.columns]
     fields = [
@@ -445,36 +967,36 @@ def _mapping_wizard_for_demo(uploaded_file):
             return None
     return None
 
-def build_demo_df(demo_files, strip_zeros_codes=False) -> pd.DataFrame:
+def build_demo_df(demo_files, strip_zeros_codes=False, engine: str = "auto") -> pd.DataFrame:
     if not demo_files:
         return pd.DataFrame()
     parts: List[pd.DataFrame] = []
     st.session_state.setdefault("demo_mappings", load_demo_mappings())
     for f in demo_files:
         fname = f.name
+        # um único parse do workbook, compartilhado pelas estratégias abaixo
+        try:
+            planilha = _planilha_demo(f, engine)
+        except Exception:
+            planilha = None
         # 1) leitor AMHP automático
         try:
-            df_demo = ler_demo_amhp_fixado(f, strip_zeros_codes=strip_zeros_codes)
+            df_demo = ler_demo_amhp_fixado(planilha if planilha is not None else f, strip_zeros_codes=strip_zeros_codes)
             parts.append(df_demo)
             continue
         except Exception:
             pass
         # 2) mapeamento persistido
         mapping_info = st.session_state["demo_mappings"].get(fname)
-        if mapping_info:
-            try:
-                df_demo = ler_demo_amhp_fixado(f, strip_zeros_codes=strip_zeros_codes)
-            except:
-                df_raw = _cached_read_excel(f, mapping_info["sheet"])
-                df_demo = _apply_manual_map(df_raw, mapping_info["columns"])
+        if mapping_info and planilha is not None and mapping_info["sheet"] in planilha.abas:
+            df_raw = planilha.tabela(mapping_info["sheet"])
+            df_demo = _apply_manual_map(df_raw, mapping_info["columns"])
             df_demo = tratar_codigo_glosa(df_demo)
             parts.append(df_demo)
             continue
         # 3) auto-detecção suave
         try:
-            xls = pd.ExcelFile(f, engine="openpyxl")
-            sheet = xls.sheet_names[0]
-            df_raw = _cached_read_excel(f, sheet)
+            df_raw = planilha.tabela()
             cols = [str(c) for c in df_raw.columns]
             pick = {k: _match_col(cols, v) for k, v in _COLMAPS.items()}
             if pick.get("cod_proc"):
@@ -486,7 +1008,7 @@ def build_demo_df(demo_files, strip_zeros_codes=False) -> pd.DataFrame:
             pass
         # 4) wizard
         with st.expander(f"⚙️ Mapear manualmente: {fname}", expanded=True):
-            df_manual = _mapping_wizard_for_demo(f)
+            df_manual = _mapping_wizard_for_demo(f, planilha)
             if df_manual is not None:
                 parts.append(df_manual)
             else:
@@ -498,26 +1020,95 @@ def build_demo_df(demo_files, strip_zeros_codes=False) -> pd.DataFrame:
 # =========================================================
 # PARTE 4 — Conciliação (XML × Demonstrativo) + Analytics
 # =========================================================
-def build_xml_df(xml_files, strip_zeros_codes: bool = False) -> pd.DataFrame:
-    linhas: List[Dict] = []
-    for f in xml_files:
+def _parse_xml_worker(fonte: Union[bytes, str, Path], engine: str, centavos: bool) -> Dict[str, Union[list, np.ndarray]]:
+    # Parse de um arquivo (também roda nas threads do pool): bytes (upload) ou caminho em disco
+    if isinstance(fonte, bytes):
+        fonte = io.BytesIO(fonte)
+    return coletar_itens_tiss_xml(fonte, engine=engine, centavos=centavos).colunas()
+
+THREAD_JOB = "tiss-job"  # prefixo das threads de FilaJobs
+
+def _pool_leitura(workers: int) -> Optional[Executor]:
+    """
+    Pool de threads para ler vários arquivos. Sem processos: o script e os jobs rodam fora da thread
+    principal, com tornado, outras sessões e a FilaJobs vivos e possivelmente segurando locks (FilaJobs._lock,
+    _PlanilhaDemo._lock, logging, import); um fork nesse momento pode travar o filho. E 'spawn' não serve,
+    porque o Streamlit executa o app como __main__, que os processos novos não conseguem importar.
+    """
+    if workers <= 1:
+        return None
+    return ThreadPoolExecutor(max_workers=workers, thread_name_prefix="tiss-leitura")
+
+def build_xml_df(xml_files, strip_zeros_codes: bool = False, engine: str = "tree", workers: int = 1,
+                 centavos: bool = False) -> pd.DataFrame:
+    t0 = time.perf_counter()
+    xml_files = list(xml_files)
+    n = len(xml_files)
+    # por arquivo: dict-de-colunas (cache ou parse) ou a exceção do parse
+    resultados: List[Union[Dict, Exception, None]] = [None] * n
+    fontes: List[Union[bytes, str, Path]] = []
+    chaves: List[Optional[str]] = []
+    for i, f in enumerate(xml_files):
         if hasattr(f, 'seek'):
             f.seek(0)
-        try:
-            if hasattr(f, 'read'):
-                bts = f.read()
-                linhas.extend(_cached_xml_bytes(bts))
-            else:
-                linhas.extend(parse_itens_tiss_xml(f))
-        except Exception as e:
-            linhas.append({'arquivo': getattr(f, 'name', 'upload.xml'), 'erro': str(e)})
-    df = pd.DataFrame(linhas)
+        fonte = f.read() if hasattr(f, 'read') else f
+        chave = _chave_cache_xml(fonte, centavos) if isinstance(fonte, bytes) else None
+        fontes.append(fonte)
+        chaves.append(chave)
+        if chave is not None:
+            resultados[i] = _cache_xml_get(chave)
+    pendentes = [i for i in range(n) if resultados[i] is None]
+    cache_hits = n - len(pendentes)
+
+    n_workers = max(1, min(workers, len(pendentes)))
+    pool = _pool_leitura(n_workers)
+    if pool is None:
+        for i in pendentes:
+            try:
+                resultados[i] = _parse_xml_worker(fontes[i], engine, centavos)
+            except Exception as e:
+                resultados[i] = e
+    else:
+        with pool:
+            futuros = {i: pool.submit(_parse_xml_worker, fontes[i], engine, centavos) for i in pendentes}
+            for i, fut in futuros.items():
+                try:
+                    resultados[i] = fut.result()
+                except Exception as e:
+                    resultados[i] = e
+    for i in pendentes:
+        if chaves[i] is not None and not isinstance(resultados[i], Exception):
+            _cache_xml_put(chaves[i], resultados[i])
+
+    # junta na ordem de upload, independente de qual worker terminou primeiro
+    coletor = ColetorItens(centavos)
+    for f, res in zip(xml_files, resultados):
+        if isinstance(res, Exception):
+            coletor.add_erro(getattr(f, 'name', 'upload.xml'), str(res))
+        else:
+            coletor.extend(res)
+    seg = max(time.perf_counter() - t0, 1e-9)
+    n_itens = coletor.n_itens
+    ingestao = {
+        'arquivos': n,
+        'itens': n_itens,
+        'workers': n_workers if pool is not None else 1,
+        'cache_hits': cache_hits,
+        'segundos': seg,
+        'arquivos_s': n / seg,
+        'itens_s': n_itens / seg,
+    }
+
+    df = pd.DataFrame(coletor.colunas()) if coletor.n_linhas else pd.DataFrame()
+    df.attrs['ingestao'] = ingestao
     if df.empty:
         return df
 
-    for c in ['quantidade', 'valor_unitario', 'valor_total']:
-        if c in df.columns:
-            df[c] = pd.to_numeric(df[c], errors='coerce').fillna(0.0)
+    if not centavos:
+        # no modo centavos as colunas já chegam int64 exatas
+        for c in ['quantidade', 'valor_unitario', 'valor_total']:
+            if c in df.columns:
+                df[c] = pd.to_numeric(df[c], errors='coerce').fillna(0.0)
     df['codigo_procedimento_norm'] = df['codigo_procedimento'].astype(str).map(
         lambda s: normalize_code(s, strip_zeros=strip_zeros_codes)
     )
@@ -542,10 +1133,11 @@ _XML_CORE_COLS = [
     'chave_oper', 'chave_prest',
 ]
 
-def _alias_xml_cols(df: pd.DataFrame, cols: List[str] = None, prefer_suffix: str = '_xml') -> pd.DataFrame:
+def _alias_xml_cols(df: pd.DataFrame, cols: List[str] = None, prefer_suffix: str = '_xml',
+                    copy: bool = True) -> pd.DataFrame:
     if cols is None:
         cols = _XML_CORE_COLS
-    out = df.copy()
+    out = df.copy() if copy else df
     for c in cols:
         if c not in out.columns:
             cand = f'{c}{prefer_suffix}'
@@ -553,68 +1145,292 @@ def _alias_xml_cols(df: pd.DataFrame, cols: List[str] = None, prefer_suffix: str
                 out[c] = out[cand]
     return out
 
+class _IndiceDemo:
+    """
+    Índice hash único sobre chave_demo: cada chave distinta vira um código e as
+    linhas do demonstrativo ficam agrupadas por código (ordem original preservada),
+    então casar N linhas do XML custa um get_indexer + um np.repeat, sem merge.
+    """
+    def __init__(self, df_demo: pd.DataFrame):
+        # o mapeamento manual não gera chave_demo (o merge antigo dava KeyError nesse caso); a chave_prest
+        # dele tem o mesmo formato (guia do prestador + código normalizado) e serve de índice
+        self.coluna = "chave_demo" if "chave_demo" in df_demo.columns else "chave_prest"
+        codigos, uniques = pd.factorize(df_demo[self.coluna])
+        self.index = pd.Index(uniques)
+        self.ordem = np.argsort(codigos, kind="stable")
+        self.contagem = np.bincount(codigos[codigos >= 0], minlength=len(uniques))
+        self.inicio = np.concatenate(([0], np.cumsum(self.contagem)[:-1])) if len(uniques) else np.array([], dtype=np.int64)
+        if (codigos < 0).any():
+            # chaves nulas nunca casam: ficam no fim da ordem e fora dos grupos
+            self.ordem = self.ordem[(codigos[self.ordem] >= 0)]
+
+    def codigos(self, chaves: pd.Series) -> np.ndarray:
+        return self.index.get_indexer(chaves)
+
+    def expandir(self, pos_xml: np.ndarray, cod: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """(linhas do XML, linhas do demonstrativo) para cada par casado, como um merge faria."""
+        rep = self.contagem[cod]
+        xml_idx = np.repeat(pos_xml, rep)
+        desloc = np.arange(rep.sum()) - np.repeat(np.cumsum(rep) - rep, rep)
+        demo_idx = self.ordem[np.repeat(self.inicio[cod], rep) + desloc]
+        return xml_idx, demo_idx
+
+def _juntar_por_posicao(df_xml: pd.DataFrame, df_demo: pd.DataFrame,
+                        xml_idx: np.ndarray, demo_idx: np.ndarray) -> pd.DataFrame:
+    # mesmo layout de colunas de df_xml.merge(df_demo, suffixes=("_xml", "_demo"))
+    comuns = set(df_xml.columns) & set(df_demo.columns)
+    esq = df_xml.take(xml_idx)
+    dir_ = df_demo.take(demo_idx)
+    esq.columns = [f"{c}_xml" if c in comuns else c for c in esq.columns]
+    dir_.columns = [f"{c}_demo" if c in comuns else c for c in dir_.columns]
+    esq.index = dir_.index = pd.RangeIndex(len(xml_idx))
+    return pd.concat([esq, dir_], axis=1)
+
+# Fallback por descrição: similaridade de tokens dentro da mesma guia
+_STOP_DESC = frozenset({"de", "da", "do", "das", "dos", "e", "em", "com", "por", "para", "a", "o"})
+_PREFIXO_DESC = 3          # chave do índice invertido (abreviações compartilham o prefixo)
+_MAX_CAND_DESC = 50        # teto de candidatos avaliados por item do XML
+
+def _tokens_desc(s: str) -> frozenset:
+    return frozenset(t for t in re.findall(r"[a-z0-9]+", _normtxt(s)) if t not in _STOP_DESC)
+
+def _sim_desc(a: frozenset, b: frozenset) -> float:
+    """Dice sobre conjuntos de tokens; 'hemogr' casa com 'hemograma' (prefixo de >= 3 letras)."""
+    if not a or not b:
+        return 0.0
+    def cobertos(x, y):
+        return sum(1 for t in x if t in y or (len(t) >= _PREFIXO_DESC and any(
+            len(u) >= _PREFIXO_DESC and (u.startswith(t) or t.startswith(u)) for u in y)))
+    return (cobertos(a, b) + cobertos(b, a)) / (len(a) + len(b))
+
+def _casar_por_descricao(sem_match: pd.DataFrame, df_demo: pd.DataFrame, livres: np.ndarray,
+                         tol: float, similaridade_min: float) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Pares (linha XML, linha demo, score) por descrição aproximada + valor dentro da tolerância.
+    Candidatos só da mesma guia e via índice invertido de prefixos (sem produto cartesiano);
+    atribuição gulosa 1:1 pelo maior score. livres: linhas do demonstrativo ainda não usadas.
+    """
+    vazio = (np.array([], dtype=np.int64), np.array([], dtype=np.int64), np.array([], dtype=np.float64))
+    guia_prest = sem_match["numeroGuiaPrestador"].fillna("").astype(str).str.strip()
+    guia_oper = sem_match["numeroGuiaOperadora"].fillna("").astype(str).str.strip()
+    guia_xml = guia_prest.where(guia_prest != "", guia_oper).to_numpy()
+    guia_demo = df_demo["numeroGuiaPrestador"].fillna("").astype(str).str.strip().to_numpy()
+    pos_demo = np.flatnonzero(livres & pd.Series(guia_demo).isin(set(guia_xml)).to_numpy()
+                              & df_demo["valor_apresentado"].notna().to_numpy())
+    if not len(pos_demo):
+        return vazio
+
+    toks = {}
+    def tokens(s):
+        t = toks.get(s)
+        if t is None:
+            t = toks[s] = _tokens_desc(s)
+        return t
+
+    desc_demo = df_demo["descricao_procedimento"].to_numpy()
+    apres = df_demo["valor_apresentado"].to_numpy()
+    indice: Dict[Tuple[str, str], List[int]] = {}
+    for p in pos_demo:
+        for t in tokens(desc_demo[p]):
+            indice.setdefault((guia_demo[p], t[:_PREFIXO_DESC]), []).append(p)
+
+    desc_xml = sem_match["descricao_procedimento"].to_numpy()
+    total = sem_match["valor_total"].to_numpy()
+    pares = []
+    for i in range(len(sem_match)):
+        tok_xml = tokens(desc_xml[i])
+        cont: Dict[int, int] = {}
+        for t in tok_xml:
+            for p in indice.get((guia_xml[i], t[:_PREFIXO_DESC]), ()):
+                cont[p] = cont.get(p, 0) + 1
+        if not cont:
+            continue
+        for p in sorted(cont, key=cont.__getitem__, reverse=True)[:_MAX_CAND_DESC]:
+            dif = abs(total[i] - apres[p])
+            if dif > tol:
+                continue
+            sc = _sim_desc(tok_xml, tokens(desc_demo[p]))
+            if sc >= similaridade_min:
+                pares.append((-sc, dif, i, p))
+    if not pares:
+        return vazio
+
+    pares.sort()
+    usados_xml, usados_demo = set(), set()
+    xi, di, sc = [], [], []
+    for neg, _, i, p in pares:
+        if i in usados_xml or p in usados_demo:
+            continue
+        usados_xml.add(i); usados_demo.add(p)
+        xi.append(i); di.append(p); sc.append(-neg)
+    ordem = np.argsort(xi, kind="stable")
+    return (np.asarray(xi, dtype=np.int64)[ordem], np.asarray(di, dtype=np.int64)[ordem],
+            np.asarray(sc, dtype=np.float64)[ordem])
+
 def conciliar_itens(
     df_xml: pd.DataFrame,
     df_demo: pd.DataFrame,
     tolerance_valor: float = 0.02,
     fallback_por_descricao: bool = False,
+    centavos: bool = False,
+    similaridade_min: float = 0.75,
 ) -> Dict[str, pd.DataFrame]:
-
-    m1 = df_xml.merge(df_demo, left_on="chave_prest", right_on="chave_demo", how="left", suffixes=("_xml", "_demo"))
-    m1 = _alias_xml_cols(m1)
-    m1["matched_on"] = m1["valor_apresentado"].notna().map({True: "prestador", False: ""})
-
-    restante = m1[m1["matched_on"] == ""].copy()
-    restante = _alias_xml_cols(restante)
+    """
+    Conciliação em uma passada: cada linha do XML é resolvida contra um único índice
+    de chave_demo, na ordem de prioridade chave_prest → chave_oper → (opcional)
+    descrição aproximada + valor. As linhas casadas saem agrupadas por origem, na ordem do XML;
+    match_score guarda a confiança (1.0 para casamento por chave).
+    nao_casados traz toda linha do XML que não casou, mesmo se outra linha com a mesma chave_prest casou
+    por descrição (a versão com merge descartava essas linhas junto).
+    centavos=True: df_xml/df_demo com valores int64 em centavos (build_xml_df / demo_em_centavos).
+    """
     cols_xml = df_xml.columns.tolist()
-    m2 = restante[cols_xml].merge(df_demo, left_on="chave_oper", right_on="chave_demo", how="left", suffixes=("_xml", "_demo"))
-    m2 = _alias_xml_cols(m2)
-    m2["matched_on"] = m2["valor_apresentado"].notna().map({True: "operadora", False: ""})
-
-    conc = pd.concat([m1[m1["matched_on"] != ""], m2[m2["matched_on"] != ""]], ignore_index=True)
-
-    fallback_matches = pd.DataFrame()
-    if fallback_por_descricao:
-        ainda_sem_match = m2[m2["matched_on"] == ""].copy()
-        ainda_sem_match = _alias_xml_cols(ainda_sem_match)
-        if not ainda_sem_match.empty:
-            ainda_sem_match["guia_join"] = ainda_sem_match.apply(
-                lambda r: str(r.get("numeroGuiaPrestador", "")).strip() or str(r.get("numeroGuiaOperadora", "")).strip(), axis=1
-            )
-            df_demo2 = df_demo.copy()
-            df_demo2["guia_join"] = df_demo2["numeroGuiaPrestador"].astype(str).str.strip()
-            if "descricao_procedimento" in ainda_sem_match.columns and "descricao_procedimento" in df_demo2.columns:
-                tmp = ainda_sem_match[cols_xml + ["guia_join"]].merge(
-                    df_demo2, on=["guia_join", "descricao_procedimento"], how="left", suffixes=("_xml", "_demo")
-                )
-                tol = float(tolerance_valor)
-                keep = (tmp["valor_apresentado"].notna() & ((tmp["valor_total"] - tmp["valor_apresentado"]).abs() <= tol))
-                fallback_matches = tmp[keep].copy()
-                if not fallback_matches.empty:
-                    fallback_matches["matched_on"] = "descricao+valor"
-                    conc = pd.concat([conc, fallback_matches], ignore_index=True)
-
-    if not fallback_matches.empty:
-        chaves_resolvidas = fallback_matches["chave_prest"].unique()
-        unmatch = m2[(m2["matched_on"] == "") & (~m2["chave_prest"].isin(chaves_resolvidas))].copy()
-    else:
-        unmatch = m2[m2["matched_on"] == ""].copy()
-    unmatch = _alias_xml_cols(unmatch)
+    idx = _IndiceDemo(df_demo)
+    cod_prest = idx.codigos(df_xml["chave_prest"])
+    cod_oper = idx.codigos(df_xml["chave_oper"])
+    hit_prest = cod_prest >= 0
+    hit_oper = ~hit_prest & (cod_oper >= 0)
+
+    partes = []
+    livres = np.ones(len(df_demo), dtype=bool)
+    for origem, hit, cod in (("prestador", hit_prest, cod_prest), ("operadora", hit_oper, cod_oper)):
+        pos = np.flatnonzero(hit)
+        xml_idx, demo_idx = idx.expandir(pos, cod[pos])
+        livres[demo_idx] = False
+        parte = _juntar_por_posicao(df_xml, df_demo, xml_idx, demo_idx)
+        parte["matched_on"] = origem
+        parte["match_score"] = 1.0
+        partes.append(parte)
+
+    sem_match = df_xml[~(hit_prest | hit_oper)]
+
+    if fallback_por_descricao and not sem_match.empty:
+        if "descricao_procedimento" in sem_match.columns and "descricao_procedimento" in df_demo.columns:
+            tol = round(float(tolerance_valor) * 100) if centavos else float(tolerance_valor)
+            xml_idx, demo_idx, score = _casar_por_descricao(sem_match[cols_xml], df_demo, livres, tol, similaridade_min)
+            if len(xml_idx):
+                parte = _juntar_por_posicao(sem_match[cols_xml], df_demo, xml_idx, demo_idx)
+                parte["matched_on"] = "descricao+valor"
+                parte["match_score"] = score
+                partes.append(parte)
+                resto = np.ones(len(sem_match), dtype=bool)
+                resto[xml_idx] = False
+                sem_match = sem_match[resto]
+
+    conc = pd.concat(partes, ignore_index=True)
+    conc = _alias_xml_cols(conc, copy=False)
+    conc["matched_on"] = conc.pop("matched_on")
+    conc["match_score"] = conc.pop("match_score")
+
+    # mesmo layout de colunas das linhas casadas, com o lado do demonstrativo vazio
+    unmatch = sem_match.merge(df_demo.iloc[:0], left_on="chave_oper", right_on=idx.coluna,
+                              how="left", suffixes=("_xml", "_demo"))
+    unmatch = _alias_xml_cols(unmatch, copy=False)
+    unmatch["matched_on"] = ""
     if not unmatch.empty:
         subset_cols = [c for c in ["arquivo", "numeroGuiaPrestador", "codigo_procedimento", "valor_total"] if c in unmatch.columns]
         if subset_cols:
             unmatch = unmatch.drop_duplicates(subset=subset_cols)
 
     if not conc.empty:
-        conc = _alias_xml_cols(conc)
+        if centavos:
+            # concat com partes vazias pode promover as colunas do demonstrativo a float
+            for c in ["valor_apresentado", "valor_glosa", "valor_pago"]:
+                if c in conc.columns:
+                    conc[c] = conc[c].astype(np.int64)
         conc["apresentado_diff"] = conc["valor_total"] - conc["valor_apresentado"]
-        conc["glosa_pct"] = conc.apply(
-            lambda r: (r["valor_glosa"] / r["valor_apresentado"]) if r.get("valor_apresentado", 0) > 0 else 0.0,
-            axis=1
-        )
+        conc["glosa_pct"] = _safe_div(conc["valor_glosa"], conc["valor_apresentado"])
 
     return {"conciliacao": conc, "nao_casados": unmatch}
 
+def _assinatura_por_guia(df: pd.DataFrame, chave: pd.Series) -> pd.Series:
+    """Hash do conteúdo de cada guia (soma dos hashes das linhas: independe da ordem)."""
+    if df.empty:
+        return pd.Series(dtype=np.uint64)
+    h = pd.util.hash_pandas_object(df, index=False)
+    return h.groupby(chave.to_numpy()).sum()
+
+def _guias_xml(df: pd.DataFrame) -> Tuple[pd.Series, pd.Series]:
+    return (df["numeroGuiaPrestador"].fillna("").astype(str).str.strip(),
+            df["numeroGuiaOperadora"].fillna("").astype(str).str.strip())
+
+class ConciliacaoIncremental:
+    """
+    Guarda conciliacao/nao_casados entre execuções e, a cada novo processamento, refaz
+    conciliar_itens só nas guias cujo conteúdo mudou (XML ou demonstrativo) — o resto é reaproveitado.
+    Uma linha do XML depende apenas das linhas do demonstrativo das suas guias (prestador/operadora),
+    então o conjunto afetado é fechado por essas duas chaves antes de reprocessar.
+    """
+    def __init__(self):
+        self.params = None
+        self.hash_xml = pd.Series(dtype=np.uint64)
+        self.hash_demo = pd.Series(dtype=np.uint64)
+        self.resultado: Optional[Dict[str, pd.DataFrame]] = None
+        self.ultimo = {}
+
+    def estado(self) -> dict:
+        """Retrato dos atributos (só pandas/dicts: vai no resultado.pkl do job). atualizar só reatribui, não altera."""
+        return dict(vars(self))
+
+    @classmethod
+    def restaurar(cls, estado: dict) -> "ConciliacaoIncremental":
+        novo = cls()
+        vars(novo).update(estado)
+        return novo
+
+    @staticmethod
+    def _alteradas(antes: pd.Series, depois: pd.Series) -> set:
+        todas = antes.index.union(depois.index)
+        a = antes.reindex(todas)
+        d = depois.reindex(todas)
+        return set(todas[~(a == d) | a.isna() | d.isna()])
+
+    def atualizar(self, df_xml: pd.DataFrame, df_demo: pd.DataFrame, **params) -> Dict[str, pd.DataFrame]:
+        prest, oper = _guias_xml(df_xml)
+        guia_demo = df_demo["numeroGuiaPrestador"].fillna("").astype(str).str.strip()
+        hash_xml = _assinatura_por_guia(df_xml, prest + "\x1f" + oper)
+        hash_demo = _assinatura_por_guia(df_demo, guia_demo)
+
+        if self.resultado is None or params != self.params:
+            afetadas = None
+        else:
+            afetadas = {g for par in self._alteradas(self.hash_xml, hash_xml) for g in par.split("\x1f")}
+            afetadas |= self._alteradas(self.hash_demo, hash_demo)
+            # fecho: uma linha tocada arrasta a outra guia dela (e as linhas dessa guia)
+            while True:
+                linhas = prest.isin(afetadas) | oper.isin(afetadas)
+                novas = (set(prest[linhas]) | set(oper[linhas])) - afetadas
+                if not novas:
+                    break
+                afetadas |= novas
+
+        if afetadas is None:
+            res = conciliar_itens(df_xml, df_demo, **params)
+            self.ultimo = {"guias_total": len(hash_xml), "guias_recalculadas": len(hash_xml), "completo": True}
+        elif not afetadas:
+            res = self.resultado
+            self.ultimo = {"guias_total": len(hash_xml), "guias_recalculadas": 0, "completo": False}
+        else:
+            sub = conciliar_itens(df_xml[prest.isin(afetadas) | oper.isin(afetadas)],
+                                  df_demo[guia_demo.isin(afetadas)], **params)
+            res = {}
+            for nome, novo in sub.items():
+                velho = self.resultado[nome]
+                if not velho.empty:
+                    vp, vo = _guias_xml(velho)
+                    velho = velho[~(vp.isin(afetadas) | vo.isin(afetadas))]
+                partes = [p for p in (velho, novo) if not p.empty]
+                res[nome] = pd.concat(partes, ignore_index=True) if partes else novo
+            if not res["conciliacao"].empty:
+                ordem = {"prestador": 0, "operadora": 1}
+                rank = res["conciliacao"]["matched_on"].map(ordem).fillna(2).to_numpy()
+                res["conciliacao"] = res["conciliacao"].iloc[np.argsort(rank, kind="stable")].reset_index(drop=True)
+            n_af = sum(1 for par in hash_xml.index if afetadas & set(par.split("\x1f")))
+            self.ultimo = {"guias_total": len(hash_xml), "guias_recalculadas": n_af, "completo": False}
+
+        self.params, self.hash_xml, self.hash_demo, self.resultado = params, hash_xml, hash_demo, res
+        return res
+
 # -----------------------------
 # Analytics
 # -----------------------------
@@ -630,9 +1446,7 @@ def kpis_por_competencia(df_conc: pd.DataFrame) -> pd.DataFrame:
            .agg(valor_apresentado=('valor_apresentado','sum'),
                 valor_pago=('valor_pago','sum'),
                 valor_glosa=('valor_glosa','sum')))
-    grp['glosa_pct'] = grp.apply(
-        lambda r: (r['valor_glosa']/r['valor_apresentado']) if r['valor_apresentado']>0 else 0, axis=1
-    )
+    grp['glosa_pct'] = _safe_div(grp['valor_glosa'], grp['valor_apresentado'])
     return grp.sort_values('competencia')
 
 def ranking_itens_glosa(df_conc: pd.DataFrame, min_apresentado: float = 0.0, topn: int = 20) -> Tuple[pd.DataFrame, pd.DataFrame]:
@@ -692,11 +1506,342 @@ def simulador_glosa(df_conc: pd.DataFrame, ajustes: Dict[str, float]) -> pd.Data
     sim['valor_glosa_sim'] = sim['valor_glosa_sim'].clip(lower=0)
     sim['valor_pago_sim'] = sim['valor_apresentado'] - sim['valor_glosa_sim']
     sim['valor_pago_sim'] = sim['valor_pago_sim'].clip(lower=0)
-    sim['glosa_pct_sim'] = sim.apply(
-        lambda r: (r['valor_glosa_sim']/r['valor_apresentado']) if r['valor_apresentado']>0 else 0, axis=1
-    )
+    sim['glosa_pct_sim'] = _safe_div(sim['valor_glosa_sim'], sim['valor_apresentado'])
     return sim
 
+# Export consolidado: xlsxwriter em constant_memory (linha a linha, direto para o arquivo) ou ZIP
+# com um CSV/Parquet por aba — bem mais rápido e sem limite de linhas do Excel.
+FORMATOS_EXPORT = {
+    "xlsx": ("tiss_conciliacao_analytics.xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    "csv": ("tiss_conciliacao_analytics_csv.zip", "application/zip"),
+    "parquet": ("tiss_conciliacao_analytics_parquet.zip", "application/zip"),
+}
+_XLSX_MAX_LINHAS = 1_048_576
+
+class LimiteExcel(ValueError):
+    """Aba com mais linhas do que uma planilha .xlsx comporta."""
+_LOTE_EXPORT = 20_000
+_TIPOS_XLSX = (str, int, float, bool, Decimal, datetime, date)
+
+def abas_conciliacao(df_xml: pd.DataFrame, conc: pd.DataFrame, unmatch: pd.DataFrame,
+                     kpi_comp: pd.DataFrame, centavos: bool) -> Iterator[Tuple[str, pd.DataFrame]]:
+    """Abas do consolidado (em reais), geradas uma a uma na ordem do arquivo."""
+    demo_cols_for_export = [c for c in [
+        'numero_lote','competencia','numeroGuiaPrestador','numeroGuiaOperadora',
+        'codigo_procedimento','descricao_procedimento',
+        'quantidade_apresentada','valor_apresentado','valor_glosa','valor_pago',
+        'motivo_glosa_codigo','motivo_glosa_descricao','Tabela'
+    ] if c in conc.columns]
+
+    yield 'Itens_XML', em_reais(df_xml, centavos)
+    if demo_cols_for_export:
+        itens_demo_match = conc[demo_cols_for_export].drop_duplicates()
+        if not itens_demo_match.empty:
+            yield 'Itens_Demo', em_reais(itens_demo_match, centavos)
+    yield 'Conciliação', em_reais(conc, centavos)
+    yield 'Nao_Casados', em_reais(unmatch, centavos)
+    yield 'Motivos_Glosa', em_reais(motivos_glosa(conc, None), centavos)
+
+    proc_x = (conc.groupby(['codigo_procedimento','descricao_procedimento'], dropna=False, as_index=False)
+              .agg(valor_apresentado=('valor_apresentado','sum'),
+                   valor_glosa=('valor_glosa','sum'),
+                   valor_pago=('valor_pago','sum'),
+                   itens=('arquivo','count')))
+    proc_x['glosa_pct'] = _safe_div(proc_x['valor_glosa'], proc_x['valor_apresentado'])
+    yield 'Procedimentos_Glosa', em_reais(proc_x, centavos)
+
+    med_x = (conc.groupby(['medico'], dropna=False, as_index=False)
+             .agg(valor_apresentado=('valor_apresentado','sum'),
+                  valor_glosa=('valor_glosa','sum'),
+                  valor_pago=('valor_pago','sum'),
+                  itens=('arquivo','count')))
+    med_x['glosa_pct'] = _safe_div(med_x['valor_glosa'], med_x['valor_apresentado'])
+    yield 'Medicos', em_reais(med_x, centavos)
+
+    if 'numero_lote' in conc.columns:
+        lot_x = (conc.groupby(['numero_lote'], dropna=False, as_index=False)
+                 .agg(valor_apresentado=('valor_apresentado','sum'),
+                      valor_glosa=('valor_glosa','sum'),
+                      valor_pago=('valor_pago','sum'),
+                      itens=('arquivo','count')))
+        lot_x['glosa_pct'] = _safe_div(lot_x['valor_glosa'], lot_x['valor_apresentado'])
+        yield 'Lotes', em_reais(lot_x, centavos)
+
+    yield 'KPIs_Competencia', em_reais(kpi_comp, centavos)
+
+def _linhas_xlsx(df: pd.DataFrame) -> Iterator[tuple]:
+    """Linhas para o xlsxwriter, convertidas em blocos: NaN/NaT → vazio, numpy → Python, o resto → texto."""
+    for ini in range(0, len(df), _LOTE_EXPORT):
+        bloco = df.iloc[ini:ini + _LOTE_EXPORT]
+        cols = []
+        for j in range(bloco.shape[1]):
+            s = bloco.iloc[:, j]
+            vals = s.astype(object).where(s.notna(), None).tolist()
+            if s.dtype == object:
+                vals = [v if v is None or isinstance(v, _TIPOS_XLSX) else str(v) for v in vals]
+            cols.append(vals)
+        yield from zip(*cols)
+
+def _escrever_xlsx(abas: Iterator[Tuple[str, pd.DataFrame]], destino: Path):
+    wb = xlsxwriter.Workbook(str(destino), {
+        "constant_memory": True,        # cada linha vai para o disco assim que a próxima começa
+        "strings_to_formulas": False,
+        "strings_to_urls": False,
+        "default_date_format": "dd/mm/yyyy",
+        "remove_timezone": True,
+    })
+    try:
+        negrito = wb.add_format({"bold": True})
+        for nome, df in abas:
+            if len(df) >= _XLSX_MAX_LINHAS:
+                raise LimiteExcel(f"A aba {nome} tem {len(df):,} linhas, acima do limite do Excel.")
+            ws = wb.add_worksheet(nome)
+            ws.write_row(0, 0, [str(c) for c in df.columns], negrito)
+            for i, linha in enumerate(_linhas_xlsx(df), start=1):
+                ws.write_row(i, 0, linha)
+    finally:
+        wb.close()
+
+def _tabela_parquet(df: pd.DataFrame) -> pa.Table:
+    try:
+        return pa.Table.from_pandas(df, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # colunas object com tipos misturados (ex.: código ora int, ora texto) viram texto
+        df = df.copy()
+        for c in df.columns[df.dtypes == object]:
+            df[c] = df[c].where(df[c].isna(), df[c].astype(str))
+        return pa.Table.from_pandas(df, preserve_index=False)
+
+def _escrever_zip(abas: Iterator[Tuple[str, pd.DataFrame]], destino: Path, formato: str):
+    # Parquet já vem comprimido: no ZIP fica só armazenado
+    compressao = zipfile.ZIP_DEFLATED if formato == "csv" else zipfile.ZIP_STORED
+    with zipfile.ZipFile(destino, "w", compression=compressao) as zf:
+        for nome, df in abas:
+            with zf.open(f"{nome}.{formato}", "w", force_zip64=True) as f:
+                if formato == "csv":
+                    with io.TextIOWrapper(f, encoding="utf-8-sig", newline="") as txt:
+                        df.to_csv(txt, index=False)
+                else:
+                    pq.write_table(_tabela_parquet(df), f)
+
+def exportar_conciliacao(df_xml: pd.DataFrame, conc: pd.DataFrame, unmatch: pd.DataFrame,
+                         kpi_comp: pd.DataFrame, centavos: bool, pasta: Path, formato: str = "xlsx") -> str:
+    """Grava o consolidado em pasta (arquivo temporário + rename atômico) e devolve o nome do arquivo."""
+    nome = FORMATOS_EXPORT[formato][0]
+    pasta.mkdir(parents=True, exist_ok=True)
+    tmp = pasta / f".{nome}.tmp"
+    abas = abas_conciliacao(df_xml, conc, unmatch, kpi_comp, centavos)
+    try:
+        if formato == "xlsx":
+            _escrever_xlsx(abas, tmp)
+        else:
+            _escrever_zip(abas, tmp, formato)
+        os.replace(tmp, pasta / nome)
+    finally:
+        tmp.unlink(missing_ok=True)
+    return nome
+
+# =========================================================
+# PARTE 4.1 — Jobs em segundo plano (conciliação)
+# =========================================================
+# O pipeline roda num pool de threads do servidor (st.cache_resource), fora da thread do script:
+# a sessão só acompanha o andamento. A tabela de jobs e os resultados ficam em disco, então uma
+# sessão que reconecta com o mesmo ?job= na URL recupera o resultado sem reprocessar.
+JOBS_DIR = Path(os.environ.get("TISS_JOBS_DIR", ".jobs"))
+JOBS_MAX = int(os.environ.get("TISS_JOBS_MAX", "20"))
+JOBS_WORKERS = int(os.environ.get("TISS_JOBS_WORKERS", "2"))
+
+ETAPAS_CONC = [
+    ("parse", "Leitura dos XML"),
+    ("demo", "Demonstrativo"),
+    ("merge", "Conciliação"),
+    ("analytics", "Analytics"),
+    ("export", "Exportação"),
+]
+JOB_FINAIS = ("concluido", "erro", "cancelado", "interrompido")
+
+class JobCancelado(Exception):
+    pass
+
+class Job:
+    """Handle entregue à função do job: marca etapas, mede o tempo de cada uma e checa cancelamento."""
+    def __init__(self, fila: "FilaJobs", job_id: str, etapas: List[Tuple[str, str]], cancelar: threading.Event):
+        self.id = job_id
+        self.pasta = JOBS_DIR / job_id
+        self._fila = fila
+        self._etapas = [e for e, _ in etapas]
+        self._cancelar = cancelar
+        self._atual: Optional[str] = None
+        self._t0 = 0.0
+        self.tempos: Dict[str, float] = {}
+
+    def _fechar_etapa(self):
+        if self._atual is not None:
+            self.tempos[self._atual] = round(time.perf_counter() - self._t0, 3)
+
+    def etapa(self, nome: str):
+        """Início de uma etapa: o cancelamento pedido é atendido aqui (entre etapas)."""
+        self._fechar_etapa()
+        if self._cancelar.is_set():
+            raise JobCancelado()
+        self._atual, self._t0 = nome, time.perf_counter()
+        self._fila._atualizar(self.id, etapa=nome, progresso=self._etapas.index(nome) / len(self._etapas),
+                              tempos=self.tempos)
+
+class FilaJobs:
+    """Pool de threads + tabela de jobs (JOBS_DIR/jobs.json, gravada de forma atômica)."""
+    def __init__(self, workers: int = JOBS_WORKERS):
+        self._pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix=THREAD_JOB)
+        self._lock = threading.Lock()
+        self._vivos: Dict[str, Tuple[Optional[Future], threading.Event]] = {}
+
+    def _tabela(self) -> Dict[str, dict]:
+        try:
+            return json.loads((JOBS_DIR / "jobs.json").read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return {}
+
+    def _gravar(self, tab: Dict[str, dict]):
+        JOBS_DIR.mkdir(parents=True, exist_ok=True)
+        tmp = JOBS_DIR / f".jobs.{os.getpid()}.{threading.get_ident()}.tmp"
+        tmp.write_text(json.dumps(tab, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp, JOBS_DIR / "jobs.json")
+
+    def _atualizar(self, job_id: str, **campos):
+        with self._lock:
+            tab = self._tabela()
+            if job_id in tab:
+                tab[job_id].update(campos, atualizado=time.time())
+                self._gravar(tab)
+
+    def submeter(self, tipo: str, fn: Callable, *args, etapas: List[Tuple[str, str]] = ETAPAS_CONC, **kwargs) -> str:
+        """Enfileira fn(job, *args, **kwargs); o dict retornado vira JOBS_DIR/<id>/resultado.pkl."""
+        # o id na URL (?job=) é a única credencial para ler o resultado: tem de ser impossível de adivinhar
+        job_id = secrets.token_urlsafe(16)
+        agora = time.time()
+        with self._lock:
+            tab = self._tabela()
+            # mantém só os JOBS_MAX mais recentes (e os ainda em andamento)
+            antigos = sorted((r for r in tab.values() if r["status"] in JOB_FINAIS), key=lambda r: r["criado"])
+            for r in antigos[:max(0, len(tab) + 1 - JOBS_MAX)]:
+                tab.pop(r["id"], None)
+                shutil.rmtree(JOBS_DIR / r["id"], ignore_errors=True)
+            tab[job_id] = dict(id=job_id, tipo=tipo, status="na fila", etapa=None, progresso=0.0,
+                               criado=agora, atualizado=agora, erro=None, tempos={})
+            self._gravar(tab)
+            cancelar = threading.Event()
+            self._vivos[job_id] = (None, cancelar)
+        fut = self._pool.submit(self._rodar, Job(self, job_id, etapas, cancelar), fn, args, kwargs)
+        with self._lock:
+            if job_id in self._vivos:
+                self._vivos[job_id] = (fut, cancelar)
+        return job_id
+
+    def _rodar(self, job: Job, fn: Callable, args: tuple, kwargs: dict):
+        try:
+            with self._lock:
+                _, cancelar = self._vivos.get(job.id, (None, threading.Event()))
+            if cancelar.is_set():
+                raise JobCancelado()
+            self._atualizar(job.id, status="executando")
+            resultado = fn(job, *args, **kwargs)
+            job._fechar_etapa()
+            job.pasta.mkdir(parents=True, exist_ok=True)
+            pd.to_pickle(resultado, job.pasta / "resultado.pkl")
+            self._atualizar(job.id, status="concluido", etapa=None, progresso=1.0, tempos=job.tempos)
+        except JobCancelado:
+            shutil.rmtree(job.pasta, ignore_errors=True)
+            self._atualizar(job.id, status="cancelado", etapa=None)
+        except Exception as e:
+            self._atualizar(job.id, status="erro", etapa=None, erro=f"{type(e).__name__}: {e}")
+        finally:
+            with self._lock:
+                self._vivos.pop(job.id, None)
+
+    def estado(self, job_id: str) -> Optional[dict]:
+        # leitura, checagem de _vivos e gravação sob o mesmo lock: _rodar grava o status final antes
+        # de sair de _vivos, então um job que acabou de concluir nunca é visto como órfão
+        with self._lock:
+            tab = self._tabela()
+            reg = tab.get(job_id)
+            if reg is not None and reg["status"] not in JOB_FINAIS and job_id not in self._vivos:
+                # em andamento na tabela, mas sem thread viva: o servidor reiniciou no meio do job
+                reg.update(status="interrompido", etapa=None, atualizado=time.time())
+                self._gravar(tab)
+        return reg
+
+    def cancelar(self, job_id: str):
+        with self._lock:
+            fut, cancelar = self._vivos.get(job_id, (None, None))
+        if cancelar is None:
+            return
+        cancelar.set()
+        if fut is not None and fut.cancel():  # ainda na fila: nem começou
+            with self._lock:
+                self._vivos.pop(job_id, None)
+            self._atualizar(job_id, status="cancelado")
+        else:
+            self._atualizar(job_id, status="cancelando")
+
+    def resultado(self, job_id: str) -> Optional[dict]:
+        if job_id not in self._tabela():  # ?job= vem da URL: só ids conhecidos viram caminho em disco
+            return None
+        p = JOBS_DIR / job_id / "resultado.pkl"
+        return pd.read_pickle(p) if p.exists() else None
+
+@st.cache_resource(show_spinner=False)
+def fila_jobs() -> FilaJobs:
+    """Uma fila por processo do servidor, compartilhada entre sessões e reruns."""
+    return FilaJobs()
+
+def job_conciliacao(job: Job, xml_files, df_demo: pd.DataFrame, params_xml: dict, params_conc: dict,
+                    estado_incremental: Optional[dict] = None, formato_export: str = "xlsx") -> dict:
+    """
+    Pipeline completo da aba de conciliação (roda na thread do job; sem chamadas st.*).
+    O modo incremental trabalha numa cópia do estado da sessão e devolve o novo em res["estado_incremental"];
+    quem troca o da sessão é o script, quando o job conclui (a sessão lê o seu a cada rerun).
+    """
+    centavos = params_conc["centavos"]
+    job.etapa("parse")
+    df_xml = build_xml_df(xml_files, centavos=centavos, **params_xml)
+    res = dict(df_xml=df_xml, conciliacao=None, centavos=centavos)
+    if df_xml.empty:
+        return res
+
+    job.etapa("demo")
+    if df_demo.empty:
+        return res
+    df_demo_conc = demo_em_centavos(df_demo) if centavos else df_demo
+
+    job.etapa("merge")
+    if estado_incremental is not None:
+        store = ConciliacaoIncremental.restaurar(estado_incremental)
+        result = store.atualizar(df_xml, df_demo_conc, **params_conc)
+        res["incremental"] = dict(store.ultimo)
+        res["estado_incremental"] = store.estado()
+    else:
+        result = conciliar_itens(df_xml=df_xml, df_demo=df_demo_conc, **params_conc)
+    conc = res["conciliacao"] = result["conciliacao"]
+    unmatch = res["nao_casados"] = result["nao_casados"]
+
+    job.etapa("analytics")
+    kpi_comp = res["kpi_comp"] = kpis_por_competencia(conc)
+    res["outliers"] = outliers_por_procedimento(conc, k=1.5)
+
+    # Falha no export não descarta a conciliação já calculada: vira aviso/erro no próprio resultado
+    job.etapa("export")
+    try:
+        res["export"] = exportar_conciliacao(df_xml, conc, unmatch, kpi_comp, centavos, job.pasta, formato_export)
+    except LimiteExcel as e:
+        try:
+            res["export"] = exportar_conciliacao(df_xml, conc, unmatch, kpi_comp, centavos, job.pasta, "csv")
+            res["export_aviso"] = f"{e} O consolidado foi gerado em ZIP (CSV)."
+        except Exception as e2:
+            res["export_erro"] = f"{type(e2).__name__}: {e2}"
+    except Exception as e:
+        res["export_erro"] = f"{type(e).__name__}: {e}"
+    return res
+
 # =========================================================
 # PARTE 5 — Auditoria de Guias (DESATIVADA)
 # =========================================================
@@ -734,10 +1879,11 @@ def auditar_guias(df_xml_itens: pd.DataFrame, prazo_retorno: int = 30) -> pd.Dat
 # =========================================================
 # PARTE 5.1 — Helpers da aba "Faturas Glosadas (XLSX)"
 # =========================================================
-def _pick_col(df: pd.DataFrame, *candidates):
-    """Retorna o primeiro nome de coluna que existir no DF dentre os candidatos."""
+def _pick_col(df: Union[pd.DataFrame, List[str]], *candidates):
+    """Retorna o primeiro nome de coluna que existir no DF (ou lista de colunas) dentre os candidatos."""
+    cols = df.columns if isinstance(df, pd.DataFrame) else df
     for cand in candidates:
-        for c in df.columns:
+        for c in cols:
             if str(c).strip().lower() == str(cand).strip().lower():
                 return c
             lc = str(c).lower()
@@ -745,25 +1891,7 @@ def _pick_col(df: pd.DataFrame, *candidates):
                 return c
     return None
 
-@st.cache_data(show_spinner=False)
-def read_glosas_xlsx(files) -> tuple[pd.DataFrame, dict]:
-    """
-    Lê 1..N arquivos .xlsx de Faturas Glosadas (AMHP ou similar),
-    concatena e retorna (df, colmap) com mapeamento de colunas.
-    Cria sempre colunas de Pagamento derivadas (_pagto_dt/_ym/_mes_br).
-    """
-    if not files:
-        return pd.DataFrame(), {}
-
-    parts = []
-    for f in files:
-        df = pd.read_excel(f, engine="openpyxl")
-        df.columns = [str(c).strip() for c in df.columns]
-        parts.append(df)
-
-    df = pd.concat(parts, ignore_index=True)
-    cols = df.columns
-
+def _colmap_glosas(cols: List[str]) -> dict:
     colmap = {
         "valor_cobrado": next((c for c in cols if "Valor Cobrado" in str(c)), None),
         "valor_glosa": next((c for c in cols if "Valor Glosa" in str(c)), None),
@@ -773,7 +1901,7 @@ def read_glosas_xlsx(files) -> tuple[pd.DataFrame, dict]:
         "motivo": next((c for c in cols if "Motivo Glosa" in str(c)), None),
         "desc_motivo": next((c for c in cols if "Descricao Glosa" in str(c) or "Descrição Glosa" in str(c)), None),
         "tipo_glosa": next((c for c in cols if "Tipo de Glosa" in str(c)), None),
-        "descricao": _pick_col(df, "descrição", "descricao", "descrição do item", "descricao do item"),
+        "descricao": _pick_col(list(cols), "descrição", "descricao", "descrição do item", "descricao do item"),
         "convenio": next((c for c in cols if "Convênio" in str(c) or "Convenio" in str(c)), None),
         "prestador": next((c for c in cols if "Nome Clínica" in str(c) or "Nome Clinica" in str(c) or "Prestador" in str(c)), None),
         "amhptiss": next((
@@ -783,15 +1911,71 @@ def read_glosas_xlsx(files) -> tuple[pd.DataFrame, dict]:
             } or "amhptiss" in str(c).strip().lower() or str(c).strip() == "Amhptiss"
         ), None),
     }
+    return colmap
+
+def _tipos_glosas(cols: List[str]) -> Dict[str, str]:
+    """Tipos aplicados já na leitura: valores numéricos e datas (realizado/pagamento)."""
+    cm = _colmap_glosas(cols)
+    tipos = {cm[k]: "num" for k in ("valor_cobrado", "valor_glosa", "valor_recursado") if cm[k]}
+    tipos.update({cm[k]: "data" for k in ("data_realizado", "data_pagamento") if cm[k]})
+    return tipos
 
-    # Números
+def _ler_glosas_worker(dados: bytes, engine: str) -> Tuple[pd.DataFrame, dict]:
+    # Um arquivo de glosas (também roda nas threads do pool), com o colmap detectado nele
+    df = ler_planilha_xlsx(io.BytesIO(dados), engine=engine, tipar=_tipos_glosas)
+    return df, _colmap_glosas(list(df.columns))
+
+def _alinhar_glosas(partes: List[Tuple[pd.DataFrame, dict]]) -> Tuple[List[pd.DataFrame], dict]:
+    """
+    Esquema canônico: para cada campo do colmap vale o rótulo do 1º arquivo que o tem; nos demais
+    a coluna detectada é renomeada para ele (ex.: 'Convenio' → 'Convênio'), então o concat não
+    cria colunas paralelas meio vazias.
+    """
+    canon: Dict[str, Optional[str]] = {}
+    for _, cm in partes:
+        for k, c in cm.items():
+            if c and not canon.get(k):
+                canon[k] = c
+    dfs = []
+    for df, cm in partes:
+        ren = {}
+        for k, c in cm.items():
+            alvo = canon.get(k)
+            if c and alvo and c != alvo and c not in ren and alvo not in df.columns:
+                ren[c] = alvo
+        dfs.append(df.rename(columns=ren) if ren else df)
+    colmap = {k: canon.get(k) for k in partes[0][1]}
+    return dfs, colmap
+
+@st.cache_data(show_spinner=False)
+def read_glosas_xlsx(files, engine: str = "auto", workers: int = 1, compactar: bool = True) -> tuple[pd.DataFrame, dict]:
+    """
+    Lê 1..N arquivos .xlsx de Faturas Glosadas (AMHP ou similar), em paralelo se workers > 1,
+    alinha as colunas num esquema canônico e retorna (df, colmap) com mapeamento de colunas.
+    Valores e datas já saem tipados da leitura (ver ler_planilha_xlsx).
+    Cria sempre colunas de Pagamento derivadas (_pagto_dt/_ym/_mes_br).
+    compactar=True: devolve o dataset já passado por compactar_glosas.
+    """
+    if not files:
+        return pd.DataFrame(), {}
+
+    dados = [_bytes_arquivo(f) for f in files]
+    pool = _pool_leitura(max(1, min(workers, len(dados))))
+    if pool is None:
+        partes = [_ler_glosas_worker(d, engine) for d in dados]
+    else:
+        with pool:
+            partes = list(pool.map(_ler_glosas_worker, dados, [engine] * len(dados)))
+    parts, colmap = _alinhar_glosas(partes)
+    df = pd.concat(parts, ignore_index=True)
+
+    # Números / datas: só converte o que a leitura não tipou (ex.: colmap diferente entre arquivos)
     for c in [colmap["valor_cobrado"], colmap["valor_glosa"], colmap["valor_recursado"]]:
-        if c and c in df.columns:
+        if c and c in df.columns and not pd.api.types.is_numeric_dtype(df[c]):
             df[c] = pd.to_numeric(df[c], errors="coerce")
-
-    # Datas
-    if colmap["data_realizado"] and colmap["data_realizado"] in df.columns:
-        df[colmap["data_realizado"]] = pd.to_datetime(df[colmap["data_realizado"]], errors="coerce")
+    c = colmap["data_realizado"]
+    if c and c in df.columns and not pd.api.types.is_datetime64_any_dtype(df[c]):
+        df[c] = pd.to_datetime(df[c], errors="coerce")
 
     # Pagamento (sempre cria derivadas)
     if colmap["data_pagamento"] and colmap["data_pagamento"] in df.columns:
@@ -813,8 +1997,92 @@ def read_glosas_xlsx(files) -> tuple[pd.DataFrame, dict]:
         df["_is_glosa"] = False
         df["_valor_glosa_abs"] = 0.0
 
+    if compactar:
+        df = compactar_glosas(df, colmap)
     return df, colmap
 
+_COLS_DERIVADAS_GLOSAS = ["_pagto_dt", "_pagto_ym", "_pagto_mes_br", "_is_glosa", "_valor_glosa_abs"]
+
+def compactar_glosas(df: pd.DataFrame, colmap: dict, max_cardinalidade: float = 0.5) -> pd.DataFrame:
+    """
+    Versão enxuta do dataset de glosas (é ela que fica no session_state de cada usuário):
+    só as colunas do colmap + derivadas, texto de baixa cardinalidade como category e
+    números no menor dtype sem perda. df.attrs['compactacao'] traz bytes antes/depois.
+    """
+    antes = int(df.memory_usage(deep=True).sum())
+    usadas = {c for c in colmap.values() if c} | set(_COLS_DERIVADAS_GLOSAS)
+    removidas = [c for c in df.columns if c not in usadas]
+    out = df.drop(columns=removidas)
+    for c in out.columns:
+        s = out[c]
+        if isinstance(s.dtype, pd.CategoricalDtype) or pd.api.types.is_bool_dtype(s):
+            continue
+        if pd.api.types.is_object_dtype(s) or pd.api.types.is_string_dtype(s):
+            if len(s) and s.nunique(dropna=True) <= max_cardinalidade * len(s):
+                try:
+                    out[c] = s.astype("category")
+                except TypeError:  # tipos misturados que não ordenam
+                    pass
+        elif pd.api.types.is_integer_dtype(s):
+            out[c] = pd.to_numeric(s, downcast="integer")
+        elif pd.api.types.is_float_dtype(s):
+            f32 = s.astype(np.float32)
+            if np.array_equal(f32.to_numpy(dtype=np.float64), s.to_numpy(dtype=np.float64), equal_nan=True):
+                out[c] = f32
+    depois = int(out.memory_usage(deep=True).sum())
+    out.attrs["compactacao"] = {"antes": antes, "depois": depois, "colunas_removidas": removidas}
+    return out
+
+def _digitos_amhptiss(serie: pd.Series) -> pd.Series:
+    # floats vindos de colunas com vazios: 61916098.0 → "61916098" (e não "619160980")
+    if pd.api.types.is_float_dtype(serie):
+        serie = serie.round().astype("Int64")
+    return serie.astype(str).str.replace(r"\D+", "", regex=True)
+
+class IndiceAmhptiss:
+    """
+    Nº AMHPTISS (só dígitos) → posições das linhas no dataset de glosas. Montado uma vez por
+    carga; cada busca custa um dict lookup por número + o tamanho do resultado. O recorte
+    atual (convênio/mês) entra como máscara booleana sobre as posições.
+    """
+    def __init__(self, serie: pd.Series):
+        codigos, uniques = pd.factorize(_digitos_amhptiss(serie).to_numpy())
+        ordem = np.argsort(codigos, kind="stable")
+        fim = np.cumsum(np.bincount(codigos[codigos >= 0], minlength=len(uniques)))
+        ordem = ordem[len(ordem) - fim[-1]:] if len(fim) else ordem[:0]
+        self._pos = {u: g for u, g in zip(uniques, np.split(ordem, fim[:-1])) if u}
+
+    def __len__(self) -> int:
+        return len(self._pos)
+
+    def buscar(self, numeros: List[str], mascara: Optional[np.ndarray] = None) -> Tuple[np.ndarray, List[str]]:
+        """Posições (na ordem dos números pedidos) e os números sem nenhuma linha."""
+        partes, faltando = [], []
+        for n in dict.fromkeys(numeros):
+            pos = self._pos.get(n)
+            if pos is not None and mascara is not None:
+                pos = pos[mascara[pos]]
+            if pos is None or not len(pos):
+                faltando.append(n)
+            else:
+                partes.append(pos)
+        return (np.concatenate(partes) if partes else np.array([], dtype=np.int64)), faltando
+
+def larguras_colunas(df: pd.DataFrame, maximo: int = 60) -> List[int]:
+    """
+    Largura de cada coluna para o Excel (cabeçalho ou maior texto, + 2, até `maximo`), calculada
+    no DataFrame antes de escrever — str.len() vetorizado sobre a coluna inteira.
+    """
+    larguras = []
+    for j, col in enumerate(df.columns):
+        s = df.iloc[:, j].dropna()
+        if pd.api.types.is_datetime64_any_dtype(s):
+            maior = len("YYYY-MM-DD HH:MM:SS") if len(s) else 0  # formato de data/hora do ExcelWriter
+        else:
+            maior = int(s.astype(str).str.len().max()) if len(s) else 0
+        larguras.append(min(max(len(str(col)), maior) + 2, maximo))
+    return larguras
+
 def build_glosas_analytics(df: pd.DataFrame, colmap: dict) -> dict:
     """
     KPIs e agrupamentos para a aba de glosas (respeita filtros aplicados previamente).
@@ -839,16 +2107,36 @@ def build_glosas_analytics(df: pd.DataFrame, colmap: dict) -> dict:
     def _agg(df_, keys):
         if df_.empty:
             return df_
-        out = (df_.groupby(keys, dropna=False, as_index=False)
+        out = (df_.groupby(keys, dropna=False, as_index=False, observed=True)
                .agg(Qtd=('_is_glosa', 'size'),
                     Valor_Glosado=('_valor_glosa_abs', 'sum')))
         return out.sort_values(["Valor_Glosado","Qtd"], ascending=False)
 
-    top_motivos = _agg(base, [cm["motivo"], cm["desc_motivo"]]) if cm.get("motivo") and cm.get("desc_motivo") else pd.DataFrame()
-    by_tipo     = _agg(base, [cm["tipo_glosa"]]) if cm.get("tipo_glosa") else pd.DataFrame()
-    top_itens   = _agg(base, [cm["descricao"]]) if cm.get("descricao") else pd.DataFrame()
-    by_convenio = _agg(base, [cm["convenio"]]) if cm.get("convenio") else pd.DataFrame()
+    partes = {nome: (_agg(base, keys) if keys else pd.DataFrame()) for nome, keys in _dimensoes_glosas(cm).items()}
+    kpis = dict(
+        linhas=total_linhas,
+        periodo_ini=periodo_ini,
+        periodo_fim=periodo_fim,
+        convenios=convenios,
+        prestadores=prestadores,
+        valor_cobrado=valor_cobrado,
+        valor_glosado=valor_glosado,
+        taxa_glosa=taxa_glosa
+    )
+    return _analytics_glosas(kpis, partes, cm)
+
+def _dimensoes_glosas(cm: dict) -> Dict[str, Optional[List[str]]]:
+    """Agrupamentos da aba (None = coluna não mapeada)."""
+    return dict(
+        top_motivos=[cm["motivo"], cm["desc_motivo"]] if cm.get("motivo") and cm.get("desc_motivo") else None,
+        by_tipo=[cm["tipo_glosa"]] if cm.get("tipo_glosa") else None,
+        top_itens=[cm["descricao"]] if cm.get("descricao") else None,
+        by_convenio=[cm["convenio"]] if cm.get("convenio") else None,
+    )
 
+def _analytics_glosas(kpis: dict, partes: Dict[str, pd.DataFrame], cm: dict) -> dict:
+    top_motivos, by_tipo = partes["top_motivos"], partes["by_tipo"]
+    top_itens, by_convenio = partes["top_itens"], partes["by_convenio"]
     if not top_motivos.empty:
         top_motivos = top_motivos.rename(columns={
             cm["motivo"]: "Motivo",
@@ -863,22 +2151,158 @@ def build_glosas_analytics(df: pd.DataFrame, colmap: dict) -> dict:
         by_convenio = by_convenio.rename(columns={cm["convenio"]:"Convênio", "Valor Glosado":"Valor Glosado (R$)"})
 
     return dict(
-        kpis=dict(
-            linhas=total_linhas,
-            periodo_ini=periodo_ini,
-            periodo_fim=periodo_fim,
-            convenios=convenios,
-            prestadores=prestadores,
-            valor_cobrado=valor_cobrado,
-            valor_glosado=valor_glosado,
-            taxa_glosa=taxa_glosa
-        ),
+        kpis=kpis,
         top_motivos=top_motivos,
         by_tipo=by_tipo,
         top_itens=top_itens,
         by_convenio=by_convenio
     )
 
+class CuboGlosas:
+    """
+    Somas e contagens parciais por (convênio, mês de pagamento), montadas uma vez por carga.
+    Trocar o filtro de convênio/mês vira um roll-up das células selecionadas — KPIs, série
+    mensal e tops (motivos, tipos, itens, convênios) — sem varrer de novo as linhas.
+    """
+    def __init__(self, df: pd.DataFrame, colmap: dict):
+        cm = self._cm = colmap
+        n = len(df)
+        conv = cm.get("convenio")
+        if conv and conv in df.columns:
+            # NaN sai antes do astype(str): no pandas<3 ele viraria a opção "nan"
+            col = df[conv]
+            txt = col.dropna().astype(str)
+            rotulos = np.full(n, None, dtype=object)
+            rotulos[col.notna().to_numpy()] = txt.to_numpy(dtype=object)
+            cod_conv, convs = pd.factorize(rotulos)
+            self.convenios = sorted(txt.unique().tolist())
+        else:
+            cod_conv, convs = np.full(n, -1), []
+            self.convenios = []
+        cod_mes, yms = pd.factorize(df["_pagto_ym"]) if "_pagto_ym" in df.columns else (np.full(n, -1), [])
+        self._cod_conv = {c: i for i, c in enumerate(convs)}
+        self._conv = cod_conv.astype(np.int32)
+        self._mes = cod_mes.astype(np.int32)
+        # mês (Period) → rótulo mm/aaaa, na ordem cronológica
+        self._yms = pd.Series(yms, dtype=object)
+        self._rotulos = pd.Series(pd.PeriodIndex(yms, freq="M").strftime("%m/%Y") if len(yms) else [], dtype=object)
+        self._cod_mes = {r: i for i, r in enumerate(self._rotulos)}
+        self.meses = [self._rotulos[i] for i in np.argsort(np.asarray(yms, dtype=object), kind="stable")] if len(yms) else []
+
+        chave = pd.DataFrame({"_conv": self._conv, "_mes": self._mes}, index=df.index)
+        m = df["_is_glosa"].fillna(False).astype(bool).to_numpy()
+        glosa_abs = df["_valor_glosa_abs"].where(m, 0.0)
+
+        cel = chave.assign(linhas=1, valor_glosado=glosa_abs.astype("float64"))
+        agg = dict(linhas=("linhas", "sum"), valor_glosado=("valor_glosado", "sum"))
+        cob = cm.get("valor_cobrado")
+        if cob in df.columns:
+            cel["valor_cobrado"] = df[cob].astype("float64")
+            agg["valor_cobrado"] = ("valor_cobrado", "sum")
+        real = cm.get("data_realizado")
+        if real in df.columns:
+            cel["real"] = df[real]
+            agg.update(periodo_ini=("real", "min"), periodo_fim=("real", "max"))
+        self._celulas = cel.groupby(["_conv", "_mes"], as_index=False).agg(**agg)
+
+        prest = cm.get("prestador")
+        self._prestadores = (chave.assign(_prest=df[prest]).dropna(subset=["_prest"]).drop_duplicates()
+                             if prest in df.columns else None)
+
+        base = df.loc[m]
+        chave_g = chave.loc[m]
+        self._dims = {}
+        for nome, keys in _dimensoes_glosas(cm).items():
+            if not keys:
+                continue
+            t = pd.concat([chave_g, base[keys]], axis=1).assign(Valor_Glosado=base["_valor_glosa_abs"].astype("float64"))
+            self._dims[nome] = (t.groupby(["_conv", "_mes"] + keys, dropna=False, as_index=False, observed=True)
+                                 .agg(Qtd=("Valor_Glosado", "size"), Valor_Glosado=("Valor_Glosado", "sum")))
+
+        # descrição → posições das linhas; o detalhe de cada top item recorta pela máscara ao abrir
+        desc = cm.get("descricao")
+        txt_desc = df[desc].astype(str).reset_index(drop=True) if desc in df.columns else pd.Series([], dtype=object)
+        self._pos_item = txt_desc.groupby(txt_desc, sort=False).indices
+
+        men = chave_g.assign(Valor_Glosado=base["_valor_glosa_abs"].astype("float64"))
+        if cob in df.columns:
+            men["Valor_Cobrado"] = base[cob].astype("float64")
+            agg_c = ("Valor_Cobrado", "sum")
+        else:
+            agg_c = ("Valor_Glosado", "size")
+        self._mensal = men.groupby(["_conv", "_mes"], as_index=False).agg(
+            Valor_Glosado=("Valor_Glosado", "sum"), Valor_Cobrado=agg_c)
+
+    def _sel(self, conv_cod: np.ndarray, mes_cod: np.ndarray, convenio: Optional[str], mes: Optional[str]) -> np.ndarray:
+        sel = np.ones(len(conv_cod), dtype=bool)
+        if convenio is not None:
+            sel &= conv_cod == self._cod_conv.get(convenio, -2)
+        if mes is not None:
+            sel &= mes_cod == self._cod_mes.get(mes, -2)
+        return sel
+
+    def _recorte(self, tab: pd.DataFrame, convenio: Optional[str], mes: Optional[str]) -> pd.DataFrame:
+        return tab[self._sel(tab["_conv"].to_numpy(), tab["_mes"].to_numpy(), convenio, mes)]
+
+    def mascara(self, convenio: Optional[str] = None, mes: Optional[str] = None) -> np.ndarray:
+        """Máscara booleana sobre as linhas do dataset (comparação por código, não por texto)."""
+        return self._sel(self._conv, self._mes, convenio, mes)
+
+    def linhas_item(self, descricao, mascara: Optional[np.ndarray] = None) -> np.ndarray:
+        """Posições das linhas com esta descrição (só as do recorte, se houver máscara)."""
+        pos = self._pos_item.get(str(descricao))
+        if pos is None:
+            return np.array([], dtype=np.int64)
+        return pos[mascara[pos]] if mascara is not None else pos
+
+    def tem_pagto(self, convenio: Optional[str] = None, mes: Optional[str] = None) -> bool:
+        return bool((self._recorte(self._celulas, convenio, mes)["_mes"] >= 0).any())
+
+    def mensal(self, convenio: Optional[str] = None, mes: Optional[str] = None) -> pd.DataFrame:
+        """Glosado/cobrado dos itens glosados por mês de pagamento (mesmo formato do groupby em linhas)."""
+        t = self._recorte(self._mensal, convenio, mes)
+        t = t[t["_mes"] >= 0].groupby("_mes").agg(Valor_Glosado=("Valor_Glosado", "sum"),
+                                                    Valor_Cobrado=("Valor_Cobrado", "sum"))
+        cods = t.index.to_numpy()
+        out = pd.DataFrame({
+            "_pagto_ym": pd.PeriodIndex(self._yms.to_numpy()[cods], freq="M") if len(cods) else pd.PeriodIndex([], freq="M"),
+            "_pagto_mes_br": self._rotulos.to_numpy()[cods] if len(cods) else [],
+            "Valor_Glosado": t["Valor_Glosado"].to_numpy(),
+            "Valor_Cobrado": t["Valor_Cobrado"].to_numpy(),
+        })
+        return out.sort_values("_pagto_ym", ignore_index=True)
+
+    def analytics(self, convenio: Optional[str] = None, mes: Optional[str] = None) -> dict:
+        """Mesmo retorno de build_glosas_analytics sobre o recorte, a partir das células."""
+        cel = self._recorte(self._celulas, convenio, mes)
+        if not self._cm or not int(cel["linhas"].sum()):
+            return {}
+        valor_cobrado = float(cel["valor_cobrado"].sum()) if "valor_cobrado" in cel.columns else 0.0
+        valor_glosado = float(cel["valor_glosado"].sum())
+        if self._prestadores is not None:
+            prestadores = int(self._recorte(self._prestadores, convenio, mes)["_prest"].nunique())
+        else:
+            prestadores = 0
+        kpis = dict(
+            linhas=int(cel["linhas"].sum()),
+            periodo_ini=cel["periodo_ini"].min() if "periodo_ini" in cel.columns else None,
+            periodo_fim=cel["periodo_fim"].max() if "periodo_fim" in cel.columns else None,
+            convenios=int(cel.loc[cel["_conv"] >= 0, "_conv"].nunique()),
+            prestadores=prestadores,
+            valor_cobrado=valor_cobrado,
+            valor_glosado=valor_glosado,
+            taxa_glosa=(valor_glosado / valor_cobrado) if valor_cobrado else 0.0,
+        )
+        partes = {}
+        for nome, keys in _dimensoes_glosas(self._cm).items():
+            t = self._recorte(self._dims[nome], convenio, mes) if keys else pd.DataFrame()
+            if not t.empty:
+                t = (t.groupby(keys, dropna=False, as_index=False, observed=True)
+                      .agg(Qtd=("Qtd", "sum"), Valor_Glosado=("Valor_Glosado", "sum"))
+                      .sort_values(["Valor_Glosado", "Qtd"], ascending=False))
+            partes[nome] = t
+        return _analytics_glosas(kpis, partes, self._cm)
+
 # =========================================================
 # PARTE 6 — Interface (Uploads, Parâmetros, Processamento, Analytics, Export)
 # =========================================================
@@ -887,20 +2311,86 @@ with st.sidebar:
     prazo_retorno = st.number_input("Prazo de retorno (dias) — (auditoria desativada)", min_value=0, value=30, step=1)
     tolerance_valor = st.number_input("Tolerância p/ fallback por descrição (R$)", min_value=0.00, value=0.02, step=0.01, format="%.2f")
     fallback_desc = st.toggle("Fallback por descrição + valor (quando código não casar)", value=False)
+    similaridade_min = st.slider(
+        "Similaridade mínima da descrição (fallback)", min_value=0.50, max_value=1.00, value=0.75, step=0.05,
+        disabled=not fallback_desc,
+        help="Tokens da descrição normalizada (sem acento/caixa; abreviações casam por prefixo), comparados só dentro da mesma guia.",
+    )
     strip_zeros_codes = st.toggle("Normalizar códigos removendo zeros à esquerda", value=True)
+    conc_incremental = st.toggle(
+        "Conciliação incremental", value=True,
+        help="Guarda o resultado entre processamentos e reconcilia só as guias afetadas por arquivos novos, alterados ou removidos.",
+    )
+    xml_engine = st.selectbox(
+        "Motor de leitura do XML", ["stream", "tree"],
+        format_func=lambda e: {"stream": "Streaming (iterparse — pouca memória)", "tree": "Árvore completa (ET.parse)"}[e],
+        help="O streaming processa guia a guia e descarta cada uma após ler seus itens; recomendado para lotes grandes.",
+    )
+    xml_workers = st.number_input(
+        "Workers para leitura (XML e planilhas de glosas)", min_value=1, max_value=max(1, os.cpu_count() or 1), value=1, step=1,
+        help="Acima de 1, os arquivos são lidos em paralelo por um pool de threads (útil com dezenas de lotes ou várias planilhas).",
+    )
+    modo_centavos = st.toggle(
+        "Valores exatos em centavos (int64)", value=False,
+        help="Lê valores do XML direto em centavos inteiros (sem Decimal/float) e concilia/agrega em inteiros; "
+             "a conversão para reais acontece só na exibição e na exportação.",
+    )
+    xlsx_engine = st.selectbox(
+        "Leitor de planilhas (.xlsx)", motores_xlsx(),
+        format_func=lambda e: {"auto": "Automático (mais rápido disponível)", "calamine": "Calamine (Rust)",
+                               "openpyxl": "openpyxl read-only (streaming)", "pandas": "pandas.read_excel"}[e],
+        help="Usado nos demonstrativos e nas Faturas Glosadas. O calamine só aparece se python-calamine estiver instalado.",
+    )
+    formato_export = st.selectbox(
+        "Formato do export da conciliação", list(FORMATOS_EXPORT),
+        format_func=lambda f: {"xlsx": "Excel (.xlsx)", "csv": "ZIP com CSV por aba (mais rápido)",
+                               "parquet": "ZIP com Parquet por aba (mais rápido e compacto)"}[f],
+        help="O Excel é gravado linha a linha direto no disco (xlsxwriter, memória constante); o ZIP não tem o limite de ~1 milhão de linhas por aba.",
+    )
 
 tab_conc, tab_glosas = st.tabs(["🔗 Conciliação TISS", "📑 Faturas Glosadas (XLSX)"])
 
 # =========================================================
 # ABA 1 — Conciliação TISS
 # =========================================================
+def resultado_job_conc(fila: FilaJobs, job_id: str) -> Optional[dict]:
+    """Resultado do job (lido do disco uma vez por sessão); o estado incremental dele passa a ser o da sessão."""
+    cache = st.session_state.get("conc_resultado")
+    if not cache or cache[0] != job_id:
+        res = fila.resultado(job_id)
+        cache = st.session_state["conc_resultado"] = (job_id, res)
+        if res is not None and res.get("estado_incremental") is not None:
+            st.session_state["conc_store"] = ConciliacaoIncremental.restaurar(res["estado_incremental"])
+    return cache[1]
+
+@st.fragment(run_every=1.0)
+def painel_job_conciliacao(job_id: str):
+    """Andamento do job (o fragmento se re-executa a cada 1s); ao terminar, recarrega a página."""
+    fila = fila_jobs()
+    job = fila.estado(job_id)
+    if job is None or job["status"] in JOB_FINAIS:
+        if job is not None and job["status"] == "concluido":
+            resultado_job_conc(fila, job_id)
+        st.rerun()
+    etapas = [e for e, _ in ETAPAS_CONC]
+    if job["etapa"] in etapas:
+        texto = f"Etapa {etapas.index(job['etapa']) + 1}/{len(etapas)} — {dict(ETAPAS_CONC)[job['etapa']]}"
+    else:
+        texto = "Na fila…"
+    st.progress(float(job["progresso"]), text=texto)
+    if job["status"] == "cancelando":
+        st.caption("Cancelamento pedido: o processamento para ao fim da etapa atual.")
+    elif st.button("⏹️ Cancelar processamento", key="btn_cancelar_conc"):
+        fila.cancelar(job_id)
+        st.rerun(scope="fragment")
+
 with tab_conc:
     st.subheader("📤 Upload de arquivos")
     xml_files = st.file_uploader("XML TISS (um ou mais):", type=['xml'], accept_multiple_files=True, key="xml_up")
     demo_files = st.file_uploader("Demonstrativos de Pagamento (.xlsx) — itemizado:", type=['xlsx'], accept_multiple_files=True, key="demo_up")
 
     # PROCESSAMENTO DO DEMONSTRATIVO (sempre) — permite wizard
-    df_demo = build_demo_df(demo_files or [], strip_zeros_codes=strip_zeros_codes)
+    df_demo = build_demo_df(demo_files or [], strip_zeros_codes=strip_zeros_codes, engine=xlsx_engine)
     if not df_demo.empty:
         st.info("Demonstrativo carregado e mapeado. A conciliação considerará **somente** os itens presentes nos XMLs. Itens presentes apenas no demonstrativo serão **ignorados**.")
     else:
@@ -908,31 +2398,81 @@ with tab_conc:
             st.info("Carregue um Demonstrativo válido ou conclua o mapeamento manual.")
 
     st.markdown("---")
-    if st.button("🚀 Processar Conciliação & Analytics", type="primary", key="btn_conc"):
-        df_xml = build_xml_df(xml_files or [], strip_zeros_codes=strip_zeros_codes)
+    fila = fila_jobs()
+    job_id = st.query_params.get("job")
+    job = fila.estado(job_id) if job_id else None
+    job_ativo = job is not None and job["status"] not in JOB_FINAIS
+    if st.button("🚀 Processar Conciliação & Analytics", type="primary", key="btn_conc", disabled=job_ativo):
+        if conc_incremental:
+            estado_incremental = st.session_state.setdefault("conc_store", ConciliacaoIncremental()).estado()
+        else:
+            st.session_state.pop("conc_store", None)
+            estado_incremental = None
+        job_id = fila.submeter(
+            "conciliacao", job_conciliacao, list(xml_files or []), df_demo,
+            params_xml=dict(strip_zeros_codes=strip_zeros_codes, engine=xml_engine, workers=int(xml_workers)),
+            params_conc=dict(
+                tolerance_valor=float(tolerance_valor),
+                fallback_por_descricao=fallback_desc,
+                centavos=modo_centavos,
+                similaridade_min=float(similaridade_min),
+            ),
+            estado_incremental=estado_incremental,
+            formato_export=formato_export,
+        )
+        # o id na URL permite retomar o acompanhamento/resultado após reconectar
+        st.query_params["job"] = job_id
+        job, job_ativo = fila.estado(job_id), True
+
+    resultado = None
+    if job_ativo:
+        painel_job_conciliacao(job_id)
+    elif job is not None:
+        if job["status"] == "concluido":
+            resultado = resultado_job_conc(fila, job_id)
+            if resultado is None:
+                st.warning("O resultado deste processamento não está mais disponível. Processe novamente.")
+            else:
+                st.caption("Etapas: " + " • ".join(
+                    f"{rotulo} {job['tempos'][e]:.2f}s" for e, rotulo in ETAPAS_CONC if e in job["tempos"]))
+        elif job["status"] == "erro":
+            st.error(f"Falha no processamento: {job['erro']}")
+        elif job["status"] == "cancelado":
+            st.info("Processamento cancelado.")
+        else:
+            st.warning("O processamento foi interrompido (o servidor reiniciou). Processe novamente.")
+
+    if resultado is not None:
+        df_xml, centavos_res = resultado["df_xml"], resultado["centavos"]
         if df_xml.empty:
             st.warning("Nenhum item extraído do(s) XML(s). Verifique os arquivos.")
-            st.stop()
-
-        st.subheader("📄 Itens extraídos dos XML (Consulta / SADT)")
-        st.dataframe(apply_currency(df_xml, ['valor_unitario','valor_total']), use_container_width=True, height=360)
-
-        if df_demo.empty:
-            st.warning("Nenhum demonstrativo válido para conciliar.")
-            st.stop()
-
-        result = conciliar_itens(
-            df_xml=df_xml,
-            df_demo=df_demo,
-            tolerance_valor=float(tolerance_valor),
-            fallback_por_descricao=fallback_desc
-        )
-        conc = result["conciliacao"]
-        unmatch = result["nao_casados"]
+        else:
+            st.subheader("📄 Itens extraídos dos XML (Consulta / SADT)")
+            st.dataframe(apply_currency(em_reais(pagina_df(df_xml, 'pag_xml'), centavos_res), ['valor_unitario','valor_total']), use_container_width=True, height=360)
+            ing = df_xml.attrs.get('ingestao')
+            if ing:
+                st.caption(
+                    f"Leitura: {ing['arquivos']} arquivo(s), {ing['itens']} itens em {ing['segundos']:.2f}s "
+                    f"• {ing['arquivos_s']:.1f} arquivos/s • {ing['itens_s']:.0f} itens/s • {ing['workers']} worker(s) "
+                    f"• {ing['cache_hits']} do cache em disco"
+                )
+            if resultado["conciliacao"] is None:
+                st.warning("Nenhum demonstrativo válido para conciliar.")
+
+    if resultado is not None and resultado["conciliacao"] is not None:
+        inc = resultado.get("incremental")
+        if inc:
+            st.caption(
+                "Conciliação completa" if inc["completo"] else
+                f"Conciliação incremental: {inc['guias_recalculadas']} de {inc['guias_total']} guia(s) recalculada(s)"
+            )
+        conc = resultado["conciliacao"]
+        unmatch = resultado["nao_casados"]
 
         st.subheader("🔗 Conciliação Item a Item (XML × Demonstrativo)")
+        # só a página visível é convertida/formatada a cada rerun
         conc_disp = apply_currency(
-            conc.copy(),
+            em_reais(pagina_df(conc, 'pag_conc'), centavos_res),
             ['valor_unitario','valor_total','valor_apresentado','valor_glosa','valor_pago','apresentado_diff']
         )
         st.dataframe(conc_disp, use_container_width=True, height=460)
@@ -943,8 +2483,8 @@ with tab_conc:
 
         if not unmatch.empty:
             st.subheader("❗ Itens (do XML) não conciliados")
-            st.dataframe(apply_currency(unmatch.copy(), ['valor_unitario','valor_total']), use_container_width=True, height=300)
-            st.download_button("Baixar Não Conciliados (CSV)", data=unmatch.to_csv(index=False).encode("utf-8"),
+            st.dataframe(apply_currency(em_reais(pagina_df(unmatch, 'pag_unmatch'), centavos_res), ['valor_unitario','valor_total']), use_container_width=True, height=300)
+            st.download_button("Baixar Não Conciliados (CSV)", data=em_reais(unmatch, centavos_res).to_csv(index=False).encode("utf-8"),
                                file_name="nao_conciliados.csv", mime="text/csv")
 
         # Analytics (conciliado)
@@ -952,23 +2492,23 @@ with tab_conc:
         st.subheader("📊 Analytics de Glosa (apenas itens conciliados)")
 
         st.markdown("### 📈 Tendência por competência")
-        kpi_comp = kpis_por_competencia(conc)
-        st.dataframe(apply_currency(kpi_comp, ['valor_apresentado','valor_pago','valor_glosa']), use_container_width=True)
+        kpi_comp = resultado["kpi_comp"]
+        st.dataframe(apply_currency(em_reais(kpi_comp, centavos_res), ['valor_apresentado','valor_pago','valor_glosa']), use_container_width=True)
         try:
-            st.line_chart(kpi_comp.set_index('competencia')[['valor_apresentado','valor_pago','valor_glosa']])
+            st.line_chart(em_reais(kpi_comp, centavos_res).set_index('competencia')[['valor_apresentado','valor_pago','valor_glosa']])
         except Exception:
             pass
 
         st.markdown("### 🏆 TOP itens glosados (valor e %)")
         min_apres = st.number_input("Corte mínimo de Apresentado para ranking por % (R$)", min_value=0.0, value=500.0, step=50.0, key="min_apres_pct")
-        top_valor, top_pct = ranking_itens_glosa(conc, min_apresentado=min_apres, topn=20)
+        top_valor, top_pct = ranking_itens_glosa(conc, min_apresentado=min_apres * 100 if centavos_res else min_apres, topn=20)
         t1, t2 = st.columns(2)
         with t1:
             st.markdown("**Por valor de glosa (TOP 20)**")
-            st.dataframe(apply_currency(top_valor, ['valor_apresentado','valor_glosa','valor_pago']), use_container_width=True)
+            st.dataframe(apply_currency(em_reais(top_valor, centavos_res), ['valor_apresentado','valor_glosa','valor_pago']), use_container_width=True)
         with t2:
             st.markdown("**Por % de glosa (TOP 20)**")
-            st.dataframe(apply_currency(top_pct, ['valor_apresentado','valor_glosa','valor_pago']), use_container_width=True)
+            st.dataframe(apply_currency(em_reais(top_pct, centavos_res), ['valor_apresentado','valor_glosa','valor_pago']), use_container_width=True)
 
         st.markdown("### 🧩 Motivos de glosa — análise")
         comp_opts = ['(todas)']
@@ -976,7 +2516,7 @@ with tab_conc:
             comp_opts += sorted(conc['competencia'].dropna().astype(str).unique().tolist())
         comp_sel = st.selectbox("Filtrar por competência", comp_opts, key="comp_mot")
         motdf = motivos_glosa(conc, None if comp_sel=='(todas)' else comp_sel)
-        st.dataframe(apply_currency(motdf, ['valor_glosa','valor_apresentado']), use_container_width=True)
+        st.dataframe(apply_currency(em_reais(motdf, centavos_res), ['valor_glosa','valor_apresentado']), use_container_width=True)
 
         st.markdown("### 👩‍⚕️ Médicos — ranking por glosa")
         if 'competencia' in conc.columns:
@@ -991,8 +2531,8 @@ with tab_conc:
                          valor_glosa=('valor_glosa','sum'),
                          valor_pago=('valor_pago','sum'),
                          itens=('arquivo','count')))
-        med_rank['glosa_pct'] = med_rank.apply(lambda r: (r['valor_glosa']/r['valor_apresentado']) if r['valor_apresentado']>0 else 0, axis=1)
-        st.dataframe(apply_currency(med_rank.sort_values(['glosa_pct','valor_glosa'], ascending=[False,False]),
+        med_rank['glosa_pct'] = _safe_div(med_rank['valor_glosa'], med_rank['valor_apresentado'])
+        st.dataframe(apply_currency(em_reais(med_rank, centavos_res).sort_values(['glosa_pct','valor_glosa'], ascending=[False,False]),
                                     ['valor_apresentado','valor_glosa','valor_pago']), use_container_width=True)
 
         st.markdown("### 🧾 Glosa por Tabela (22/19)")
@@ -1001,8 +2541,8 @@ with tab_conc:
                    .agg(valor_apresentado=('valor_apresentado','sum'),
                         valor_glosa=('valor_glosa','sum'),
                         valor_pago=('valor_pago','sum')))
-            tab['glosa_pct'] = tab.apply(lambda r: (r['valor_glosa']/r['valor_apresentado']) if r['valor_apresentado']>0 else 0, axis=1)
-            st.dataframe(apply_currency(tab, ['valor_apresentado','valor_glosa','valor_pago']), use_container_width=True)
+            tab['glosa_pct'] = _safe_div(tab['valor_glosa'], tab['valor_apresentado'])
+            st.dataframe(apply_currency(em_reais(tab, centavos_res), ['valor_apresentado','valor_glosa','valor_pago']), use_container_width=True)
         else:
             st.info("Coluna 'Tabela' não encontrada nos itens conciliados (opcional no demonstrativo).")
 
@@ -1011,14 +2551,17 @@ with tab_conc:
             match_dist = conc['matched_on'].value_counts(dropna=False).rename_axis('origem').reset_index(name='itens')
             st.bar_chart(match_dist.set_index('origem'))
             st.dataframe(match_dist, use_container_width=True)
+            fuzzy = conc.loc[conc['matched_on'] == 'descricao+valor', 'match_score']
+            if not fuzzy.empty:
+                st.caption(f"Fallback por descrição: {len(fuzzy)} itens • similaridade média {fuzzy.mean():.2f} • mínima {fuzzy.min():.2f}")
 
         st.markdown("### 🚩 Outliers em valor apresentado (por procedimento)")
-        out_df = outliers_por_procedimento(conc, k=1.5)
+        out_df = resultado["outliers"]
         if out_df.empty:
             st.info("Nenhum outlier identificado com o critério atual (IQR).")
         else:
-            st.dataframe(out_df, use_container_width=True, height=280)
-            st.download_button("Baixar Outliers (CSV)", data=out_df.to_csv(index=False).encode("utf-8"),
+            st.dataframe(em_reais(out_df, centavos_res), use_container_width=True, height=280)
+            st.download_button("Baixar Outliers (CSV)", data=em_reais(out_df, centavos_res).to_csv(index=False).encode("utf-8"),
                                file_name="outliers_valor_apresentado.csv", mime="text/csv")
 
         st.markdown("### 🧮 Simulador de faturamento (what‑if por motivo de glosa)")
@@ -1034,73 +2577,33 @@ with tab_conc:
                     ajustes[cod] = fator
             sim = simulador_glosa(conc, ajustes)
             st.write("**Resumo do cenário simulado:**")
-            res = (sim.agg(
-                total_apres=('valor_apresentado','sum'),
-                glosa=('valor_glosa','sum'),
-                glosa_sim=('valor_glosa_sim','sum'),
-                pago=('valor_pago','sum'),
-                pago_sim=('valor_pago_sim','sum')
-            ))
-            st.json({k: f_currency(v) for k, v in res.to_dict().items()})
-
-        # Export Excel consolidado
-        st.markdown("---")
-        st.subheader("📥 Exportar Excel Consolidado")
-
-        demo_cols_for_export = [c for c in [
-            'numero_lote','competencia','numeroGuiaPrestador','numeroGuiaOperadora',
-            'codigo_procedimento','descricao_procedimento',
-            'quantidade_apresentada','valor_apresentado','valor_glosa','valor_pago',
-            'motivo_glosa_codigo','motivo_glosa_descricao','Tabela'
-        ] if c in conc.columns]
-        itens_demo_match = pd.DataFrame()
-        if demo_cols_for_export:
-            itens_demo_match = conc[demo_cols_for_export].drop_duplicates().copy()
-
-        buf = io.BytesIO()
-        with pd.ExcelWriter(buf, engine='openpyxl') as wr:
-            df_xml.to_excel(wr, index=False, sheet_name='Itens_XML')
-            if not itens_demo_match.empty:
-                itens_demo_match.to_excel(wr, index=False, sheet_name='Itens_Demo')
-            conc.to_excel(wr, index=False, sheet_name='Conciliação')
-            unmatch.to_excel(wr, index=False, sheet_name='Nao_Casados')
-
-            mot_x = motivos_glosa(conc, None)
-            mot_x.to_excel(wr, index=False, sheet_name='Motivos_Glosa')
-
-            proc_x = (conc.groupby(['codigo_procedimento','descricao_procedimento'], dropna=False, as_index=False)
-                      .agg(valor_apresentado=('valor_apresentado','sum'),
-                           valor_glosa=('valor_glosa','sum'),
-                           valor_pago=('valor_pago','sum'),
-                           itens=('arquivo','count')))
-            proc_x['glosa_pct'] = proc_x.apply(lambda r: (r['valor_glosa']/r['valor_apresentado']) if r['valor_apresentado']>0 else 0, axis=1)
-            proc_x.to_excel(wr, index=False, sheet_name='Procedimentos_Glosa')
-
-            med_x = (conc.groupby(['medico'], dropna=False, as_index=False)
-                     .agg(valor_apresentado=('valor_apresentado','sum'),
-                          valor_glosa=('valor_glosa','sum'),
-                          valor_pago=('valor_pago','sum'),
-                          itens=('arquivo','count')))
-            med_x['glosa_pct'] = med_x.apply(lambda r: (r['valor_glosa']/r['valor_apresentado']) if r['valor_apresentado']>0 else 0, axis=1)
-            med_x.to_excel(wr, index=False, sheet_name='Medicos')
-
-            if 'numero_lote' in conc.columns:
-                lot_x = (conc.groupby(['numero_lote'], dropna=False, as_index=False)
-                         .agg(valor_apresentado=('valor_apresentado','sum'),
-                              valor_glosa=('valor_glosa','sum'),
-                              valor_pago=('valor_pago','sum'),
-                              itens=('arquivo','count')))
-                lot_x['glosa_pct'] = lot_x.apply(lambda r: (r['valor_glosa']/r['valor_apresentado']) if r['valor_apresentado']>0 else 0, axis=1)
-                lot_x.to_excel(wr, index=False, sheet_name='Lotes')
-
-            kpi_comp.to_excel(wr, index=False, sheet_name='KPIs_Competencia')
+            res = {
+                'total_apres': sim['valor_apresentado'].sum(),
+                'glosa': sim['valor_glosa'].sum(),
+                'glosa_sim': sim['valor_glosa_sim'].sum(),
+                'pago': sim['valor_pago'].sum(),
+                'pago_sim': sim['valor_pago_sim'].sum(),
+            }
+            st.json({k: f_currency(v / 100 if centavos_res else v) for k, v in res.items()})
 
-        st.download_button(
-            "⬇️ Baixar Excel consolidado",
-            data=buf.getvalue(),
-            file_name="tiss_conciliacao_analytics.xlsx",
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-        )
+        # Export consolidado (gravado em disco na etapa "export" do job)
+        st.markdown("---")
+        arq_export = JOBS_DIR / job_id / resultado.get("export", "")
+        st.subheader("📥 Exportar Excel Consolidado" if arq_export.suffix != ".zip" else "📥 Exportar Consolidado (ZIP)")
+        if resultado.get("export_aviso"):
+            st.warning(resultado["export_aviso"])
+        if resultado.get("export_erro"):
+            st.error(f"Falha ao gerar o arquivo consolidado: {resultado['export_erro']}")
+        elif resultado.get("export") and arq_export.exists():
+            with open(arq_export, "rb") as f:
+                st.download_button(
+                    "⬇️ Baixar Excel consolidado" if arq_export.suffix == ".xlsx" else "⬇️ Baixar consolidado (ZIP)",
+                    data=f,
+                    file_name=arq_export.name,
+                    mime=dict(FORMATOS_EXPORT.values())[arq_export.name],
+                )
+        else:
+            st.warning("O arquivo exportado deste processamento não está mais disponível. Processe novamente.")
 
 # =========================================================
 # ABA 2 — Faturas Glosadas (XLSX)
@@ -1114,6 +2617,8 @@ with tab_glosas:
         st.session_state.glosas_data = None
         st.session_state.glosas_colmap = None
         st.session_state.glosas_files_sig = None
+        st.session_state.glosas_idx_amhp = None
+        st.session_state.glosas_cubo = None
 
     glosas_files = st.file_uploader(
         "Relatórios de Faturas Glosadas (.xlsx):",
@@ -1136,6 +2641,8 @@ with tab_glosas:
     if clear_click:
         st.session_state.glosas_ready = False
         st.session_state.glosas_data = None
+        st.session_state.glosas_idx_amhp = None
+        st.session_state.glosas_cubo = None
         st.session_state.glosas_colmap = None
         st.session_state.glosas_files_sig = None
         st.rerun()
@@ -1145,9 +2652,12 @@ with tab_glosas:
             st.warning("Selecione pelo menos um arquivo .xlsx antes de processar.")
         else:
             files_sig = _files_signature(glosas_files)
-            df_g, colmap = read_glosas_xlsx(glosas_files)
+            df_g, colmap = read_glosas_xlsx(glosas_files, engine=xlsx_engine, workers=int(xml_workers))
             st.session_state.glosas_data = df_g
             st.session_state.glosas_colmap = colmap
+            amhp = colmap.get("amhptiss")
+            st.session_state.glosas_idx_amhp = IndiceAmhptiss(df_g[amhp]) if amhp in df_g.columns else None
+            st.session_state.glosas_cubo = CuboGlosas(df_g, colmap)
             st.session_state.glosas_ready = True
             st.session_state.glosas_files_sig = files_sig
             st.rerun()
@@ -1159,6 +2669,12 @@ with tab_glosas:
 
         df_g   = st.session_state.glosas_data
         colmap = st.session_state.glosas_colmap
+        comp = df_g.attrs.get("compactacao")
+        if comp and comp["antes"]:
+            st.caption(
+                f"Dataset compactado: {comp['antes'] / 2**20:.1f} MB → {comp['depois'] / 2**20:.1f} MB "
+                f"({1 - comp['depois'] / comp['antes']:.0%} a menos) • {len(comp['colunas_removidas'])} coluna(s) sem uso removida(s)"
+            )
 
         # Diagnóstico
         with st.expander("🔧 Diagnóstico (debug rápido)", expanded=False):
@@ -1174,21 +2690,19 @@ with tab_glosas:
             }
             st.write("**Flags de Pagamento criadas?**", flags)
 
-        # Filtros
-        has_pagto = ("_pagto_dt" in df_g.columns) and df_g["_pagto_dt"].notna().any()
+        # Filtros (opções, máscara e agregados saem do cubo montado na carga)
+        cubo = st.session_state.get("glosas_cubo")
+        if cubo is None:
+            cubo = st.session_state.glosas_cubo = CuboGlosas(df_g, colmap)
+        has_pagto = cubo.tem_pagto()
         if not has_pagto:
             st.warning("Coluna 'Pagamento' não encontrada ou sem dados válidos. Recursos mensais ficarão limitados.")
 
-        conv_opts = ["(todos)"]
-        if colmap.get("convenio") and colmap["convenio"] in df_g.columns:
-            conv_unique = sorted(df_g[colmap["convenio"]].dropna().astype(str).unique().tolist())
-            conv_opts += conv_unique
+        conv_opts = ["(todos)"] + cubo.convenios
         conv_sel = st.selectbox("Convênio", conv_opts, index=0, key="conv_glosas")
 
         if has_pagto:
-            meses_df = (df_g.loc[df_g["_pagto_ym"].notna(), ["_pagto_ym","_pagto_mes_br"]]
-                          .drop_duplicates().sort_values("_pagto_ym"))
-            meses_labels = meses_df["_pagto_mes_br"].tolist()
+            meses_labels = cubo.meses
             modo_periodo = st.radio("Período (por **Pagamento**):",
                                     ["Todos os meses (agrupado)", "Um mês"],
                                     horizontal=False, key="modo_periodo")
@@ -1199,12 +2713,11 @@ with tab_glosas:
             modo_periodo = "Todos os meses (agrupado)"
             mes_sel_label = None
 
-        # Aplicar filtros
-        df_view = df_g.copy()
-        if conv_sel != "(todos)" and colmap.get("convenio") and colmap["convenio"] in df_view.columns:
-            df_view = df_view[df_view[colmap["convenio"]].astype(str) == conv_sel]
-        if has_pagto and mes_sel_label:
-            df_view = df_view[df_view["_pagto_mes_br"] == mes_sel_label]
+        # Aplicar filtros (máscara sobre as posições de df_g: também recorta a busca por AMHPTISS)
+        recorte = dict(convenio=None if conv_sel == "(todos)" else conv_sel,
+                       mes=mes_sel_label if has_pagto and mes_sel_label else None)
+        mask_view = cubo.mascara(**recorte)
+        df_view = df_g[mask_view]
 
         # ==========================================
         # 🔎 Buscar por Nº AMHPTISS → por padrão, mostra apenas itens glosados
@@ -1219,11 +2732,12 @@ with tab_glosas:
         else:
             c1, c2, c3 = st.columns([0.45, 0.30, 0.25])
             with c1:
-                amhptiss_busca = st.text_input(
-                    "Informe o Nº AMHPTISS",
+                amhptiss_busca = st.text_area(
+                    "Informe o Nº AMHPTISS (vários: um por linha ou separados por vírgula/espaço)",
                     value="",
                     placeholder="Ex.: 61916098",
                     key="amhptiss_lookup",
+                    height=80,
                 )
             with c2:
                 ignorar_filtros = st.checkbox(
@@ -1245,20 +2759,27 @@ with tab_glosas:
                 return re.sub(r"\D+", "", str(s or ""))
 
             if buscar_click:
-                numero_alvo = _digits(amhptiss_busca)
-                if not numero_alvo:
+                numeros = [d for d in (_digits(t) for t in re.split(r"[\s,;]+", amhptiss_busca or "")) if d]
+                numero_alvo = numeros[0] if len(numeros) == 1 else f"{len(numeros)}_guias"
+                if not numeros:
                     st.warning("Informe um número AMHPTISS válido (somente dígitos).")
                 else:
-                    # Fonte da busca: df_g (todos os dados) ou df_view (recorte atual)?
-                    df_base_busca = df_g if ignorar_filtros else df_view
-                    df_tmp = df_base_busca.copy()
-                    df_tmp["_amhp_digits"] = df_tmp[amhp_col].astype(str).map(_digits)
+                    # Índice montado na carga; o recorte atual (df_view) entra como máscara
+                    idx_amhp = st.session_state.get("glosas_idx_amhp")
+                    if idx_amhp is None:
+                        idx_amhp = st.session_state.glosas_idx_amhp = IndiceAmhptiss(df_g[amhp_col])
+                    pos, faltando = idx_amhp.buscar(numeros, None if ignorar_filtros else mask_view)
 
-                    # Guia completa encontrada
-                    result_all = df_tmp[df_tmp["_amhp_digits"] == numero_alvo].copy()
+                    # Guia(s) completa(s) encontrada(s)
+                    result_all = df_g.iloc[pos].copy()
 
                     st.markdown("---")
-                    st.subheader(f"🧾 Itens da guia — AMHPTISS **{numero_alvo}**")
+                    if len(numeros) == 1:
+                        st.subheader(f"🧾 Itens da guia — AMHPTISS **{numero_alvo}**")
+                    else:
+                        st.subheader(f"🧾 Itens de {len(numeros)} guias AMHPTISS")
+                        if faltando:
+                            st.caption(f"Sem linhas{' no recorte atual' if not ignorar_filtros else ''}: {', '.join(faltando)}")
 
                     if result_all.empty:
                         msg_filtros = " com os filtros atuais" if not ignorar_filtros else ""
@@ -1369,21 +2890,12 @@ with tab_glosas:
 
         # Série mensal (Pagamento)
         st.markdown("### 📅 Glosa por **mês de pagamento**")
-        has_pagto = ("_pagto_dt" in df_view.columns) and df_view["_pagto_dt"].notna().any()
+        has_pagto = cubo.tem_pagto(**recorte)
         if has_pagto:
-            base_m = df_view[df_view["_is_glosa"] == True].copy()
-            if base_m.empty:
+            mensal = cubo.mensal(**recorte)
+            if mensal.empty:
                 st.info("Sem glosas no recorte atual.")
             else:
-                if (colmap.get("valor_cobrado") in base_m.columns) and (colmap["valor_cobrado"] is not None):
-                    mensal = (base_m.groupby(["_pagto_ym","_pagto_mes_br"], as_index=False)
-                                      .agg(Valor_Glosado=("_valor_glosa_abs","sum"),
-                                           Valor_Cobrado=(colmap["valor_cobrado"], "sum")))
-                else:
-                    mensal = (base_m.groupby(["_pagto_ym","_pagto_mes_br"], as_index=False)
-                                      .agg(Valor_Glosado=("_valor_glosa_abs","sum"),
-                                           Valor_Cobrado=("_valor_glosa_abs","size")))
-                mensal = mensal.sort_values("_pagto_ym")
                 st.dataframe(
                     apply_currency(mensal.rename(columns={
                         "Valor_Glosado":"Valor Glosado (R$)",
@@ -1402,7 +2914,7 @@ with tab_glosas:
             st.info("Sem 'Pagamento' válido para montar série mensal.")
 
         # ---------- Top motivos / Tipos ----------
-        analytics = build_glosas_analytics(df_view, colmap)
+        analytics = cubo.analytics(**recorte)
         st.markdown("### 🥇 Top motivos de glosa (por valor)")
         if not analytics or analytics["top_motivos"].empty:
             st.info("Não foi possível identificar colunas de motivo/descrição de glosa.")
@@ -1461,9 +2973,13 @@ with tab_glosas:
                     if pd.isna(valor_item) and "Valor_Glosado" in row.index:
                         valor_item = row["Valor_Glosado"]
 
-                    with st.expander(f"🔎 Detalhes — {item_nome}"):
-                        # Filtra as linhas deste item no recorte atual
-                        df_item = df_view[df_view[desc_col_map].astype(str) == str(item_nome)].copy()
+                    # Só monta a relação quando o expander está aberto (rerun ao abrir/fechar)
+                    detalhe = st.expander(f"🔎 Detalhes — {item_nome}", key=f"det_item_{item_nome}", on_change="rerun")
+                    if not detalhe.open:
+                        continue
+                    with detalhe:
+                        # Linhas deste item no recorte atual (índice descrição → posições do cubo)
+                        df_item = df_g.iloc[cubo.linhas_item(item_nome, mask_view)]
 
                         if df_item.empty:
                             st.info("Nenhuma linha encontrada para este item no recorte atual.")
@@ -1498,7 +3014,7 @@ with tab_glosas:
                         if show_cols:
                             st.dataframe(
                                 apply_currency(
-                                    df_item[show_cols],
+                                    pagina_df(df_item[show_cols], f"pag_item_{item_nome}"),
                                     [
                                         colmap.get("valor_cobrado") or "",
                                         colmap.get("valor_glosa") or "",
@@ -1536,83 +3052,69 @@ with tab_glosas:
         # Export análise XLSX (glosas)
         st.markdown("---")
         st.subheader("📥 Exportar análise de Faturas Glosadas (XLSX)")
-        from io import BytesIO
-        buf = BytesIO()
-        with pd.ExcelWriter(buf, engine="openpyxl") as wr:
-            k = analytics["kpis"] if analytics else dict(
-                linhas=len(df_view), periodo_ini=None, periodo_fim=None,
-                convenios=df_view[colmap["convenio"]].nunique() if colmap.get("convenio") in df_view.columns else 0,
-                prestadores=df_view[colmap["prestador"]].nunique() if colmap.get("prestador") in df_view.columns else 0,
-                valor_cobrado=float(df_view[colmap["valor_cobrado"]].sum()) if colmap.get("valor_cobrado") in df_view.columns else 0.0,
-                valor_glosado=float(df_view["_valor_glosa_abs"].sum()) if "_valor_glosa_abs" in df_view.columns else 0.0,
-                taxa_glosa=0.0
-            )
-            conv_sel = st.session_state.get("conv_glosas", "(todos)")
-            modo_periodo = st.session_state.get("modo_periodo", "Todos os meses (agrupado)")
-            mes_sel_label = st.session_state.get("mes_pagto_sel", "")
-
-            kpi_df = pd.DataFrame([{
-                "Convênio (filtro)": conv_sel,
-                "Modo Período": modo_periodo,
-                "Mês (se aplicado)": mes_sel_label or "",
-                "Registros": k.get("linhas", ""),
-                "Período Início": k.get("periodo_ini").strftime("%d/%m/%Y") if k.get("periodo_ini") else "",
-                "Período Fim": k.get("periodo_fim").strftime("%d/%m/%Y") if k.get("periodo_fim") else "",
-                "Convênios": k.get("convenios", ""),
-                "Prestadores": k.get("prestadores", ""),
-                "Valor Cobrado (R$)": round(k.get("valor_cobrado", 0.0), 2),
-                "Valor Glosado (R$)": round(k.get("valor_glosado", 0.0), 2),
-                "Taxa de Glosa (%)": round(k.get("taxa_glosa", 0.0) * 100, 2),
-            }])
-            kpi_df.to_excel(wr, index=False, sheet_name="KPIs")
-
-            has_pagto = ("_pagto_dt" in df_view.columns) and df_view["_pagto_dt"].notna().any()
-            if has_pagto:
-                base_m = df_view[df_view["_is_glosa"] == True].copy()
-                if (colmap.get("valor_cobrado") in base_m.columns) and (colmap["valor_cobrado"] is not None):
-                    mensal = (base_m.groupby(["_pagto_ym","_pagto_mes_br"], as_index=False)
-                                      .agg(Valor_Glosado=("_valor_glosa_abs","sum"),
-                                           Valor_Cobrado=(colmap["valor_cobrado"], "sum")))
-                else:
-                    mensal = (base_m.groupby(["_pagto_ym","_pagto_mes_br"], as_index=False)
-                                      .agg(Valor_Glosado=("_valor_glosa_abs","sum"),
-                                           Valor_Cobrado=("_valor_glosa_abs","size")))
-                mensal = mensal.sort_values("_pagto_ym")
-                mensal.rename(columns={"_pagto_ym":"YYYY-MM","_pagto_mes_br":"Mês/Ano"}, inplace=True)
-                mensal.to_excel(wr, index=False, sheet_name="Mensal_Pagamento")
-
-            if analytics and not analytics["top_motivos"].empty:
-                analytics["top_motivos"].to_excel(wr, index=False, sheet_name="Top_Motivos")
-            if analytics and not analytics["by_tipo"].empty:
-                analytics["by_tipo"].to_excel(wr, index=False, sheet_name="Tipo_Glosa")
-            if analytics and not analytics["top_ite    ns"].empty:
-                analytics["top_itens"].to_excel(wr, index=False, sheet_name="Top_Itens")
-            if analytics and not analytics["by_convenio"].empty:
-                analytics["by_convenio"].to_excel(wr, index=False, sheet_name="Convenios")
-
-            col_export = [c for c in [
-                colmap.get("amhptiss"),
-                colmap.get("data_pagamento"),
-                colmap.get("data_realizado"),
-                colmap.get("convenio"), colmap.get("prestador"),
-                colmap.get("descricao"), colmap.get("tipo_glosa"),
-                colmap.get("motivo"), colmap.get("desc_motivo"),
-                colmap.get("valor_cobrado"), colmap.get("valor_glosa"), colmap.get("valor_recursado")
-            ] if c and c in df_view.columns]
-            raw = df_view[col_export].copy() if col_export else pd.DataFrame()
-            if not raw.empty:
-                raw.to_excel(wr, index=False, sheet_name="Bruto_Selecionado")
-
-            for name in wr.sheets:
-                ws = wr.sheets[name]
-                ws.freeze_panes = "A2"
-                for col in ws.columns:
-                    try:
-                        col_letter = col[0].column_letter
-                    except Exception:
-                        continue
-                    max_len = max(len(str(cell.value)) if cell.value else 0 for cell in col)
-                    ws.column_dimensions[col_letter].width = min(max_len + 2, 60)
+        abas = []  # (nome, DataFrame): larguras calculadas antes de escrever
+        k = analytics["kpis"] if analytics else dict(
+            linhas=len(df_view), periodo_ini=None, periodo_fim=None,
+            convenios=df_view[colmap["convenio"]].nunique() if colmap.get("convenio") in df_view.columns else 0,
+            prestadores=df_view[colmap["prestador"]].nunique() if colmap.get("prestador") in df_view.columns else 0,
+            valor_cobrado=float(df_view[colmap["valor_cobrado"]].sum()) if colmap.get("valor_cobrado") in df_view.columns else 0.0,
+            valor_glosado=float(df_view["_valor_glosa_abs"].sum()) if "_valor_glosa_abs" in df_view.columns else 0.0,
+            taxa_glosa=0.0
+        )
+        conv_sel = st.session_state.get("conv_glosas", "(todos)")
+        modo_periodo = st.session_state.get("modo_periodo", "Todos os meses (agrupado)")
+        mes_sel_label = st.session_state.get("mes_pagto_sel", "")
+
+        kpi_df = pd.DataFrame([{
+            "Convênio (filtro)": conv_sel,
+            "Modo Período": modo_periodo,
+            "Mês (se aplicado)": mes_sel_label or "",
+            "Registros": k.get("linhas", ""),
+            "Período Início": k.get("periodo_ini").strftime("%d/%m/%Y") if k.get("periodo_ini") else "",
+            "Período Fim": k.get("periodo_fim").strftime("%d/%m/%Y") if k.get("periodo_fim") else "",
+            "Convênios": k.get("convenios", ""),
+            "Prestadores": k.get("prestadores", ""),
+            "Valor Cobrado (R$)": round(k.get("valor_cobrado", 0.0), 2),
+            "Valor Glosado (R$)": round(k.get("valor_glosado", 0.0), 2),
+            "Taxa de Glosa (%)": round(k.get("taxa_glosa", 0.0) * 100, 2),
+        }])
+        abas.append(("KPIs", kpi_df))
+
+        if cubo.tem_pagto(**recorte):
+            mensal = cubo.mensal(**recorte)
+            mensal.rename(columns={"_pagto_ym":"YYYY-MM","_pagto_mes_br":"Mês/Ano"}, inplace=True)
+            abas.append(("Mensal_Pagamento", mensal))
+
+        if analytics and not analytics["top_motivos"].empty:
+            abas.append(("Top_Motivos", analytics["top_motivos"]))
+        if analytics and not analytics["by_tipo"].empty:
+            abas.append(("Tipo_Glosa", analytics["by_tipo"]))
+        if analytics and not analytics["top_itens"].empty:
+            abas.append(("Top_Itens", analytics["top_itens"]))
+        if analytics and not analytics["by_convenio"].empty:
+            abas.append(("Convenios", analytics["by_convenio"]))
+
+        col_export = [c for c in [
+            colmap.get("amhptiss"),
+            colmap.get("data_pagamento"),
+            colmap.get("data_realizado"),
+            colmap.get("convenio"), colmap.get("prestador"),
+            colmap.get("descricao"), colmap.get("tipo_glosa"),
+            colmap.get("motivo"), colmap.get("desc_motivo"),
+            colmap.get("valor_cobrado"), colmap.get("valor_glosa"), colmap.get("valor_recursado")
+        ] if c and c in df_view.columns]
+        raw = df_view[col_export] if col_export else pd.DataFrame()
+        if not raw.empty:
+            abas.append(("Bruto_Selecionado", raw))
+
+        buf = io.BytesIO()
+        with pd.ExcelWriter(buf, engine="xlsxwriter") as wr:
+            for nome, aba in abas:
+                aba.to_excel(wr, index=False, sheet_name=nome)
+                ws = wr.sheets[nome]
+                ws.freeze_panes(1, 0)
+                for j, largura in enumerate(larguras_colunas(aba)):
+                    ws.set_column(j, j, largura)
 
         st.download_button(
             "⬇️ Baixar análise (XLSX)",
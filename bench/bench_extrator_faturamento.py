@@ -0,0 +1,87 @@
+"""
+Benchmark: extração das linhas de faturamento dos relatórios AMHP (funciona.py).
+
+Compara a regex antiga (DOTALL + salto preguiçoso sobre o texto inteiro) com o extrator
+linha a linha (extrair_linhas_faturamento) em relatórios sintéticos de várias páginas:
+- "limpo": só cabeçalho sem data e itens; os dois extratores têm de devolver o mesmo;
+- "com ruído": cabeçalho datado em cada página e páginas finais de histórico com datas
+  sem item (carimbos, OCR sujo), onde a regex antiga degrada e troca datas entre linhas.
+
+Uso:  python bench/bench_extrator_faturamento.py [páginas]   (padrão: 200)
+"""
+import logging
+import random
+import re
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+logging.getLogger("streamlit").setLevel(logging.ERROR)
+from funciona import extrair_linhas_faturamento  # noqa: E402
+
+ITENS = ["CONSULTA EM CONSULTORIO", "HEMOGRAMA COMPLETO", "RX TORAX PA E PERFIL",
+         "ULTRASSONOGRAFIA ABDOMEN TOTAL", "SESSAO DE FISIOTERAPIA MOTORA"]
+
+_PADRAO_ANTIGO = re.compile(
+    r"(\d{2}/\d{2}/\d{4}).*?(\d[\d\.\-]{5,15})\s+(.*?)\s+(\d+)\s+([\d,.]+)\s+([\d,.]+)", re.DOTALL)
+
+
+def _antigo(texto: str) -> list:
+    texto_limpo = re.sub(r"[ \t]+", " ", texto)
+    return [
+        {"Data": m[0], "Código": m[1], "Descrição": m[2].replace("\n", " ").strip(),
+         "Qtd": m[3], "Valor Unit": m[4], "Valor Total": m[5]}
+        for m in _PADRAO_ANTIGO.findall(texto_limpo)
+    ]
+
+
+def _data(r: random.Random) -> str:
+    return f"{r.randint(1, 28):02d}/{r.randint(1, 12):02d}/2024"
+
+
+def _relatorio(paginas: int, ruido: bool, seed: int = 0) -> str:
+    r = random.Random(seed)
+    linhas = []
+    for p in range(1, paginas + 1):
+        linhas.append("AMHP - RELATORIO DE ATENDIMENTO" + (f" Emitido em {_data(r)} 10:22" if ruido else ""))
+        linhas.append("Data Codigo Descricao Qtd Unit Total")
+        for _ in range(25):
+            qtd = r.randint(1, 4)
+            unit = r.randint(1000, 90000)
+            desc = r.choice(ITENS)
+            item = f"{_data(r)} {r.randint(10000000, 49999999)} {desc} {qtd} {unit / 100:.2f} {qtd * unit / 100:.2f}".replace(".", ",")
+            if r.random() < 0.1:  # descrição quebrada em duas linhas pelo PDF
+                corte = item.index(desc) + len(desc.split()[0])
+                linhas += [item[:corte], item[corte + 1:]]
+            else:
+                linhas.append(item)
+        linhas.append(f"Pagina {p} de {paginas}")
+    if ruido:
+        for _ in range(max(1, paginas // 10)):
+            linhas.append("HISTORICO DE OCORRENCIAS")
+            linhas += [f"{_data(r)} Guia conferida pelo auditor, pendente de assinatura" for _ in range(40)]
+    return "\n".join(linhas)
+
+
+def _medir(fn, texto: str):
+    t0 = time.perf_counter()
+    res = fn(texto)
+    return res, time.perf_counter() - t0
+
+
+def main(paginas: int) -> None:
+    for nome, ruido in (("limpo", False), ("com ruído", True)):
+        for n in sorted({max(1, paginas // 4), paginas}):
+            texto = _relatorio(n, ruido)
+            antigo, t_antigo = _medir(_antigo, texto)
+            novo, t_novo = _medir(extrair_linhas_faturamento, texto)
+            if not ruido:
+                assert antigo == novo, "extratores divergem no relatório limpo"
+            print(f"{nome:>10} {n:>5} págs ({len(texto) / 1e6:5.2f} MB): "
+                  f"regex {t_antigo:7.3f}s ({len(antigo):,} itens)   "
+                  f"linhas {t_novo:7.3f}s ({len(novo):,} itens)   {t_antigo / max(t_novo, 1e-9):6.1f}x")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
@@ -0,0 +1,50 @@
+"""
+Benchmark: glosa_pct por apply(axis=1) x _safe_div vetorizado.
+
+Uso:  python bench/bench_glosa_pct.py [linhas]   (padrão: 1_000_000)
+"""
+import logging
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+logging.getLogger("streamlit").setLevel(logging.ERROR)
+from app import _safe_div  # noqa: E402
+
+
+def _base(n: int, seed: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    apres = np.round(rng.uniform(0, 5000, n), 2)
+    apres[rng.random(n) < 0.05] = 0.0          # denominador zero
+    apres[rng.random(n) < 0.01] = np.nan       # sem valor no demonstrativo
+    glosa = np.round(apres * rng.uniform(0, 1, n), 2)
+    return pd.DataFrame({"valor_apresentado": apres, "valor_glosa": glosa})
+
+
+def _apply_antigo(df: pd.DataFrame) -> pd.Series:
+    return df.apply(lambda r: (r['valor_glosa']/r['valor_apresentado']) if r['valor_apresentado'] > 0 else 0, axis=1)
+
+
+def main(n: int) -> None:
+    df = _base(n)
+
+    t0 = time.perf_counter()
+    antigo = _apply_antigo(df)
+    t_apply = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    novo = _safe_div(df["valor_glosa"], df["valor_apresentado"])
+    t_vet = time.perf_counter() - t0
+
+    np.testing.assert_array_equal(antigo.to_numpy(dtype=np.float64), novo)
+    print(f"linhas: {n:,}")
+    print(f"apply(axis=1): {t_apply:8.3f}s")
+    print(f"_safe_div:     {t_vet:8.3f}s  ({t_apply / max(t_vet, 1e-9):,.0f}x)")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000)
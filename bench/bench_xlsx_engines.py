@@ -0,0 +1,71 @@
+"""
+Benchmark: leitura de Faturas Glosadas (.xlsx) por motor de planilha.
+
+Gera uma planilha sintética no layout da AMHP e mede read_glosas_xlsx com cada
+motor disponível (motores_xlsx), conferindo que todos devolvem os mesmos dados.
+
+Uso:  python bench/bench_xlsx_engines.py [linhas]   (padrão: 200_000)
+"""
+import io
+import logging
+import random
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+
+import pandas as pd
+import xlsxwriter
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+logging.getLogger("streamlit").setLevel(logging.ERROR)
+import app  # noqa: E402
+
+CABECALHO = ["Amhptiss", "Convênio", "Nome Clínica", "Realizado", "Pagamento", "Descrição",
+             "Motivo Glosa", "Descricao Glosa", "Tipo de Glosa", "Valor Cobrado", "Valor Glosa", "Valor Recursado"]
+
+
+def _planilha(n: int, seed: int = 0) -> bytes:
+    r = random.Random(seed)
+    buf = io.BytesIO()
+    wb = xlsxwriter.Workbook(buf, {"constant_memory": True})
+    ws = wb.add_worksheet()
+    fmt_data = wb.add_format({"num_format": "dd/mm/yyyy"})
+    ws.write_row(0, 0, CABECALHO)
+    for i in range(1, n + 1):
+        vc = round(r.uniform(10, 500), 2)
+        ws.write_row(i, 0, [str(61900000 + r.randint(0, 50000)), r.choice(["CASSI", "GEAP", "AMIL"]),
+                            r.choice(["Clinica A", "Clinica B"])])
+        ws.write_datetime(i, 3, datetime(2024, r.randint(1, 6), r.randint(1, 28)), fmt_data)
+        ws.write_datetime(i, 4, datetime(2024, r.randint(2, 8), 10), fmt_data)
+        ws.write_row(i, 5, [r.choice(["CONSULTA", "HEMOGRAMA COMPLETO", "RX TORAX"]), r.choice(["1801", "2001"]),
+                            r.choice(["Valor cobrado a maior", "Auditoria"]), r.choice(["Total", "Parcial"]),
+                            vc, -round(vc * r.choice([0, 0, .5, 1]), 2), 0])
+    wb.close()
+    return buf.getvalue()
+
+
+class _Arquivo(io.BytesIO):
+    name = "glosas_bench.xlsx"
+
+
+def main(n: int) -> None:
+    dados = _planilha(n)
+    print(f"linhas: {n:,}  ({len(dados) / 1e6:.1f} MB)")
+    ler = app.read_glosas_xlsx.__wrapped__ if hasattr(app.read_glosas_xlsx, "__wrapped__") else app.read_glosas_xlsx
+    ref = None
+    for engine in app.motores_xlsx():
+        if engine == "auto":
+            continue
+        t0 = time.perf_counter()
+        df, _ = ler([_Arquivo(dados)], engine=engine)
+        dt = time.perf_counter() - t0
+        if ref is None:
+            ref = df
+        else:
+            pd.testing.assert_frame_equal(ref, df, check_dtype=False)
+        print(f"{engine:>9}: {dt:8.2f}s  {n / dt:>10,.0f} linhas/s")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200_000)
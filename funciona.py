@@ -6,6 +6,14 @@ import re
 import io
 import os
 import shutil
+import queue
+import hashlib
+import tempfile
+from contextlib import contextmanager
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import NamedTuple
 import pdfplumber
 from selenium import webdriver
 from selenium.webdriver.chrome.options import Options
@@ -14,17 +22,38 @@ from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait, Select
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.common.keys import Keys
+from selenium.common.exceptions import NoSuchFrameException, StaleElementReferenceException, TimeoutException
 from pytesseract import image_to_string
-from pdf2image import convert_from_path
+from pdf2image import convert_from_path, pdfinfo_from_path
 
 # === CONFIGURAÇÃO DO AMBIENTE ===
 
-def configurar_driver():
-    download_dir = os.path.join(os.getcwd(), "temp_pdfs")
-    # Limpeza preventiva para teste limpo
-    if os.path.exists(download_dir):
-        shutil.rmtree(download_dir)
-    os.makedirs(download_dir)
+class UrlsAMHP(NamedTuple):
+    """Endereços do portal (podem apontar para um mock local das páginas nos testes)."""
+    portal: str = "https://portal.amhp.com.br/"
+    atendimentos: str = "https://amhptiss.amhp.com.br/AtendimentosRealizados.aspx"
+
+URLS_AMHP = UrlsAMHP()
+DOWNLOAD_BASE = os.path.join(os.getcwd(), "temp_pdfs")
+DOWNLOAD_VALIDADE_H = 6  # pastas de sessões mais antigas que isso são apagadas
+DOWNLOAD_TIMEOUT = 60    # segundos até desistir de um PDF exportado
+
+def nova_pasta_download():
+    """Pasta de download exclusiva por sessão de navegador (sessões em paralelo não se misturam)."""
+    os.makedirs(DOWNLOAD_BASE, exist_ok=True)
+    limite = time.time() - DOWNLOAD_VALIDADE_H * 3600
+    for e in os.scandir(DOWNLOAD_BASE):
+        try:
+            if e.is_dir() and e.stat().st_mtime < limite:
+                shutil.rmtree(e.path, ignore_errors=True)
+        except OSError:
+            continue
+    return tempfile.mkdtemp(prefix="sessao_", dir=DOWNLOAD_BASE)
+
+def configurar_driver(download_dir=None):
+    if download_dir is None:
+        download_dir = nova_pasta_download()
+    os.makedirs(download_dir, exist_ok=True)
 
     opts = Options()
     opts.add_argument("--headless=new")
@@ -51,6 +80,50 @@ def configurar_driver():
         driver = webdriver.Chrome(service=service, options=opts)
     return driver, download_dir
 
+# === ESPERAS (CONDIÇÕES EXPLÍCITAS NO LUGAR DE time.sleep) ===
+
+EXT_PARCIAIS = (".crdownload", ".part", ".tmp")
+
+def arquivos_na_pasta(pasta):
+    """{nome: tamanho} dos arquivos na raiz da pasta (subpastas ficam de fora)."""
+    with os.scandir(pasta) as it:
+        return {e.name: e.stat().st_size for e in it if e.is_file()}
+
+def aguardar_download(pasta, ja_existentes, timeout=DOWNLOAD_TIMEOUT, intervalo=0.25, estavel=0.5):
+    """
+    Espera o Chrome terminar de gravar um arquivo novo na pasta: nada de .crdownload pendente
+    e tamanho parado por `estavel` segundos. Devolve o nome; TimeoutError se não vier.
+    """
+    limite = time.monotonic() + timeout
+    vistos = {}  # nome -> (tamanho, desde quando está com esse tamanho)
+    while time.monotonic() < limite:
+        agora = time.monotonic()
+        atuais = arquivos_na_pasta(pasta)
+        if not any(n.endswith(EXT_PARCIAIS) for n in atuais):
+            for nome, tam in atuais.items():
+                if nome in ja_existentes or tam == 0:
+                    continue
+                anterior = vistos.get(nome)
+                if anterior and anterior[0] == tam:
+                    if agora - anterior[1] >= estavel:
+                        return nome
+                else:
+                    vistos[nome] = (tam, agora)
+        time.sleep(intervalo)
+    raise TimeoutError(f"Nenhum download concluído em {timeout}s")
+
+def pagina_carregada(driver):
+    return driver.execute_script("return document.readyState") == "complete"
+
+@contextmanager
+def cronometrar(tempos, etapa):
+    """Soma em tempos[etapa] os segundos gastos no bloco (mesmo se ele falhar)."""
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        tempos[etapa] = tempos.get(etapa, 0.0) + time.perf_counter() - t0
+
 # === NAVEGAÇÃO ENTRE FRAMES (SUA LÓGICA ORIGINAL) ===
 
 def entrar_no_frame_do_elemento(driver, element_id):
@@ -72,177 +145,565 @@ def entrar_no_frame_do_elemento(driver, element_id):
 
 # === MOTOR DE EXTRAÇÃO (INTELIGÊNCIA GABMA) ===
 
-def extrair_texto_pdf(caminho_pdf):
-    texto_full = ""
+OCR_MIN_CARACTERES = 50  # página com menos texto nativo que isso pode ser digitalização
+OCR_AREA_IMAGEM = 0.5    # ... e é, se uma imagem cobre ao menos essa fração da página
+OCR_DPI = 200
+OCR_WORKERS = int(os.environ.get("TISS_OCR_WORKERS", "2"))  # = máximo de páginas rasterizadas em memória
+# Várias páginas em paralelo: cada tesseract fica com 1 thread em vez de disputar todos os núcleos
+os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
+_pool_ocr = None
+_pool_ocr_lock = threading.Lock()
+
+def pool_ocr():
+    """
+    Pool de OCR único, criado na primeira página que precisar. Sem st.cache_resource: quem chama são
+    também as threads do lote (consultar_guias_em_lote), que não têm ScriptRunContext.
+    """
+    global _pool_ocr
+    with _pool_ocr_lock:
+        if _pool_ocr is None:
+            _pool_ocr = ThreadPoolExecutor(max_workers=max(1, OCR_WORKERS), thread_name_prefix="ocr")
+        return _pool_ocr
+
+def ocr_pagina(caminho_pdf, n_pagina):
+    """Rasteriza só a página n_pagina (1-based) e passa no tesseract; a imagem morre aqui."""
+    imgs = convert_from_path(caminho_pdf, dpi=OCR_DPI, first_page=n_pagina, last_page=n_pagina)
+    return image_to_string(imgs[0], lang='por') if imgs else ""
+
+def precisa_ocr(page, texto):
+    """Página sem texto, ou com pouco texto sobre uma imagem grande (digitalização com carimbo/cabeçalho)."""
+    if not texto.strip():
+        return True
+    if len(texto.strip()) >= OCR_MIN_CARACTERES:
+        return False
+    # pouco texto numa página de texto (totais, rodapé) fica com a camada nativa, que é exata
+    area = float(page.width * page.height) or 1.0
+    return any((im["x1"] - im["x0"]) * (im["bottom"] - im["top"]) >= OCR_AREA_IMAGEM * area for im in page.images)
+
+def extrair_texto_pdf_com_ocr(caminho_pdf):
+    """Texto do PDF + se alguma página precisou de OCR + mensagens de erro (quem chama decide como mostrar)."""
+    textos, sem_texto, erros = [], [], []
     try:
         with pdfplumber.open(caminho_pdf) as pdf:
-            for page in pdf.pages:
-                t = page.extract_text()
-                if t: texto_full += t + "\n"
+            for i, page in enumerate(pdf.pages):
+                textos.append(page.extract_text() or "")
+                if precisa_ocr(page, textos[i]):
+                    sem_texto.append(i)
     except Exception as e:
-        st.error(f"Erro ao ler PDF nativo: {e}")
-    
-    # Se o texto for nulo ou imagem (comum no AMHP), usa OCR
-    if len(texto_full.strip()) < 50:
+        erros.append(f"Erro ao ler PDF nativo: {e}")
         try:
-            paginas_img = convert_from_path(caminho_pdf, dpi=200)
-            for img in paginas_img:
-                texto_full += image_to_string(img, lang='por') + "\n"
-        except Exception as e:
-            st.error(f"Erro no OCR (verifique packages.txt): {e}")
+            textos = [""] * pdfinfo_from_path(caminho_pdf)["Pages"]
+        except Exception:
+            textos = [""]
+        sem_texto = list(range(len(textos)))
+    
+    # Só as páginas sem camada de texto (comum no AMHP) vão para o OCR, em paralelo no pool único
+    # do processo: cada tarefa rasteriza a própria página, então há no máximo OCR_WORKERS imagens em
+    # memória, mesmo com várias sessões do lote extraindo ao mesmo tempo.
+    # pytesseract roda o tesseract como processo externo, por isso threads já paralelizam o OCR.
+    if sem_texto:
+        pool = pool_ocr()
+        futuros = {i: pool.submit(ocr_pagina, caminho_pdf, i + 1) for i in sem_texto}
+        for i, futuro in futuros.items():
+            try:
+                ocr = futuro.result()
+            except Exception as e:
+                erros.append(f"Erro no OCR da página {i + 1} (verifique packages.txt): {e}")
+                continue
+            if ocr.strip():  # OCR vazio não apaga o pouco texto nativo da página
+                textos[i] = ocr
     
-    return texto_full
+    return "".join(t + "\n" for t in textos if t), bool(sem_texto), erros
+
+def extrair_texto_pdf(caminho_pdf):
+    texto, _, erros = extrair_texto_pdf_com_ocr(caminho_pdf)
+    for erro in erros:
+        st.error(erro)
+    return texto
+
+# Extração linha a linha: cada linha vira tokens uma vez e as colunas são reconhecidas por padrões
+# ancorados no token. Substitui a regex com DOTALL e salto preguiçoso (.*?) entre data e código, que
+# a cada data sem item depois varria o resto do documento (quadrático em OCR longo) e casava a data
+# de uma linha com o código/valores de outra. Linha de item quebrada no PDF/OCR é completada com as
+# seguintes, até FATURAMENTO_JANELA linhas.
+FATURAMENTO_JANELA = 3
+_RE_DATA = re.compile(r"\d{2}/\d{2}/\d{4}")
+_RE_CODIGO = re.compile(r"(?:^|\D)(\d[\d.\-]{5,15})$")  # Código TUSS (pode vir colado a um rótulo)
+_RE_QTD = re.compile(r"\d+")
+_RE_VALOR = re.compile(r"[\d,.]+")
+
+def _item_faturamento(tokens, ini):
+    """
+    Primeiro item em tokens[ini:]: data, depois código, depois descrição (>= 1 token) seguida de
+    Qtd, Unit e Total. Devolve (registro, posição após o Total) ou None.
+    Basta testar a primeira data e o primeiro código depois dela: se não há Qtd/Unit/Total após
+    esse código, também não há após os seguintes — cada token é visitado um número fixo de vezes.
+    """
+    n = len(tokens)
+    i = next((k for k in range(ini, n) if _RE_DATA.search(tokens[k])), None)
+    if i is None:
+        return None
+    c = next((k for k in range(i + 1, n) if _RE_CODIGO.search(tokens[k])), None)
+    if c is None:
+        return None
+    # Com linhas emendadas, vale a data mais próxima do código (a da própria linha do item)
+    i = max(k for k in range(i, c) if _RE_DATA.search(tokens[k]))
+    for j in range(c + 2, n - 2):
+        if _RE_QTD.fullmatch(tokens[j]) and _RE_VALOR.fullmatch(tokens[j + 1]):
+            total = _RE_VALOR.match(tokens[j + 2])
+            if total:
+                return {
+                    "Data": _RE_DATA.search(tokens[i]).group(),
+                    "Código": _RE_CODIGO.search(tokens[c]).group(1),
+                    "Descrição": " ".join(tokens[c + 1:j]),
+                    "Qtd": tokens[j],
+                    "Valor Unit": tokens[j + 1],
+                    "Valor Total": total.group(),
+                }, j + 3
+    return None
+
+def extrair_linhas_faturamento(texto):
+    """Linhas de faturamento (Data, Código, Descrição, Qtd, Valor Unit, Valor Total) do texto de um relatório."""
+    brutas = texto.splitlines()
+    linhas = [None] * len(brutas)  # tokens, gerados só para linhas que chegam a ser examinadas
+    def tokens_da(k):
+        if linhas[k] is None:
+            linhas[k] = brutas[k].split()
+        return linhas[k]
+    registros = []
+    i = 0
+    while i < len(brutas):
+        if not _RE_DATA.search(brutas[i]):  # item sempre começa numa linha com data
+            i += 1
+            continue
+        tokens, usadas, consumidas, pos = tokens_da(i), 1, 1, 0
+        while True:
+            achado = _item_faturamento(tokens, pos)
+            if achado is None:
+                # Data sem item fechado: pode ser descrição quebrada, tenta com a próxima linha
+                if (usadas < FATURAMENTO_JANELA and i + usadas < len(brutas)
+                        and any(_RE_DATA.search(t) for t in tokens[pos:])):
+                    tokens = tokens + tokens_da(i + usadas)
+                    usadas += 1
+                    continue
+                break
+            registro, pos = achado
+            registros.append(registro)
+            consumidas = usadas
+        i += consumidas
+    return registros
+
+# === CACHE DE PDFs (POR CONTEÚDO) ===
+# Um JSON por (conteúdo do PDF, versão da extração): texto, se usou OCR e linhas já extraídas.
+# Relatório que não mudou não passa de novo por pdfplumber/OCR/regex. LRU por mtime.
+PDF_CACHE_VERSION = "2"  # subir ao mudar extração de texto, OCR ou extrair_linhas_faturamento
+PDF_CACHE_DIR = Path(os.environ.get("TISS_PDF_CACHE_DIR", ".cache_pdfs"))
+PDF_CACHE_MAX_BYTES = int(float(os.environ.get("TISS_PDF_CACHE_MAX_MB", "256")) * 1024 * 1024)
+
+def chave_cache_pdf(caminho_pdf):
+    h = hashlib.sha256(f"amhp-pdf:{PDF_CACHE_VERSION}:{OCR_DPI}:".encode())
+    with open(caminho_pdf, "rb") as f:
+        for bloco in iter(lambda: f.read(1 << 20), b""):
+            h.update(bloco)
+    return h.hexdigest()
+
+def _cache_pdf_get(chave):
+    p = PDF_CACHE_DIR / f"{chave}.json"
+    try:
+        with open(p, encoding="utf-8") as f:
+            entrada = json.load(f)
+        os.utime(p)  # LRU: mtime = último acesso
+        return entrada
+    except (OSError, ValueError):
+        return None
+
+def _cache_pdf_put(chave, entrada):
+    # best-effort: falha de disco não pode derrubar a extração
+    try:
+        PDF_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        tmp = PDF_CACHE_DIR / f".{chave}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(entrada, f, ensure_ascii=False)
+        os.replace(tmp, PDF_CACHE_DIR / f"{chave}.json")
+        _cache_pdf_evict()
+    except Exception:
+        pass
+
+def _cache_pdf_evict(limite=None):
+    limite = PDF_CACHE_MAX_BYTES if limite is None else limite
+    arqs = []
+    for e in os.scandir(PDF_CACHE_DIR):
+        if e.name.endswith(".json"):
+            try:
+                info = e.stat()
+                arqs.append((info.st_mtime, info.st_size, e.path))
+            except OSError:
+                continue
+    total = sum(a[1] for a in arqs)
+    for _, tam, path in sorted(arqs):
+        if total <= limite:
+            break
+        try:
+            os.remove(path)
+            total -= tam
+        except OSError:
+            pass
+
+def ler_pdf(caminho_pdf):
+    """
+    ({"texto", "ocr", "linhas"}, veio_do_cache, erros): PDF com conteúdo já visto sai do cache.
+    Sem st.* aqui: no lote isto roda nas threads das sessões; quem chama mostra os erros.
+    """
+    chave = chave_cache_pdf(caminho_pdf)
+    entrada = _cache_pdf_get(chave)
+    if entrada is not None:
+        return entrada, True, []
+    texto, usou_ocr, erros = extrair_texto_pdf_com_ocr(caminho_pdf)
+    entrada = {"texto": texto, "ocr": usou_ocr, "linhas": extrair_linhas_faturamento(texto)}
+    if not erros:  # extração incompleta não fica gravada
+        _cache_pdf_put(chave, entrada)
+    return entrada, False, erros
 
 def processar_arquivos_baixados(diretorio, numero_guia):
-    dados_lista = []
-    # Regex flexível para capturar dados de faturamento
-    padrao = re.compile(
-        r"(\d{2}/\d{2}/\d{4})"  # Data
-        r".*?"                  # Salto preguiçoso
-        r"(\d[\d\.\-]{5,15})"   # Código TUSS
-        r"\s+(.*?)\s+"          # Descrição
-        r"(\d+)\s+"             # Qtd
-        r"([\d,.]+)\s+"         # Unit
-        r"([\d,.]+)",           # Total
-        re.DOTALL
-    )
+    dados_lista, erros = [], []
+    acertos = ocr = pdfs = 0
     
-    for arquivo in os.listdir(diretorio):
+    for arquivo in sorted(os.listdir(diretorio)):
         if arquivo.lower().endswith(".pdf"):
             caminho = os.path.join(diretorio, arquivo)
-            texto = extrair_texto_pdf(caminho)
-            texto_limpo = re.sub(r"[ \t]+", " ", texto) # Normaliza espaços
-            matches = padrao.findall(texto_limpo)
+            entrada, do_cache, erros_pdf = ler_pdf(caminho)
+            erros += [f"{arquivo}: {e}" for e in erros_pdf]
+            pdfs += 1
+            acertos += do_cache
+            ocr += bool(entrada["ocr"])
             
-            for m in matches:
-                dados_lista.append({
-                    "Guia": numero_guia,
-                    "Data": m[0],
-                    "Código": m[1],
-                    "Descrição": m[2].replace("\n", " ").strip(),
-                    "Qtd": m[3],
-                    "Valor Unit": m[4],
-                    "Valor Total": m[5],
-                    "Arquivo Origem": arquivo
-                })
-    return pd.DataFrame(dados_lista)
+            for linha in entrada["linhas"]:
+                dados_lista.append({"Guia": numero_guia, **linha, "Arquivo Origem": arquivo})
+    df = pd.DataFrame(dados_lista)
+    df.attrs["pdfs"] = {"arquivos": pdfs, "do_cache": acertos, "com_ocr": ocr, "erros": erros}
+    return df
 
-# === FUNÇÃO PRINCIPAL DE BUSCA ===
+# === SESSÃO NO PORTAL (LOGIN UMA VEZ, VÁRIAS GUIAS) ===
+
+class SessaoAMHP:
+    """
+    Navegador logado no AMHPTISS, reaproveitado entre guias. Cada sessão tem a própria pasta
+    de download; os PDFs de cada guia vão para uma subpasta com o número dela.
+    """
+    def __init__(self, urls=URLS_AMHP, credenciais=None, driver_factory=configurar_driver, timeout=30):
+        self.urls = urls
+        self.credenciais = credenciais if credenciais is not None else st.secrets["credentials"]
+        self.driver, download_dir = driver_factory(nova_pasta_download())
+        # Garantir caminho absoluto para o Chrome
+        self.download_dir = os.path.abspath(download_dir)
+        self.wait = WebDriverWait(self.driver, timeout)
+        # frames ainda montando durante a espera não contam como falha
+        self.wait_frames = WebDriverWait(self.driver, timeout,
+                                         ignored_exceptions=(NoSuchFrameException, StaleElementReferenceException))
+        self.janela_principal = self.janela_sistema = None
+        self.tempos_login = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.fechar()
+
+    def fechar(self):
+        try:
+            self.driver.quit()
+        except Exception:
+            pass
+
+    def ativa(self):
+        """Navegador respondendo e janela do AMHPTISS aberta; se não, só um novo login resolve."""
+        try:
+            return self.janela_sistema is not None and self.janela_sistema in self.driver.window_handles
+        except Exception:
+            return False
+
+    def _screenshot(self, nome):
+        # Fora da raiz da pasta: arquivos soltos na raiz são limpos antes de cada guia
+        os.makedirs(os.path.join(self.download_dir, "erros"), exist_ok=True)
+        caminho = os.path.join(self.download_dir, "erros", nome)
+        try:
+            self.driver.save_screenshot(caminho)
+            return caminho
+        except Exception:
+            return None
+
+    def entrar(self):
+        driver, wait, tempos = self.driver, self.wait, self.tempos_login
+        self.janela_principal = driver.current_window_handle
 
-def extrair_detalhes_site_amhp(numero_guia):
-    driver, download_dir = configurar_driver()
-    # Garantir caminho absoluto para o Chrome
-    download_dir = os.path.abspath(download_dir) 
-    wait = WebDriverWait(driver, 30)
-    valor_solicitado = re.sub(r"\D+", "", str(numero_guia).strip())
-    janela_principal = driver.current_window_handle
-    
-    try:
         # 1. Login (Mantido)
-        driver.get("https://portal.amhp.com.br/")
-        wait.until(EC.presence_of_element_located((By.ID, "input-9"))).send_keys(st.secrets["credentials"]["usuario"])
-        driver.find_element(By.ID, "input-12").send_keys(st.secrets["credentials"]["senha"] + Keys.ENTER)
-
-        # 2. Transição para AMHPTISS
-        time.sleep(7)
-        btn_tiss = wait.until(EC.element_to_be_clickable((By.XPATH, "//button[contains(., 'AMHPTISS')]")))
-        driver.execute_script("arguments[0].click();", btn_tiss)
-        
-        # Esperar nova janela abrir e focar nela
-        wait.until(lambda d: len(d.window_handles) > 1)
-        for handle in driver.window_handles:
-            if handle != janela_principal:
-                driver.switch_to.window(handle)
-                break
-        
-        janela_sistema = driver.current_window_handle
-
-        # 3. Busca (Navegação Direta)
-        driver.get("https://amhptiss.amhp.com.br/AtendimentosRealizados.aspx")
-        time.sleep(5)
-
-        # Preenchimento Robusto
-        input_atendimento = wait.until(EC.presence_of_element_located((By.ID, "ctl00_MainContent_rtbNumeroAtendimento")))
-        driver.execute_script(f"arguments[0].value = '{valor_solicitado}';", input_atendimento)
-        
-        btn_buscar = driver.find_element(By.ID, "ctl00_MainContent_btnBuscar_input")
-        driver.execute_script("arguments[0].click();", btn_buscar)
-        
-        # 4. Abrir Relatório
-        time.sleep(5)
-        link_guia = wait.until(EC.element_to_be_clickable((By.XPATH, f"//a[contains(text(), '{valor_solicitado}')]")))
-        driver.execute_script("arguments[0].click();", link_guia)
-        
-        # 5. O PULO DO GATO: Download em Loop
-        # Vamos tentar os dois botões (Imprimir e Outras Despesas)
-        botoes = ["ctl00_MainContent_btnImprimir_input", "ctl00_MainContent_rbtOutrasDespesas_input"]
-        
-        for id_btn in botoes:
+        with cronometrar(tempos, "login"):
+            driver.get(self.urls.portal)
+            wait.until(EC.presence_of_element_located((By.ID, "input-9"))).send_keys(self.credenciais["usuario"])
+            driver.find_element(By.ID, "input-12").send_keys(self.credenciais["senha"] + Keys.ENTER)
+
+        # 2. Transição para AMHPTISS (o botão só fica clicável depois que o portal termina de carregar)
+        with cronometrar(tempos, "abrir AMHPTISS"):
+            btn_tiss = wait.until(EC.element_to_be_clickable((By.XPATH, "//button[contains(., 'AMHPTISS')]")))
+            driver.execute_script("arguments[0].click();", btn_tiss)
+
+            # Esperar nova janela abrir e focar nela
+            wait.until(lambda d: len(d.window_handles) > 1)
+            for handle in driver.window_handles:
+                if handle != self.janela_principal:
+                    driver.switch_to.window(handle)
+                    break
+            wait.until(pagina_carregada)
+
+        self.janela_sistema = driver.current_window_handle
+
+    def consultar(self, numero_guia):
+        """Busca uma guia na sessão já logada; erros viram {"erro": ...} (a sessão segue utilizável)."""
+        driver, wait = self.driver, self.wait
+        janela_principal, janela_sistema = self.janela_principal, self.janela_sistema
+        valor_solicitado = re.sub(r"\D+", "", str(numero_guia).strip())
+        destino = os.path.join(self.download_dir, valor_solicitado or "guia")
+        avisos, tempos = [], {}
+        # PDFs soltos de uma guia anterior que falhou no meio não podem cair nesta
+        for arq in os.listdir(self.download_dir):
+            if os.path.isfile(os.path.join(self.download_dir, arq)):
+                os.remove(os.path.join(self.download_dir, arq))
+
+        try:
             driver.switch_to.window(janela_sistema)
-            if entrar_no_frame_do_elemento(driver, id_btn):
+
+            # 3. Busca (Navegação Direta)
+            with cronometrar(tempos, "busca"):
+                driver.get(self.urls.atendimentos)
+                wait.until(pagina_carregada)
+
+                # Preenchimento Robusto
+                input_atendimento = wait.until(EC.element_to_be_clickable((By.ID, "ctl00_MainContent_rtbNumeroAtendimento")))
+                driver.execute_script(f"arguments[0].value = '{valor_solicitado}';", input_atendimento)
+
+                btn_buscar = wait.until(EC.element_to_be_clickable((By.ID, "ctl00_MainContent_btnBuscar_input")))
+                driver.execute_script("arguments[0].click();", btn_buscar)
+
+            # 4. Abrir Relatório (o link com o número só existe depois que a grade volta da busca)
+            with cronometrar(tempos, "abrir guia"):
+                link_guia = wait.until(EC.element_to_be_clickable((By.XPATH, f"//a[contains(text(), '{valor_solicitado}')]")))
+                driver.execute_script("arguments[0].click();", link_guia)
+
+                # O detalhe da guia carrega num frame depois do clique: espera algum botão de relatório existir
+                botoes = ["ctl00_MainContent_btnImprimir_input", "ctl00_MainContent_rbtOutrasDespesas_input"]
                 try:
-                    btn_export = driver.find_element(By.ID, id_btn)
-                    if btn_export.is_enabled():
-                        driver.execute_script("arguments[0].click();", btn_export)
-                        
-                        # Espera abrir a janela do relatório (terceira janela)
-                        wait.until(lambda d: len(d.window_handles) > 2)
-                        
-                        # Muda para a janela do relatório
+                    self.wait_frames.until(lambda d: any(entrar_no_frame_do_elemento(d, b) for b in botoes))
+                except TimeoutException:
+                    avisos.append("Nenhum botão de relatório apareceu na guia.")
+                driver.switch_to.default_content()
+
+            # 5. O PULO DO GATO: Download em Loop
+            # Vamos tentar os dois botões (Imprimir e Outras Despesas)
+
+            for id_btn in botoes:
+                driver.switch_to.window(janela_sistema)
+                if entrar_no_frame_do_elemento(driver, id_btn):
+                    try:
+                        with cronometrar(tempos, f"exportar {id_btn.split('_')[-2]}"):
+                            btn_export = driver.find_element(By.ID, id_btn)
+                            if btn_export.is_enabled():
+                                driver.execute_script("arguments[0].click();", btn_export)
+
+                                # Espera abrir a janela do relatório (terceira janela)
+                                wait.until(lambda d: len(d.window_handles) > 2)
+
+                                # Muda para a janela do relatório
+                                for handle in driver.window_handles:
+                                    if handle not in [janela_principal, janela_sistema]:
+                                        driver.switch_to.window(handle)
+                                        break
+
+                                # Seleciona PDF e clica em Exportar
+                                drop = wait.until(EC.presence_of_element_located((By.ID, "ReportView_ReportToolbar_ExportGr_FormatList_DropDownList")))
+                                Select(drop).select_by_value("PDF")
+                                btn_final = wait.until(EC.element_to_be_clickable((By.ID, "ReportView_ReportToolbar_ExportGr_Export")))
+                                antes = arquivos_na_pasta(self.download_dir)
+                                driver.execute_script("arguments[0].click();", btn_final)
+
+                                # AGUARDA O ARQUIVO TERMINAR DE GRAVAR NO DISCO
+                                aguardar_download(self.download_dir, antes)
+                                driver.close() # Fecha aba do relatório
+                    except Exception as e:
+                        avisos.append(f"Falha ao tentar clicar em {id_btn}: {e}")
+                        # Janela de relatório que ficou aberta atrapalharia a espera do próximo botão
                         for handle in driver.window_handles:
                             if handle not in [janela_principal, janela_sistema]:
                                 driver.switch_to.window(handle)
-                                break
-                        
-                        # Seleciona PDF e clica em Exportar
-                        drop = wait.until(EC.presence_of_element_located((By.ID, "ReportView_ReportToolbar_ExportGr_FormatList_DropDownList")))
-                        Select(drop).select_by_value("PDF")
-                        time.sleep(2)
-                        btn_final = driver.find_element(By.ID, "ReportView_ReportToolbar_ExportGr_Export")
-                        driver.execute_script("arguments[0].click();", btn_final)
-                        
-                        # AGUARDA O ARQUIVO APARECER NO DISCO
-                        time.sleep(8) 
-                        driver.close() # Fecha aba do relatório
-                except Exception as e:
-                    st.write(f"Aviso: Falha ao tentar clicar em {id_btn}: {e}")
-                    continue
+                                driver.close()
+                        continue
+
+            driver.switch_to.window(janela_sistema)
+
+            # 6. Extração (os PDFs desta guia vão para a subpasta dela)
+            with cronometrar(tempos, "extração"):
+                os.makedirs(destino, exist_ok=True)
+                for arq in os.listdir(self.download_dir):
+                    if os.path.isfile(os.path.join(self.download_dir, arq)):
+                        shutil.move(os.path.join(self.download_dir, arq), os.path.join(destino, arq))
+                df_final = processar_arquivos_baixados(destino, valor_solicitado)
+                avisos += df_final.attrs["pdfs"]["erros"]
+            return {"status": "Sucesso", "dados": df_final, "diretorio": destino, "avisos": avisos, "tempos": tempos}
 
-        driver.switch_to.window(janela_sistema)
-        
-        # 6. Extração
-        df_final = processar_arquivos_baixados(download_dir, valor_solicitado)
-        return {"status": "Sucesso", "dados": df_final, "diretorio": download_dir}
+        except Exception as e:
+            return {"erro": str(e), "screenshot": self._screenshot(f"erro_{valor_solicitado or 'guia'}.png"),
+                    "avisos": avisos, "tempos": tempos}
+
+# === FUNÇÃO PRINCIPAL DE BUSCA ===
 
+def extrair_detalhes_site_amhp(numero_guia, urls=URLS_AMHP, driver_factory=configurar_driver):
+    try:
+        with SessaoAMHP(urls, driver_factory=driver_factory) as sessao:
+            sessao.entrar()
+            res = sessao.consultar(numero_guia)
+            res["tempos"] = {**sessao.tempos_login, **res["tempos"]}
+            return res
     except Exception as e:
-        driver.save_screenshot("erro_download.png")
         return {"erro": str(e)}
-    finally:
-        driver.quit()
+
+def status_guia(res):
+    if "erro" in res:
+        return f"Erro: {res['erro']}"
+    return "Sucesso" if res.get("dados") is not None and not res["dados"].empty else "Sem itens extraídos"
+
+def combinar_resultados(numeros, resultados):
+    """Um DataFrame só: itens de todas as guias + Status; guia sem itens (ou com erro) vira uma linha."""
+    partes = []
+    for n in numeros:
+        res = resultados.get(n, {"erro": "guia não processada"})
+        dados = res.get("dados")
+        if dados is not None and not dados.empty:
+            partes.append(dados.assign(Status=status_guia(res)))
+        else:
+            partes.append(pd.DataFrame({"Guia": [n], "Status": [status_guia(res)]}))
+    return pd.concat(partes, ignore_index=True) if partes else pd.DataFrame(columns=["Guia", "Status"])
+
+def consultar_guias_em_lote(numeros, n_sessoes=2, urls=URLS_AMHP, credenciais=None,
+                            sessao_factory=SessaoAMHP, ao_concluir=None):
+    """
+    Busca várias guias espalhadas por até n_sessoes navegadores logados (login uma vez por sessão).
+    Erro da própria guia (não encontrada, sem relatório) não custa novo login; se o navegador caiu
+    ou o login falhou, a sessão é descartada e a guia é tentada de novo numa sessão nova.
+    ao_concluir(feitas, total, guia, resultado) é chamado na thread de quem chamou (pode usar st.*).
+    """
+    numeros = list(dict.fromkeys(n for n in (re.sub(r"\D+", "", str(x)) for x in numeros) if n))
+    if not numeros:
+        return combinar_resultados([], {})
+    if credenciais is None:
+        credenciais = dict(st.secrets["credentials"])
+    pendentes, prontas = queue.Queue(), queue.Queue()
+    for n in numeros:
+        pendentes.put(n)
+
+    def trabalhador():
+        sessao = None
+        try:
+            while True:
+                try:
+                    n = pendentes.get_nowait()
+                except queue.Empty:
+                    return
+                for tentativa in (1, 2):
+                    try:
+                        if sessao is None:
+                            sessao = sessao_factory(urls, credenciais)
+                            sessao.entrar()
+                        res = sessao.consultar(n)
+                        if "erro" not in res or sessao.ativa():
+                            break
+                    except Exception as e:  # navegador não subiu ou login falhou
+                        res = {"erro": f"{type(e).__name__}: {e}"}
+                    if sessao is not None:
+                        sessao.fechar()
+                        sessao = None
+                prontas.put((n, res))
+        finally:
+            if sessao is not None:
+                sessao.fechar()
+
+    resultados = {}
+    n_threads = max(1, min(int(n_sessoes), len(numeros)))
+    with ThreadPoolExecutor(max_workers=n_threads, thread_name_prefix="amhp") as pool:
+        futuros = [pool.submit(trabalhador) for _ in range(n_threads)]
+        while len(resultados) < len(numeros):
+            try:
+                n, res = prontas.get(timeout=1)
+            except queue.Empty:
+                if all(f.done() for f in futuros) and prontas.empty():
+                    break
+                continue
+            resultados[n] = res
+            if ao_concluir:
+                ao_concluir(len(resultados), len(numeros), n, res)
+    return combinar_resultados(numeros, resultados)
 
 # === INTERFACE STREAMLIT ===
 
 st.set_page_config(page_title="GABMA - Consulta AMHP", page_icon="🏥", layout="wide")
 st.title("🏥 Inteligência de Faturamento AMHP")
 
-if "credentials" not in st.secrets:
+try:
+    tem_credenciais = "credentials" in st.secrets
+except Exception:  # sem secrets.toml (ex.: módulo importado por bench/)
+    tem_credenciais = False
+
+if not tem_credenciais:
     st.error("Configure as credenciais em Secrets.")
 else:
-    guia = st.text_input("Número do Atendimento:")
+    entrada = st.text_area("Número(s) do Atendimento:", help="Uma guia ou várias, separadas por linha, vírgula ou espaço.")
+    guias = [g for g in re.split(r"[\s,;]+", entrada) if g]
+    n_sessoes = st.number_input("Sessões de navegador em paralelo", min_value=1, max_value=4, value=2,
+                                help="Cada sessão faz login uma vez e consulta várias guias.")
     
     if st.button("🚀 Processar e Analisar"):
-        if not guia:
+        if not guias:
             st.warning("Informe a guia.")
+        elif len(guias) > 1:
+            barra = st.progress(0.0, text=f"0/{len(guias)} guias")
+            avisos = []
+            def ao_concluir(feitas, total, guia, res):
+                avisos.extend(f"Guia {guia} — {a}" for a in res.get("avisos", []))
+                segundos = sum(res.get("tempos", {}).values())
+                barra.progress(feitas / total, text=f"{feitas}/{total} guias · {guia}: {status_guia(res)} ({segundos:.0f}s)")
+            df = consultar_guias_em_lote(guias, n_sessoes=n_sessoes, ao_concluir=ao_concluir)
+            barra.empty()
+
+            resumo = df.groupby("Guia", sort=False)["Status"].agg(["first", "size"]).reset_index()
+            resumo.columns = ["Guia", "Status", "Linhas"]
+            resumo.loc[resumo["Status"] != "Sucesso", "Linhas"] = 0
+            ok = int((resumo["Status"] == "Sucesso").sum())
+            st.success(f"{ok} de {len(resumo)} guias com itens extraídos.")
+            st.dataframe(resumo, use_container_width=True, hide_index=True)
+            if avisos:
+                with st.expander(f"⚠️ Avisos ({len(avisos)})"):
+                    for aviso in avisos:
+                        st.warning(aviso)
+
+            itens = df[df["Status"] == "Sucesso"]
+            if not itens.empty:
+                st.subheader("📋 Dados Extraídos")
+                st.dataframe(itens, use_container_width=True)
+            csv = df.to_csv(index=False).encode('utf-8-sig')
+            st.download_button("📥 Baixar Planilha de Resultados", csv, "faturamento.csv", "text/csv")
         else:
             with st.spinner("Navegando no portal e baixando documentos..."):
-                res = extrair_detalhes_site_amhp(guia)
+                res = extrair_detalhes_site_amhp(guias[0])
                 
+                if res.get("tempos"):
+                    st.caption("⏱️ " + " · ".join(f"{etapa}: {seg:.1f}s" for etapa, seg in res["tempos"].items()))
                 if "erro" in res:
                     st.error(f"Erro: {res['erro']}")
-                    if os.path.exists("erro_amhptiss.png"):
-                        st.image("erro_amhptiss.png", caption="Screenshot do Erro")
+                    if res.get("screenshot") and os.path.exists(res["screenshot"]):
+                        st.image(res["screenshot"], caption="Screenshot do Erro")
                 else:
                     st.success("Automação concluída!")
+                    for aviso in res.get("avisos", []):
+                        st.warning(aviso)
                     
                     # --- TESTE DE DOWNLOAD (Para você conferir se baixou) ---
                     with st.expander("📂 Conferência de Arquivos Baixados"):
@@ -259,6 +720,9 @@ else:
 
                     # --- EXIBIÇÃO DOS DADOS ---
                     df = res["dados"]
+                    if df.attrs.get("pdfs"):
+                        p = df.attrs["pdfs"]
+                        st.caption(f"📄 {p['arquivos']} PDF(s) · {p['do_cache']} do cache · {p['com_ocr']} com OCR")
                     if not df.empty:
                         st.subheader("📋 Dados Extraídos")
                         st.dataframe(df, use_container_width=True)
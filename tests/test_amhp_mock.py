@@ -0,0 +1,162 @@
+"""
+Consulta de guias (funciona.py) contra um mock local das páginas do portal AMHP (tests/mock_amhp).
+
+O mock usa os mesmos IDs do portal real: login, botão AMHPTISS numa nova janela, busca do
+atendimento, detalhe da guia num iframe e relatório que exporta PDF. Guias existentes: 1001
+(relatório + outras despesas) e 1002 (só relatório); qualquer outra volta "nenhum registro".
+
+Os testes com navegador precisam de Chrome/Chromium + chromedriver e são pulados sem eles.
+"""
+import functools
+import http.server
+import logging
+import shutil
+import threading
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("selenium")
+logging.getLogger("streamlit").setLevel(logging.ERROR)
+import funciona  # noqa: E402
+
+MOCK = Path(__file__).resolve().parent / "mock_amhp"
+CREDENCIAIS = {"usuario": "teste", "senha": "teste"}
+ITENS = {
+    "1001_guia": ["01/02/2024 10101012 CONSULTA EM CONSULTORIO 1 100,00 100,00",
+                  "01/02/2024 40304361 HEMOGRAMA COMPLETO 2 10,50 21,00"],
+    "1001_despesas": ["01/02/2024 90000123 MATERIAL DESCARTAVEL 3 5,00 15,00"],
+    "1002_guia": ["03/02/2024 40808041 RX TORAX PA 1 80,00 80,00"],
+}
+
+
+def _pdf(linhas: list) -> bytes:
+    """PDF mínimo de uma página com uma linha de texto por item (suficiente para o pdfplumber)."""
+    ops = "BT /F1 9 Tf 30 800 Td 12 TL " + " ".join(f"({l}) '" for l in linhas) + " ET"
+    objs = ["<< /Type /Catalog /Pages 2 0 R >>",
+            "<< /Type /Pages /Kids [4 0 R] /Count 1 >>",
+            "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+            "<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Resources << /Font << /F1 3 0 R >> >> /Contents 5 0 R >>",
+            f"<< /Length {len(ops)} >>\nstream\n{ops}\nendstream"]
+    out, offs = b"%PDF-1.4\n", []
+    for i, o in enumerate(objs, 1):
+        offs.append(len(out))
+        out += f"{i} 0 obj\n{o}\nendobj\n".encode("latin-1")
+    xref = len(out)
+    out += f"xref\n0 {len(objs) + 1}\n0000000000 65535 f \n".encode() + b"".join(f"{o:010d} 00000 n \n".encode() for o in offs)
+    out += f"trailer\n<< /Size {len(objs) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    return out
+
+
+class _Silencioso(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def pastas(tmp_path, monkeypatch):
+    monkeypatch.setattr(funciona, "DOWNLOAD_BASE", str(tmp_path / "downloads"))
+    monkeypatch.setattr(funciona, "PDF_CACHE_DIR", tmp_path / "cache_pdfs")
+    return tmp_path
+
+
+@pytest.fixture
+def portal(pastas):
+    """Serve o mock (com os PDFs dos relatórios) num http.server local; devolve as UrlsAMHP."""
+    raiz = pastas / "site"
+    shutil.copytree(MOCK, raiz)
+    (raiz / "pdf").mkdir()
+    for nome, linhas in ITENS.items():
+        (raiz / "pdf" / f"{nome}.pdf").write_bytes(_pdf(linhas))
+    srv = http.server.ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(_Silencioso, directory=str(raiz)))
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{srv.server_address[1]}"
+    yield funciona.UrlsAMHP(portal=f"{base}/portal.html", atendimentos=f"{base}/atendimentos.html")
+    srv.shutdown()
+
+
+@pytest.fixture
+def driver_factory():
+    try:
+        driver, _ = funciona.configurar_driver()
+        driver.quit()
+    except Exception as e:
+        pytest.skip(f"Chrome/chromedriver indisponível: {e}")
+    return funciona.configurar_driver
+
+
+def test_sessao_consulta_varias_guias_com_um_login(portal, driver_factory):
+    with funciona.SessaoAMHP(portal, CREDENCIAIS, driver_factory, timeout=5) as sessao:
+        sessao.entrar()
+
+        res = sessao.consultar("1001")
+        assert res.get("status") == "Sucesso", res
+        assert sorted(res["dados"]["Código"]) == ["10101012", "40304361", "90000123"]
+        assert sorted(Path(res["diretorio"]).glob("*.pdf"))
+
+        res = sessao.consultar("9999")
+        assert "erro" in res
+        assert sessao.ativa()  # guia inexistente não derruba a sessão
+
+        res = sessao.consultar("1002")
+        assert res.get("status") == "Sucesso", res
+        assert list(res["dados"]["Código"]) == ["40808041"]
+        assert Path(res["diretorio"]).name == "1002"
+
+
+def test_lote_contra_mock(portal, driver_factory):
+    logins = []
+
+    class Sessao(funciona.SessaoAMHP):
+        def entrar(self):
+            logins.append(self)
+            super().entrar()
+
+    df = funciona.consultar_guias_em_lote(
+        ["1001", "9999", "1002"], n_sessoes=1, urls=portal, credenciais=CREDENCIAIS,
+        sessao_factory=lambda urls, cred: Sessao(urls, cred, driver_factory, timeout=5))
+
+    status = df.groupby("Guia", sort=False)["Status"].first()
+    assert status["1001"] == "Sucesso" and status["1002"] == "Sucesso"
+    assert status["9999"].startswith("Erro:")
+    assert (df["Guia"] == "1001").sum() == 3
+    assert len(logins) == 1  # guia não encontrada não força novo login
+
+
+class _SessaoFalsa:
+    """Sessão sem navegador: guia 404 dá erro com a sessão viva; 500 derruba o navegador uma vez."""
+    logins = 0
+    derrubou = False
+
+    def __init__(self, urls, credenciais):
+        self.viva = True
+
+    def entrar(self):
+        _SessaoFalsa.logins += 1
+
+    def consultar(self, n):
+        if n == "404":
+            return {"erro": "não encontrada"}
+        if n == "500" and not _SessaoFalsa.derrubou:
+            _SessaoFalsa.derrubou, self.viva = True, False
+            return {"erro": "invalid session id"}
+        return {"status": "Sucesso", "dados": funciona.pd.DataFrame({"Guia": [n], "Código": ["10101012"]})}
+
+    def ativa(self):
+        return self.viva
+
+    def fechar(self):
+        pass
+
+
+def test_lote_so_refaz_login_quando_a_sessao_cai():
+    _SessaoFalsa.logins, _SessaoFalsa.derrubou = 0, False
+    feitas = []
+    df = funciona.consultar_guias_em_lote(
+        ["1", "404", "2", "500", "3"], n_sessoes=1, credenciais=CREDENCIAIS,
+        sessao_factory=_SessaoFalsa, ao_concluir=lambda f, t, g, r: feitas.append(g))
+
+    assert feitas == ["1", "404", "2", "500", "3"]
+    assert dict(zip(df["Guia"], df["Status"])) == {
+        "1": "Sucesso", "404": "Erro: não encontrada", "2": "Sucesso", "500": "Sucesso", "3": "Sucesso"}
+    assert _SessaoFalsa.logins == 2  # um login inicial + um depois que o navegador caiu
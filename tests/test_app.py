@@ -0,0 +1,223 @@
+"""
+Funções de leitura e conciliação do app.py, sem a interface (o import roda o script em modo "bare").
+"""
+import io
+import logging
+import random
+import threading
+from datetime import datetime
+
+import pandas as pd
+import pytest
+import xlsxwriter
+
+logging.getLogger("streamlit").setLevel(logging.ERROR)
+import app  # noqa: E402
+
+NS = "http://www.ans.gov.br/padroes/tiss/schemas"
+
+
+def _xml_tiss(n_guias: int, seed: int) -> bytes:
+    """Lote TISS sintético com guias SP-SADT (procedimentos + outras despesas) e de consulta."""
+    r = random.Random(seed)
+    guias = []
+    for g in range(n_guias):
+        if g % 4 == 0:
+            guias.append(
+                f"<ans:guiaConsulta><ans:numeroGuiaPrestador>{1000 + g}</ans:numeroGuiaPrestador>"
+                f"<ans:dadosAtendimento><ans:dataAtendimento>2024-01-{1 + g % 28:02d}</ans:dataAtendimento>"
+                f"<ans:procedimento><ans:codigoTabela>22</ans:codigoTabela><ans:codigoProcedimento>10101012</ans:codigoProcedimento>"
+                f"<ans:descricaoProcedimento>Consulta em consultório</ans:descricaoProcedimento>"
+                f"<ans:valorProcedimento>{r.randint(50, 300)}.{r.randint(0, 99):02d}</ans:valorProcedimento>"
+                f"</ans:procedimento></ans:dadosAtendimento></ans:guiaConsulta>")
+            continue
+        itens = "".join(
+            f"<ans:procedimentoExecutado><ans:dataExecucao>2024-02-02</ans:dataExecucao><ans:procedimento>"
+            f"<ans:codigoTabela>22</ans:codigoTabela><ans:codigoProcedimento>403{i:05d}</ans:codigoProcedimento>"
+            f"<ans:descricaoProcedimento>Exame {i}</ans:descricaoProcedimento></ans:procedimento>"
+            f"<ans:quantidadeExecutada>{r.choice(['1', '2', '1.5'])}</ans:quantidadeExecutada>"
+            f"<ans:valorUnitario>{r.choice(['10.50', '3.333', '120.00'])}</ans:valorUnitario>"
+            f"<ans:valorTotal>{r.choice(['0', '21.00', '7.77'])}</ans:valorTotal></ans:procedimentoExecutado>"
+            for i in range(r.randint(1, 5)))
+        desp = (f"<ans:outrasDespesas><ans:despesa><ans:identificadorDespesa>01</ans:identificadorDespesa>"
+                f"<ans:servicosExecutados><ans:codigoTabela>19</ans:codigoTabela><ans:codigoProcedimento>90001</ans:codigoProcedimento>"
+                f"<ans:quantidadeExecutada>3</ans:quantidadeExecutada><ans:valorUnitario>2.10</ans:valorUnitario>"
+                f"<ans:valorTotal>6.30</ans:valorTotal><ans:descricaoProcedimento>Material</ans:descricaoProcedimento>"
+                f"</ans:servicosExecutados></ans:despesa></ans:outrasDespesas>")
+        guias.append(
+            f"<ans:guiaSP-SADT><ans:cabecalhoGuia><ans:numeroGuiaPrestador>{2000 + g}</ans:numeroGuiaPrestador></ans:cabecalhoGuia>"
+            f"<ans:dadosAtendimento><ans:dataAtendimento>2024-02-{1 + g % 28:02d}</ans:dataAtendimento></ans:dadosAtendimento>"
+            f"<ans:procedimentosExecutados>{itens}</ans:procedimentosExecutados>{desp if g % 3 else ''}</ans:guiaSP-SADT>")
+    return _lote_tiss(guias, lote=str(100 + seed))
+
+
+def _lote_tiss(guias: list, lote: str = "1") -> bytes:
+    return (f'<?xml version="1.0" encoding="UTF-8"?><ans:mensagemTISS xmlns:ans="{NS}"><ans:prestadorParaOperadora>'
+            f"<ans:loteGuias><ans:numeroLote>{lote}</ans:numeroLote><ans:guiasTISS>{''.join(guias)}"
+            f"</ans:guiasTISS></ans:loteGuias></ans:prestadorParaOperadora></ans:mensagemTISS>").encode()
+
+
+def _guia_sadt(prestador: str, itens: list, operadora: str = "") -> str:
+    """Guia SP-SADT com itens (código, descrição, quantidade, valor unitário, valor total)."""
+    oper = f"<ans:numeroGuiaOperadora>{operadora}</ans:numeroGuiaOperadora>" if operadora else ""
+    procs = "".join(
+        f"<ans:procedimentoExecutado><ans:dataExecucao>2024-03-01</ans:dataExecucao><ans:procedimento>"
+        f"<ans:codigoTabela>22</ans:codigoTabela><ans:codigoProcedimento>{cod}</ans:codigoProcedimento>"
+        f"<ans:descricaoProcedimento>{desc}</ans:descricaoProcedimento></ans:procedimento>"
+        f"<ans:quantidadeExecutada>{qtd}</ans:quantidadeExecutada><ans:valorUnitario>{vuni}</ans:valorUnitario>"
+        f"<ans:valorTotal>{vtot}</ans:valorTotal></ans:procedimentoExecutado>"
+        for cod, desc, qtd, vuni, vtot in itens)
+    return (f"<ans:guiaSP-SADT><ans:cabecalhoGuia><ans:numeroGuiaPrestador>{prestador}</ans:numeroGuiaPrestador>{oper}"
+            f"</ans:cabecalhoGuia><ans:procedimentosExecutados>{procs}</ans:procedimentosExecutados></ans:guiaSP-SADT>")
+
+
+def _glosas_xlsx(n: int, seed: int, cabecalho_alternativo: bool = False) -> bytes:
+    """Faturas Glosadas no layout da AMHP; a variante troca nomes de colunas, como em exportações antigas."""
+    r = random.Random(seed)
+    cab = ["Amhptiss", "Convênio", "Nome Clínica", "Realizado", "Pagamento", "Descrição",
+           "Motivo Glosa", "Descricao Glosa", "Tipo de Glosa", "Valor Cobrado", "Valor Glosa", "Valor Recursado"]
+    if cabecalho_alternativo:
+        cab[1], cab[5] = "Convenio", "Descrição do Item"
+    buf = io.BytesIO()
+    wb = xlsxwriter.Workbook(buf)
+    ws = wb.add_worksheet()
+    fmt_data = wb.add_format({"num_format": "dd/mm/yyyy"})
+    ws.write_row(0, 0, cab)
+    for i in range(1, n + 1):
+        vc = round(r.uniform(10, 500), 2)
+        ws.write_row(i, 0, [str(61900000 + r.randint(0, 80)), r.choice(["CASSI", "GEAP", "AMIL"]),
+                            r.choice(["Clinica A", "Clinica B"])])
+        ws.write_datetime(i, 3, datetime(2024, r.randint(1, 6), r.randint(1, 28)), fmt_data)
+        ws.write_datetime(i, 4, datetime(2024, r.randint(2, 8), 10), fmt_data)
+        ws.write_row(i, 5, [r.choice(["CONSULTA", "HEMOGRAMA COMPLETO", "RX TORAX"]), r.choice(["1801", "2001"]),
+                            r.choice(["Valor cobrado a maior", "Auditoria"]), r.choice(["Total", "Parcial"]),
+                            vc, -round(vc * r.choice([0, 0, .5, 1]), 2), 0])
+    wb.close()
+    return buf.getvalue()
+
+
+def _demo_de(df_xml: pd.DataFrame, seed: int = 0) -> pd.DataFrame:
+    """Demonstrativo no formato de ler_demo_amhp_fixado: cada item da guia do prestador, com alguma glosa."""
+    r = random.Random(seed)
+    guias = df_xml["numeroGuiaPrestador"].astype(str)
+    demo = pd.DataFrame({
+        "numeroGuiaPrestador": guias,
+        "codigo_procedimento": df_xml["codigo_procedimento"].astype(str),
+        "codigo_procedimento_norm": df_xml["codigo_procedimento_norm"],
+        "descricao_procedimento": df_xml["descricao_procedimento"],
+        "valor_apresentado": df_xml["valor_total"].astype(float),
+        "valor_glosa": [-r.choice([0.0, 0.0, 1.5]) for _ in range(len(df_xml))],
+    })
+    demo["valor_pago"] = demo["valor_apresentado"] + demo["valor_glosa"]
+    demo["chave_demo"] = demo["numeroGuiaPrestador"] + "__" + demo["codigo_procedimento_norm"]
+    return demo.reset_index(drop=True)
+
+
+@pytest.fixture
+def sem_cache_xml(tmp_path, monkeypatch):
+    """Cache de parse sempre vazio (e gravando no tmp), para as duas leituras fazerem o parse de fato."""
+    monkeypatch.setattr(app, "_cache_xml_get", lambda chave: None)
+    monkeypatch.setattr(app, "XML_CACHE_DIR", tmp_path / "cache_tiss")
+
+
+@pytest.mark.parametrize("centavos", [False, True])
+def test_build_xml_df_paralelo_igual_ao_serial(sem_cache_xml, centavos):
+    xmls = [_xml_tiss(40, seed) for seed in range(4)]
+    serial = app.build_xml_df([io.BytesIO(b) for b in xmls], workers=1, centavos=centavos)
+    paralelo = app.build_xml_df([io.BytesIO(b) for b in xmls], workers=2, centavos=centavos)
+
+    assert paralelo.attrs["ingestao"]["workers"] == 2
+    assert len(serial) > 100
+    pd.testing.assert_frame_equal(paralelo, serial)
+
+
+def test_read_glosas_xlsx_paralelo_igual_ao_serial():
+    ler = getattr(app.read_glosas_xlsx, "__wrapped__", app.read_glosas_xlsx)  # sem o st.cache_data
+    arquivos = [_glosas_xlsx(200, 0), _glosas_xlsx(150, 1, cabecalho_alternativo=True), _glosas_xlsx(50, 2)]
+    df_serial, cm_serial = ler([io.BytesIO(b) for b in arquivos], workers=1)
+    df_paralelo, cm_paralelo = ler([io.BytesIO(b) for b in arquivos], workers=2)
+
+    assert len(df_serial) == 400
+    assert cm_paralelo == cm_serial
+    pd.testing.assert_frame_equal(df_paralelo, df_serial)
+
+
+def test_job_conciliacao_incremental_nao_altera_o_estado_da_sessao(sem_cache_xml, tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "JOBS_DIR", tmp_path / "jobs")
+    xmls = [_xml_tiss(30, seed) for seed in range(2)]
+    demo = _demo_de(app.build_xml_df([io.BytesIO(b) for b in xmls]))
+    fila = app.FilaJobs(workers=1)
+
+    def rodar(estado):
+        job = app.Job(fila, app.secrets.token_urlsafe(8), app.ETAPAS_CONC, threading.Event())
+        return app.job_conciliacao(job, [io.BytesIO(b) for b in xmls], demo, params_xml={},
+                                   params_conc=dict(centavos=False), estado_incremental=estado)
+
+    sessao = app.ConciliacaoIncremental()
+    res = rodar(sessao.estado())
+    assert sessao.resultado is None and sessao.params is None  # o job trabalhou numa cópia
+    assert res["incremental"]["completo"] and len(res["conciliacao"]) > 0
+
+    sessao = app.ConciliacaoIncremental.restaurar(res["estado_incremental"])
+    res2 = rodar(sessao.estado())
+    assert res2["incremental"]["guias_recalculadas"] == 0
+    assert sessao.ultimo == res["incremental"]
+    pd.testing.assert_frame_equal(res2["conciliacao"], res["conciliacao"])
+
+
+@pytest.mark.parametrize("fallback", [False, True])
+def test_conciliar_demo_mapeado_manualmente(sem_cache_xml, fallback):
+    # demonstrativo do mapeamento manual: sem chave_demo, o índice usa a chave_prest dele
+    xml = _lote_tiss([
+        _guia_sadt("5001", [("10101012", "Consulta em consultorio", "1", "100.00", "100.00")]),
+        _guia_sadt("5002", [("40304361", "Hemograma completo", "1", "20.00", "20.00")], operadora="9002"),
+        _guia_sadt("5003", [("40399999", "Hemograma completo", "1", "10.00", "10.00"),
+                            ("40399999", "Hemograma completo", "1", "25.00", "25.00")]),
+        _guia_sadt("5004", [("20202020", "Raio X torax", "1", "50.00", "50.00")]),
+    ])
+    df_xml = app.build_xml_df([io.BytesIO(xml)])
+    planilha = pd.DataFrame({
+        "Guia": ["5001", "9002", "5003"],
+        "Código": ["10101012", "40304361", "40304361"],
+        "Descrição": ["Consulta em consultorio", "Hemograma completo", "Hemograma completo"],
+        "Apresentado": [100.0, 20.0, 10.0],
+        "Glosa": [0.0, -5.0, 0.0],
+        "Pago": [100.0, 15.0, 10.0],
+    })
+    demo = app._apply_manual_map(planilha, {"guia_prest": "Guia", "cod_proc": "Código", "desc_proc": "Descrição",
+                                            "val_apres": "Apresentado", "val_glosa": "Glosa", "val_pago": "Pago"})
+    assert "chave_demo" not in demo.columns
+
+    res = app.conciliar_itens(df_xml, demo, fallback_por_descricao=fallback)
+
+    conc = res["conciliacao"]
+    casados = list(zip(conc["numeroGuiaPrestador"], conc["codigo_procedimento"], conc["matched_on"]))
+    nao_casados = list(zip(res["nao_casados"]["numeroGuiaPrestador"], res["nao_casados"]["codigo_procedimento"],
+                           res["nao_casados"]["valor_total"]))
+    assert casados[:2] == [("5001", "10101012", "prestador"), ("5002", "40304361", "operadora")]
+    if fallback:
+        # o item de 10,00 casa por descrição; o de 25,00, com a mesma chave_prest, continua em nao_casados
+        assert casados[2:] == [("5003", "40399999", "descricao+valor")]
+        assert nao_casados == [("5003", "40399999", 25.0), ("5004", "20202020", 50.0)]
+    else:
+        assert casados[2:] == []
+        assert nao_casados == [("5003", "40399999", 10.0), ("5003", "40399999", 25.0), ("5004", "20202020", 50.0)]
+    assert (res["nao_casados"]["matched_on"] == "").all()
+
+
+def test_centavos_valor_unitario_abaixo_de_um_centavo(sem_cache_xml):
+    xml = _lote_tiss([_guia_sadt("6001", [
+        ("90001", "Material fracionado", "1000", "0.004", ""),  # total calculado: 4,00
+        ("90002", "Material sem unitario", "2", "", "7.50"),     # sem unitário: vale o total informado
+        ("90003", "Material", "3", "3.333", ""),
+    ])])
+    flt = app.build_xml_df([io.BytesIO(xml)])
+    cent = app.build_xml_df([io.BytesIO(xml)], centavos=True)
+
+    assert list(cent["valor_unitario"]) == [4, 7500, 3333]  # milésimos de real
+    assert list(cent["valor_total"]) == [400, 750, 1000]
+    reais = app.em_reais(cent, True)
+    assert list(reais["valor_unitario"]) == list(flt["valor_unitario"]) == [0.004, 7.5, 3.333]
+    assert list(reais["valor_total"]) == [4.0, 7.5, 10.0]
+    assert list(flt["valor_total"]) == [4.0, 7.5, 9.999]
+    assert list(reais["quantidade"]) == list(flt["quantidade"])